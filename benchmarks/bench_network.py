@@ -0,0 +1,120 @@
+import os
+import time
+import hashlib
+import logging
+import argparse
+import tempfile
+import tracemalloc
+
+from src import DEFAULT_NAME
+from src.network import Network
+from benchmarks.common import print_table
+from benchmarks.fake_http import FakeFileServer
+
+
+def read(path):
+    with open(path, "rb") as file:
+        return file.read()
+
+
+def check(name, condition):
+    print("%s %s" % ("ok  " if condition else "FAIL", name))
+    return condition
+
+
+def run_checks():
+    """Streaming download/upload of `Network` against the local server: resume, `416`, checksum, progress."""
+    results = []
+    network = Network("bench")
+    with FakeFileServer(size=1024 * 1024 + 123) as fake, tempfile.TemporaryDirectory(prefix="raspone-bench-") as path:
+        file_path = os.path.join(path, "file.bin")
+        size, digest = len(fake.data), hashlib.sha256(fake.data).hexdigest()
+
+        progress = []
+        saved, _ = network.download(fake.url, file_path, checksum=("sha256", digest),
+                                    progress_callback=lambda done, total: progress.append((done, total)))
+        results.append(check("fresh download", saved == file_path and read(file_path) == fake.data and
+                             fake.ranges == [None] and progress[-1] == (size, size) and
+                             not os.path.exists(file_path + ".part")))
+
+        # Connection dropped after a third of the body: the `.part` file (the chunks received whole) is kept, then
+        # continued from its end
+        os.remove(file_path)
+        fake.ranges.clear()
+        fake.drop_after = size // 3
+        interrupted, _ = network.download(fake.url, file_path, checksum=("sha256", digest))
+        kept = os.path.getsize(file_path + ".part") if os.path.exists(file_path + ".part") else 0
+        resumed, _ = network.download(fake.url, file_path, checksum=("sha256", digest))
+        results.append(check("resume after truncation", interrupted is False and 0 < kept <= size // 3 and
+                             resumed == file_path and read(file_path) == fake.data and
+                             fake.ranges == [None, "bytes=%d-" % kept]))
+
+        # `.part` already complete: `416` with `Content-Range: bytes */<size>`, nothing downloaded again
+        os.replace(file_path, file_path + ".part")
+        fake.ranges.clear()
+        saved, _ = network.download(fake.url, file_path)
+        results.append(check("416 on a complete file", saved == file_path and read(file_path) == fake.data and
+                             fake.ranges == ["bytes=%d-" % size]))
+
+        # `.part` longer than the remote file: not a prefix of it, downloaded again from scratch
+        with open(file_path + ".part", "wb") as part_file:
+            part_file.write(os.urandom(size + 10))
+
+        fake.ranges.clear()
+        saved, _ = network.download(fake.url, file_path)
+        results.append(check("416 on a stale file", saved == file_path and read(file_path) == fake.data and
+                             fake.ranges == ["bytes=%d-" % (size + 10), None]))
+
+        os.remove(file_path)
+        mismatch, request_id = network.download(fake.url, file_path, checksum=("sha256", "0" * 64))
+        results.append(check("checksum mismatch", mismatch is False and not os.path.exists(file_path) and
+                             not os.path.exists(file_path + ".part") and
+                             network.get_error(request_id).startswith("Checksum")))
+
+        progress.clear()
+        with open(file_path, "wb") as upload_file:
+            upload_file.write(fake.data)
+
+        response, _ = network.upload(fake.url, file_path,
+                                     progress_callback=lambda done, total: progress.append((done, total)))
+        results.append(check("streamed upload", response is not False and fake.uploaded == fake.data and
+                             progress[-1] == (size, size)))
+
+    return all(results)
+
+
+def bench_download(size_mb, chunk_kb):
+    network = Network("bench")
+    with FakeFileServer(size=size_mb * 1024 * 1024) as fake, \
+            tempfile.TemporaryDirectory(prefix="raspone-bench-") as path:
+        tracemalloc.start()
+        start = time.perf_counter()
+        network.download(fake.url, os.path.join(path, "file.bin"), checksum=("sha256", "0" * 64),
+                         chunk_size=chunk_kb * 1024)
+        duration = time.perf_counter() - start
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+    # The wrong checksum is expected: the `.part` file is hashed and removed, the timing covers the whole path
+    return [size_mb, chunk_kb, "%.1f" % (size_mb / duration), "%.0f" % (peak / 1024)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check and benchmark the streaming transfers of `Network` against "
+                                                 "a local HTTP server")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[16, 64], help="downloaded file sizes (MB)")
+    parser.add_argument("--chunks", type=int, nargs="+", default=[16, 64, 256], help="chunk sizes (KB)")
+    parser.add_argument("--skip-checks", action="store_true")
+    args = parser.parse_args()
+
+    logging.getLogger(DEFAULT_NAME).addHandler(logging.NullHandler())  # Expected errors (the dropped connection)
+    if not args.skip_checks and not run_checks():
+        raise SystemExit(1)
+
+    print()
+    print_table(["MB", "chunk KB", "MB/s", "peak memory KB"],
+                [bench_download(size, chunk) for size in args.sizes for chunk in args.chunks])
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,174 @@
+import os
+import time
+import logging
+import argparse
+
+from src import DEFAULT_NAME
+from benchmarks.common import BenchCore, measure, print_table
+from benchmarks.fake_s3 import FakeS3, BUCKET_NAME
+from modules.s3 import ModuleS3, LIST_PAGE_SIZE, MIN_PART_SIZE
+
+
+def new_module(fake, part_size=MIN_PART_SIZE, threads=4):
+    module = fake.configure(ModuleS3(BenchCore()))
+    module.multipart_threshold = part_size
+    module.part_size = part_size
+    module.upload_threads = threads
+    return module
+
+
+def write_file(path, size):
+    with open(path, "wb") as file:
+        for _ in range(size // MIN_PART_SIZE):
+            file.write(os.urandom(MIN_PART_SIZE))
+
+        file.write(os.urandom(size % MIN_PART_SIZE))
+
+
+def check(name, condition):
+    print("%s %s" % ("ok  " if condition else "FAIL", name))
+    return condition
+
+
+def run_checks():
+    """Behaviour of the S3 path against the stand-in: index pagination, multipart upload, resume, get, delete."""
+    results = []
+    with FakeS3(objects=2500) as fake:
+        module = new_module(fake)
+
+        # Index: `list_objects_v2` pages of 1000 keys, list pages of `LIST_PAGE_SIZE`
+        objects, error = module.get_objects()
+        results.append(check("index lists every page", not error and len(objects) == 2500))
+
+        module._list_view = ["LIST", "prefix-3/", "name", 0]
+        message, keyboard = module._render_list()
+        results.append(check("prefix view", len(module._get_view()) == 250 and "Page 1/%d" % (250 // LIST_PAGE_SIZE)
+                             in message))
+
+        # Multipart upload (3 parts), content read back with ranged reads
+        file_path = os.path.join(fake.data_path, "upload")
+        write_file(file_path, 2 * MIN_PART_SIZE + 1234)
+        saved, error = module.save_file("upload.bin", file_path)
+        object_key = saved[0] if saved else None
+        results.append(check("multipart upload", not error and object_key in module.objects and
+                             fake.client.head_object(Bucket=BUCKET_NAME, Key=object_key)["ETag"].endswith('-3"')))
+
+        size, error = module.download_object(object_key, file_path + ".get")
+        with open(file_path, "rb") as sent, open(file_path + ".get", "rb") as received:
+            results.append(check("ranged download", not error and sent.read() == received.read()))
+
+        saved, error = module.save_file("copy.bin", file_path)
+        results.append(check("duplicate not uploaded", not error and saved == (saved[0], saved[1], True)))
+
+        # Queued upload interrupted at the second part, then resumed without sending the first part again
+        entry_id = "resumed"
+        write_file(os.path.join(module.queue_path, entry_id), 2 * MIN_PART_SIZE + 1)
+        queued, error = module.enqueue_file(entry_id, "resumed.bin")
+        client = module.get_client()
+        upload_part, sent_parts, dropped = client.upload_part, [], []
+
+        def flaky_upload_part(**kwargs):
+            sent_parts.append(kwargs["PartNumber"])
+            if kwargs["PartNumber"] == 2 and not dropped:
+                dropped.append(kwargs["PartNumber"])
+                raise ConnectionError("Network drop")
+
+            return upload_part(**kwargs)
+
+        client.upload_part = flaky_upload_part
+        module.upload_threads = 1
+        entry = module.queue[entry_id]
+        _, error = module.upload_file(entry["key"], os.path.join(module.queue_path, entry_id), None, None,
+                                      entry["metadata"], entry)
+        first_attempt = list(sent_parts)
+        sent_parts.clear()
+        _, resume_error = module.upload_file(entry["key"], os.path.join(module.queue_path, entry_id), None, None,
+                                             entry["metadata"], entry)
+        results.append(check("queued upload resumed", error and not resume_error and first_attempt[:2] == [1, 2]
+                             and 1 not in sent_parts and entry["key"] in module.objects))
+        client.upload_part = upload_part
+
+        # Deletes: bucket, index and digests
+        status, error = module.delete_object(object_key)
+        listed = fake.client.list_objects_v2(Bucket=BUCKET_NAME, Prefix=object_key)
+        results.append(check("delete", status and not listed.get("KeyCount") and object_key not in module.objects
+                             and object_key not in module.digests.values()))
+
+        # Unloaded instance: its uploads stop without writing the manifest loaded by the next instance
+        entry_id = "unloaded"
+        write_file(os.path.join(module.queue_path, entry_id), 2 * MIN_PART_SIZE + 1)
+        queued, error = module.enqueue_file(entry_id, "unloaded.bin")
+        module.kill()
+        entry = module.queue[entry_id]
+        _, error = module.upload_file(entry["key"], os.path.join(module.queue_path, entry_id), None, None,
+                                      entry["metadata"], entry)
+        reloaded = new_module(fake)
+        reloaded._load_queue()
+        results.append(check("unloaded instance stops", error and reloaded.queue.get(entry_id, {}).get("status")
+                             == "queued" and module.enqueue_file("late", "late.bin")[1]))
+
+    return all(results)
+
+
+def bench_upload(size_mb, threads):
+    with FakeS3() as fake:
+        file_path = os.path.join(fake.data_path, "upload")
+        write_file(file_path, size_mb * 1024 * 1024)
+
+        rows = []
+        for name, module in [("put_object", new_module(fake, part_size=2 * size_mb * 1024 * 1024)),
+                             ("multipart x%d" % threads, new_module(fake, threads=threads))]:
+            module.deduplicate = False
+            start = time.perf_counter()
+            saved, error = module.save_file("upload.bin", file_path)
+            duration = time.perf_counter() - start
+            rows.append([name, size_mb, "%.1f" % (size_mb / duration), "error" if error else "ok"])
+
+    return rows
+
+
+def bench_listing(objects_count):
+    with FakeS3() as fake:
+        # Seeded with the client, not timed: moto serves `put_object` much slower than `list_objects_v2`
+        seed_start = time.perf_counter()
+        fake.add_objects(objects_count)
+        seed_s = time.perf_counter() - seed_start
+
+        module = new_module(fake)
+        refresh_ms = measure(module.refresh_index, repeat=3)
+
+        module._list_view = ["LIST", "", "date", 0]
+
+        def render_cold():
+            module._objects_version += 1
+            module._render_list()
+
+        render_ms = measure(render_cold)
+        module._list_view[3] = 5
+        flip_ms = measure(module._render_list)
+
+    return [objects_count, "%.1f" % seed_s, "%.1f" % refresh_ms, "%.3f" % render_ms, "%.3f" % flip_ms]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check and benchmark the S3 module against an in-process S3 stand-in")
+    parser.add_argument("--objects", type=int, nargs="+", default=[1000, 10000])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[16, 64], help="uploaded file sizes (MB)")
+    parser.add_argument("--threads", type=int, default=4)
+    parser.add_argument("--skip-checks", action="store_true")
+    args = parser.parse_args()
+
+    logging.getLogger(DEFAULT_NAME).addHandler(logging.NullHandler())  # Expected errors (the network drop)
+    if not args.skip_checks and not run_checks():
+        raise SystemExit(1)
+
+    print()
+    print_table(["upload", "MB", "MB/s", "result"],
+                [row for size in args.sizes for row in bench_upload(size, args.threads)])
+    print()
+    print_table(["objects", "seed s", "index refresh ms", "list ms", "page flip ms"],
+                [bench_listing(x) for x in args.objects])
+
+
+if __name__ == "__main__":
+    main()
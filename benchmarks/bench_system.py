@@ -0,0 +1,62 @@
+import math
+import time
+import argparse
+
+from benchmarks.common import BenchCore, measure, print_table
+from modules.system import ModuleSystem, RESOLUTIONS, METRICS
+
+
+def check(name, condition):
+    print("%s %s" % ("ok  " if condition else "FAIL", name))
+    return condition
+
+
+def run_checks(module):
+    """Downsampling between the resolutions, on synthetic samples (10 s apart)."""
+    sampler = module.sampler
+    samples = math.prod(x[0] for x in RESOLUTIONS) * 2
+    for i in range(samples):
+        sampler._append([float(i)] + [math.nan] * (len(METRICS) - 1), i * 10)
+
+    finest, coarsest = sampler.levels[0], sampler.levels[-1]
+    results = [
+        check("every level fed", all(level.count for level in sampler.levels)),
+        check("coarsest level is the mean", coarsest.last()[0] == (samples - 1 + samples / 2) / 2),
+        check("missing metrics stay missing", math.isnan(coarsest.last()[1])),
+        check("trend series", len(finest.series(3600, 12)) == 12 and "█" in module._render_stats())
+    ]
+
+    return all(results)
+
+
+def main(args):
+    module = ModuleSystem(BenchCore())
+    if not args.skip_checks and not run_checks(module):
+        raise SystemExit(1)
+
+    # Real `/proc` and `/sys` of this host
+    module = ModuleSystem(BenchCore())
+    sampler = module.sampler
+    sampler.sample()
+
+    start_cpu = time.process_time()
+    sample_ms = measure(sampler.sample, repeat=args.samples)
+    cpu_ms = (time.process_time() - start_cpu) * 1000 / args.samples
+
+    for _ in range(max(x[1] for x in RESOLUTIONS)):
+        sampler.sample()
+
+    render_ms = measure(module._render_stats)
+    memory = sum(level.times.itemsize * len(level.times) * (1 + len(level.values)) for level in sampler.levels)
+
+    print()
+    print_table(["sample ms", "sample CPU ms", "CPU %% at %ds" % sampler.interval, "render ms", "buffers kB"],
+                [["%.3f" % sample_ms, "%.3f" % cpu_ms, "%.4f" % (cpu_ms / 10 / sampler.interval),
+                  "%.2f" % render_ms, memory // 1024]])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Check and benchmark the system metrics sampler")
+    parser.add_argument("--samples", type=int, default=1000)
+    parser.add_argument("--skip-checks", action="store_true")
+    main(parser.parse_args())
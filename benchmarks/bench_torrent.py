@@ -0,0 +1,65 @@
+import asyncio
+import argparse
+
+from benchmarks.common import BenchCore, measure, print_table
+from benchmarks.fake_transmission import FakeTransmission
+from modules.torrent import ModuleTorrent, TORRENT_FIELDS
+
+
+def bench_population(torrents_count, ticks):
+    with FakeTransmission(torrents=torrents_count) as fake:
+        module = ModuleTorrent(BenchCore())
+        module.rpc_url = fake.url
+        module.status_message_enabled = False
+
+        # Baseline: what a tick cost when every torrent was fetched each time
+        fake.reset_stats()
+        full_ms = measure(lambda: module.rpc("torrent-get", {"fields": TORRENT_FIELDS}), repeat=ticks)
+        full_bytes = fake.bytes_sent // fake.requests_count
+
+        # First (full) sync of the local table, then `recently-active` deltas
+        module.sync_torrents()
+        fake.reset_stats()
+        tick_ms = measure(lambda: (module.sync_torrents(), asyncio.run(module.watch_progress())), repeat=ticks)
+        tick_bytes = fake.bytes_sent // max(fake.requests_count, 1)
+
+        # `/torrent list`: first page after a table change, then cached page flips
+        module._list_view = ["LIST", "id", "all", 0]
+
+        def render_cold():
+            module._torrents_version += 1
+            module._render_list()
+
+        render_ms = measure(render_cold)
+        flip_ms = measure(module._render_list)
+
+        torrents = sorted(module.torrents.values(), key=lambda x: x["id"])
+        keyboard_page_ms = measure(lambda: module._prepare_keyboard("PAUSE", torrents[:10], set(), 0,
+                                                                    -(-len(torrents) // 10)))
+        keyboard_all_ms = measure(lambda: module._prepare_keyboard("PAUSE", torrents))
+
+        module.stop_watcher()
+
+    return [torrents_count,
+            "%.2f" % full_ms, full_bytes,
+            "%.2f" % tick_ms, tick_bytes,
+            "%.3f" % render_ms, "%.3f" % flip_ms,
+            "%.3f" % keyboard_page_ms, "%.2f" % keyboard_all_ms]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the torrent module against a fake Transmission server")
+    parser.add_argument("--torrents", type=int, nargs="+", default=[10, 100, 1000, 10000])
+    parser.add_argument("--ticks", type=int, default=10)
+    args = parser.parse_args()
+
+    print_table(["torrents",
+                 "full get ms", "full get B",
+                 "tick ms", "tick B",
+                 "list ms", "page flip ms",
+                 "keyboard page ms", "keyboard all ms"],
+                [bench_population(x, args.ticks) for x in args.torrents])
+
+
+if __name__ == "__main__":
+    main()
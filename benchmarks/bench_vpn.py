@@ -0,0 +1,111 @@
+import time
+import asyncio
+import logging
+import argparse
+
+from src import DEFAULT_NAME
+from benchmarks.common import BenchCore, print_table
+from benchmarks.fake_openvpn import FakeOpenVPN
+from modules.vpn import ModuleVPN, ManagementClient
+
+
+def new_module(fake, client_auth=False):
+    module = ModuleVPN(BenchCore())
+    module.management = ManagementClient(fake.address, fake.password, module._management_notification)
+    module.management_client_auth = client_auth
+    return module
+
+
+async def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        await asyncio.sleep(0.01)
+
+    return condition()
+
+
+def check(name, condition):
+    print("%s %s" % ("ok  " if condition else "FAIL", name))
+    return condition
+
+
+async def run_checks():
+    """Management client against the fake server: password, `status`, `>CLIENT:` notifications, reconnection."""
+    results = []
+    with FakeOpenVPN(clients=3, password="secret") as fake:
+        module = new_module(fake, client_auth=True)
+        task = asyncio.get_running_loop().create_task(module.management.run())
+
+        results.append(check("connected with password", await wait_for(lambda: module.management.connected)))
+
+        await module.poll_status(None)
+        await module.poll_status(None)
+        results.append(check("status parsed", len(module.clients) == 3 and module.count_sessions() == 3 and
+                             all(x["received"] and x["since"] for x in module.clients.values())))
+        results.append(check("traffic history", all(module.traffic[x].rates() != (0, 0) for x in module.clients)))
+
+        client_id = fake.connect_client("phone")
+        results.append(check("connect alert and client approved",
+                             await wait_for(lambda: any("phone" in x for x in module.core.sent_messages)) and
+                             await wait_for(lambda: [str(client_id), "1"] in fake.approved)))
+
+        await module.poll_status(None)
+        fake.disconnect_client(client_id)
+        results.append(check("disconnect alert",
+                             await wait_for(lambda: any("disconnected" in x for x in module.core.sent_messages))))
+
+        await module.poll_status(None)
+        results.append(check("ended session in totals", "phone" in module.traffic_totals and
+                             "phone" in module._render_traffic() and len(module.clients) == 3))
+
+        for session in list(fake.sessions):
+            session.close()
+
+        results.append(check("reconnected", await wait_for(lambda: not module.management.connected, 2) and
+                             await wait_for(lambda: module.management.connected, 10)))
+
+        task.cancel()
+
+    return all(results)
+
+
+async def bench_population(clients_count, polls):
+    with FakeOpenVPN(clients=clients_count) as fake:
+        module = new_module(fake)
+        task = asyncio.get_running_loop().create_task(module.management.run())
+        await wait_for(lambda: module.management.connected)
+
+        durations = []
+        for _ in range(polls):
+            start = time.perf_counter()
+            await module.poll_status(None)
+            durations.append((time.perf_counter() - start) * 1000)
+
+        start = time.perf_counter()
+        module._render_clients()
+        module._render_traffic()
+        render_ms = (time.perf_counter() - start) * 1000
+
+        task.cancel()
+
+    durations.sort()
+    return [clients_count, "%.2f" % durations[len(durations) // 2], "%.2f" % render_ms]
+
+
+async def main(args):
+    logging.getLogger(DEFAULT_NAME).addHandler(logging.NullHandler())  # Expected warnings (the reconnection)
+    if not args.skip_checks and not await run_checks():
+        raise SystemExit(1)
+
+    print()
+    print_table(["clients", "status poll ms", "render ms"],
+                [await bench_population(x, args.polls) for x in args.clients])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Check and benchmark the VPN module against a fake OpenVPN "
+                                                 "management interface")
+    parser.add_argument("--clients", type=int, nargs="+", default=[10, 100, 1000])
+    parser.add_argument("--polls", type=int, default=10)
+    parser.add_argument("--skip-checks", action="store_true")
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,76 @@
+import os
+import sys
+import time
+import types
+import tempfile
+import cachetools
+import statistics
+
+from src import core
+
+
+class BenchCore:
+    """Minimal stand-in of `RaspOne` (no Telegram, no IPC) to instantiate modules in benchmarks."""
+
+    def __init__(self):
+        # The modules state (`DATA_PATH`) and scripts (`UTILS_PATH`) go into a temporary directory, not the checkout
+        self.temp_dir = tempfile.TemporaryDirectory(prefix="raspone-bench-")
+        redirect_paths(self.temp_dir.name)
+
+        self.chat_id = None
+        self.sent_messages = []
+        self.modules = {"instances": dict(), "handlers": dict(), "callbacks": dict()}
+        self.callback_tokens = cachetools.TTLCache(maxsize=core.CALLBACK_TOKENS_SIZE, ttl=core.CALLBACK_TOKENS_TTL)
+
+        self.ipc = types.SimpleNamespace(add_service=lambda *_: None, remove_service=lambda *_: None)
+        self.server = None
+        self.application = types.SimpleNamespace(
+            bot=None,
+            job_queue=types.SimpleNamespace(run_repeating=lambda *_, **__: _BenchJob(),
+                                            run_once=lambda *_, **__: _BenchJob())
+        )
+
+    register_callback_token = core.RaspOne.register_callback_token
+    get_callback_token = core.RaspOne.get_callback_token
+
+    def send_message(self, message, log=True, markdown=True, on_sent=None, silent=False):
+        self.sent_messages.append(message)
+        if on_sent:
+            on_sent(types.SimpleNamespace(message_id=len(self.sent_messages), text=message))
+
+        return True
+
+    def edit_message(self, message_id, message, log=True, markdown=True):
+        self.sent_messages[message_id - 1] = message
+        return True
+
+
+def redirect_paths(path):
+    """Point `DATA_PATH` and `UTILS_PATH` of `src` and of the modules already imported to `path`."""
+    for name, directory in (("DATA_PATH", "data"), ("UTILS_PATH", "utils")):
+        os.makedirs(os.path.join(path, directory), exist_ok=True)
+        for module_name, module in list(sys.modules.items()):
+            if (module_name == "src" or module_name.split(".")[0] == "modules") and hasattr(module, name):
+                setattr(module, name, os.path.join(path, directory, ""))
+
+
+class _BenchJob:
+    def schedule_removal(self):
+        pass
+
+
+def measure(func, repeat=5):
+    """Run `func` `repeat` times, return the median duration in milliseconds."""
+    durations = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        durations.append((time.perf_counter() - start) * 1000)
+
+    return statistics.median(durations)
+
+
+def print_table(header, rows):
+    widths = [max(len(str(x)) for x in column) for column in zip(header, *rows)]
+    for row in [header] + rows:
+        print("  ".join(str(x).rjust(w) for x, w in zip(row, widths)))
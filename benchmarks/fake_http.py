@@ -0,0 +1,90 @@
+import os
+import re
+import threading
+import http.server
+
+RANGE_HEADER = re.compile(r"^bytes=(\d+)-$")
+
+
+class FakeFileServer:
+    """
+    In-process HTTP server of a single file (`GET` with `Range: bytes=N-` support, `416` past its end) that also
+    stores the body of `PUT` requests. With `drop_after` a `GET` is cut after that many bytes (once).
+
+    Usage:
+    ```
+        with FakeFileServer(size=1024 * 1024) as fake:
+            network.download(fake.url, file_path)
+    ```
+    """
+
+    def __init__(self, size=1024 * 1024, host="127.0.0.1", port=0):
+        self.data = os.urandom(size)
+        self.drop_after = None
+        self.ranges = []  # `Range` header of every `GET`, None when not sent
+        self.uploaded = None
+
+        self.server = http.server.ThreadingHTTPServer((host, port), _FakeFileHandler)
+        self.server.fake = self
+        self.thread = None
+
+    @property
+    def url(self):
+        return "http://%s:%d/file.bin" % self.server.server_address[:2]
+
+    def start(self):
+        self.thread = threading.Thread(name="[Fake] HTTP", target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *_):
+        self.stop()
+
+
+class _FakeFileHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        fake, data = self.server.fake, self.server.fake.data
+        fake.ranges.append(self.headers.get("Range", None))
+
+        match = RANGE_HEADER.match(self.headers.get("Range", ""))
+        offset = int(match.group(1)) if match else 0
+        if offset >= len(data):
+            self.send_response(416)
+            self.send_header("Content-Range", "bytes */%d" % len(data))
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+
+        self.send_response(206 if match else 200)
+        if match:
+            self.send_header("Content-Range", "bytes %d-%d/%d" % (offset, len(data) - 1, len(data)))
+
+        self.send_header("Content-Length", str(len(data) - offset))
+        self.end_headers()
+
+        if fake.drop_after is not None:
+            # Fewer bytes than announced, then the connection is closed: the client sees a truncated body
+            self.wfile.write(data[offset:offset + fake.drop_after])
+            fake.drop_after = None
+            self.close_connection = True
+            return
+
+        self.wfile.write(data[offset:])
+
+    def do_PUT(self):
+        self.server.fake.uploaded = self.rfile.read(int(self.headers.get("Content-Length", "0")))
+        self.send_response(200)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, *_):
+        pass
@@ -0,0 +1,178 @@
+import time
+import random
+import threading
+import socketserver
+
+BANNER = ">INFO:OpenVPN Management Interface Version 5 -- type 'help' for more info"
+
+STATUS_HEADER = ["Common Name", "Real Address", "Virtual Address", "Virtual IPv6 Address", "Bytes Received",
+                 "Bytes Sent", "Connected Since", "Connected Since (time_t)", "Username", "Client ID", "Peer ID",
+                 "Data Channel Cipher"]
+
+
+class FakeOpenVPN:
+    """
+    In-process fake of the OpenVPN (server mode) management interface over TCP, with a population of clients.
+    Implements the password prompt, `status 3`, `client-auth-nt`, `quit` and the `>CLIENT:` notifications,
+    sent to every session by `connect_client` and `disconnect_client`.
+
+    Usage:
+    ```
+        with FakeOpenVPN(clients=100) as fake:
+            module.management = ManagementClient(fake.address, ...)
+    ```
+    """
+
+    def __init__(self, clients=0, password=None, host="127.0.0.1", port=0, seed=1):
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.password = password
+
+        self.clients = dict()  # client ID -> client
+        self.next_id = 0
+        self.sessions = []
+        self.commands = []
+        self.approved = []
+
+        for i in range(clients):
+            self._new_client("client-%d" % i)
+
+        self.server = socketserver.ThreadingTCPServer((host, port), _FakeOpenVPNHandler)
+        self.server.daemon_threads = True
+        self.server.fake = self
+        self.thread = None
+
+    @property
+    def address(self):
+        return "%s:%d" % self.server.server_address[:2]
+
+    def start(self):
+        self.thread = threading.Thread(name="[Fake] OpenVPN", target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        for session in list(self.sessions):
+            session.close()
+
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *_):
+        self.stop()
+
+    # Simulation
+    def _new_client(self, name):
+        client_id = self.next_id
+        self.next_id += 1
+        self.clients[client_id] = {
+            "Common Name": name,
+            "Real Address": "203.0.113.%d:%d" % (client_id % 250 + 1, self.random.randint(1024, 65535)),
+            "Virtual Address": "10.8.%d.%d" % (client_id // 250, client_id % 250 + 2),
+            "Virtual IPv6 Address": "",
+            "Bytes Received": 0,
+            "Bytes Sent": 0,
+            "Connected Since (time_t)": int(time.time()) - self.random.randint(0, 86400),
+            "Username": "UNDEF",
+            "Client ID": client_id,
+            "Peer ID": client_id,
+            "Data Channel Cipher": "AES-256-GCM",
+        }
+        return self.clients[client_id]
+
+    def _env(self, client, **extra):
+        env = {"common_name": client["Common Name"], "trusted_ip": client["Real Address"].split(":")[0],
+               "ifconfig_pool_remote_ip": client["Virtual Address"]}
+        env.update(extra)
+        return [">CLIENT:ENV,%s=%s" % item for item in env.items()] + [">CLIENT:ENV,END"]
+
+    def connect_client(self, name):
+        with self.lock:
+            client = self._new_client(name)
+            client["Connected Since (time_t)"] = int(time.time())
+            client_id = client["Client ID"]
+            self.broadcast([">CLIENT:CONNECT,%d,1" % client_id] + self._env(client) +
+                           [">CLIENT:ESTABLISHED,%d" % client_id] + self._env(client))
+        return client_id
+
+    def disconnect_client(self, client_id):
+        with self.lock:
+            client = self.clients.pop(client_id)
+            self.broadcast([">CLIENT:DISCONNECT,%d" % client_id] + self._env(
+                client, bytes_received=client["Bytes Received"], bytes_sent=client["Bytes Sent"],
+                time_duration=int(time.time()) - client["Connected Since (time_t)"]))
+
+    def broadcast(self, lines):
+        for session in list(self.sessions):
+            session.send(lines)
+
+    def status(self):
+        # Clients exchange some traffic between two `status`
+        lines = ["TITLE\tOpenVPN 2.5.9 fake", "TIME\t%s\t%d" % (time.ctime(), time.time()),
+                 "\t".join(["HEADER", "CLIENT_LIST"] + STATUS_HEADER)]
+        with self.lock:
+            for client in self.clients.values():
+                client["Bytes Received"] += self.random.randint(0, 10 ** 6)
+                client["Bytes Sent"] += self.random.randint(0, 10 ** 7)
+                client["Connected Since"] = time.ctime(client["Connected Since (time_t)"])
+                lines.append("\t".join(["CLIENT_LIST"] + [str(client[k]) for k in STATUS_HEADER]))
+
+        return lines + ["GLOBAL_STATS\tMax bcast/mcast queue length\t0", "END"]
+
+
+class _FakeOpenVPNHandler(socketserver.StreamRequestHandler):
+    def setup(self):
+        super().setup()
+        self.write_lock = threading.Lock()
+        self.fake = self.server.fake
+
+    def send(self, lines, end="\r\n"):
+        with self.write_lock:
+            try:
+                self.wfile.write("".join(line + end for line in lines).encode())
+                self.wfile.flush()
+
+            except OSError:
+                pass
+
+    def close(self):
+        try:
+            self.connection.shutdown(2)
+
+        except OSError:
+            pass
+
+    def handle(self):
+        if self.fake.password:
+            self.send(["ENTER PASSWORD:"], end="")
+            if self.rfile.readline().decode().strip() != self.fake.password:
+                self.send(["ERROR: bad password"])
+                return
+
+            self.send(["SUCCESS: password is correct"])
+
+        self.send([BANNER])
+        self.fake.sessions.append(self)
+        try:
+            for line in self.rfile:
+                command = line.decode().strip()
+                self.fake.commands.append(command)
+
+                if command == "status 3":
+                    self.send(self.fake.status())
+
+                elif command.startswith("client-auth-nt "):
+                    self.fake.approved.append(command.split()[1:])
+                    self.send(["SUCCESS: client-auth command succeeded"])
+
+                elif command == "quit":
+                    return
+
+                else:
+                    self.send(["ERROR: unknown command, enter 'help' for more options"])
+
+        finally:
+            self.fake.sessions.remove(self)
@@ -0,0 +1,75 @@
+import os
+import shutil
+import tempfile
+
+try:
+    import boto3
+    from moto import mock_aws
+
+except ImportError as import_error:
+    raise ImportError("The S3 stand-in needs moto: pip install 'moto[s3]'") from import_error
+
+BUCKET_NAME = "raspone-bench"
+
+CREDENTIALS = {"aws_access_key_id": "bench", "aws_secret_access_key": "bench"}
+
+
+class FakeS3:
+    """
+    In-process stand-in of S3 (moto, every boto3 call is served in memory), with a bucket of synthetic objects.
+
+    Usage:
+    ```
+        with FakeS3(objects=10000) as fake:
+            fake.configure(module)
+    ```
+    """
+
+    def __init__(self, objects=0, object_size=128, prefixes=10):
+        self.objects_count = objects
+        self.object_size = object_size
+        self.prefixes = prefixes
+
+        self.mock = mock_aws()
+        self.client = None
+        self.data_path = None
+
+    def start(self):
+        os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+        self.mock.start()
+        self.data_path = tempfile.mkdtemp(prefix="raspone-bench-s3-")
+
+        self.client = boto3.client("s3", **CREDENTIALS)
+        self.client.create_bucket(Bucket=BUCKET_NAME)
+        self.add_objects(self.objects_count)
+        return self
+
+    def stop(self):
+        self.mock.stop()
+        shutil.rmtree(self.data_path, ignore_errors=True)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *_):
+        self.stop()
+
+    def add_objects(self, count, start=0):
+        body = b"x" * self.object_size
+        for i in range(start, start + count):
+            self.client.put_object(Bucket=BUCKET_NAME, Key="prefix-%d/object-%06d" % (i % self.prefixes, i),
+                                   Body=body)
+
+    def configure(self, module):
+        """Point a `ModuleS3` at the stand-in bucket, with its state (digests, upload queue) in a temporary dir."""
+        module.credentials = dict(CREDENTIALS)
+        module.rasp_bucket_name = BUCKET_NAME
+        module.client = None
+
+        module.digests = dict()
+        module.digests_path = os.path.join(self.data_path, "s3_digests.json")
+        module.queue = dict()
+        module.queue_path = os.path.join(self.data_path, "s3_queue")
+        module.queue_manifest_path = os.path.join(module.queue_path, "manifest.json")
+        os.makedirs(module.queue_path, exist_ok=True)
+        return module
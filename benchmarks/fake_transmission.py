@@ -0,0 +1,232 @@
+import json
+import time
+import random
+import base64
+import hashlib
+import threading
+import http.server
+
+SESSION_ID = "RaspOneFakeSession"
+
+RECENTLY_ACTIVE_SECONDS = 60
+
+
+class FakeTransmission:
+    """
+    In-process fake of the Transmission RPC server, with a synthetic population of torrents.
+    Implements the `X-Transmission-Session-Id` handshake (409), `torrent-get`/`add`/`start`/`stop`/`set`/`remove`
+    and `session-get`/`set`/`stats`.
+
+    Usage:
+    ```
+        with FakeTransmission(torrents=1000) as fake:
+            module.rpc_url = fake.url
+    ```
+    """
+
+    def __init__(self, torrents=100, downloading_ratio=0.05, host="127.0.0.1", port=0, seed=1):
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+
+        self.torrents = dict()
+        self.removed = dict()  # ID -> removal time
+        self.session = {"alt-speed-enabled": False, "alt-speed-down": 50, "alt-speed-up": 50,
+                        "speed-limit-down-enabled": False, "speed-limit-down": 100,
+                        "speed-limit-up-enabled": False, "speed-limit-up": 100}
+        self.next_id = 1
+
+        self.requests_count = 0
+        self.bytes_sent = 0
+
+        for _ in range(torrents):
+            self._new_torrent("Synthetic torrent", downloading=self.random.random() < downloading_ratio)
+
+        self.server = http.server.ThreadingHTTPServer((host, port), _FakeTransmissionHandler)
+        self.server.fake = self
+        self.thread = None
+
+    @property
+    def url(self):
+        return "http://%s:%d/transmission/rpc" % self.server.server_address[:2]
+
+    def start(self):
+        self.thread = threading.Thread(name="[Fake] Transmission", target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *_):
+        self.stop()
+
+    def reset_stats(self):
+        self.requests_count = self.bytes_sent = 0
+
+    # Simulation
+    def _new_torrent(self, name, downloading=True):
+        torrent_id = self.next_id
+        self.next_id += 1
+
+        total_size = self.random.randint(10 ** 6, 10 ** 10)
+        percent_done = round(self.random.random(), 4) if downloading else 1
+        self.torrents[torrent_id] = {
+            "id": torrent_id,
+            "name": "%s %d" % (name, torrent_id),
+            "hashString": hashlib.sha1(b"%d" % torrent_id).hexdigest(),
+            "totalSize": total_size,
+            "error": 0,
+            "errorString": "",
+            "eta": self.random.randint(60, 86400) if downloading else -1,
+            "percentDone": percent_done,
+            "status": 4 if downloading else 6,
+            "uploadRatio": round(self.random.random() * 3, 2),
+            "rateDownload": self.random.randint(0, 2 * 10 ** 6) if downloading else 0,
+            "leftUntilDone": int(total_size * (1 - percent_done)),
+            "activityDate": int(time.time()) - (0 if downloading else self.random.randint(3600, 86400)),
+        }
+        return self.torrents[torrent_id]
+
+    def _tick(self):
+        # Downloading torrents progress at every `torrent-get`
+        now = int(time.time())
+        for torrent in self.torrents.values():
+            if torrent["status"] == 4:
+                torrent["percentDone"] = min(1, round(torrent["percentDone"] + self.random.random() / 100, 4))
+                torrent["leftUntilDone"] = int(torrent["totalSize"] * (1 - torrent["percentDone"]))
+                torrent["rateDownload"] = self.random.randint(0, 2 * 10 ** 6)
+                torrent["activityDate"] = now
+                if torrent["percentDone"] == 1:
+                    torrent.update({"status": 6, "eta": -1, "rateDownload": 0})
+
+    def _files(self, torrent):
+        # Per-file data, generated on first request
+        if "files" not in torrent:
+            files_count = self.random.randint(1, 50)
+            torrent["files"] = [{"name": "%s/file %d.bin" % (torrent["name"], i),
+                                 "length": torrent["totalSize"] // files_count,
+                                 "bytesCompleted": int(torrent["totalSize"] // files_count * torrent["percentDone"])}
+                                for i in range(files_count)]
+            torrent["fileStats"] = [{"bytesCompleted": x["bytesCompleted"], "wanted": True, "priority": 0}
+                                    for x in torrent["files"]]
+
+        return torrent
+
+    def _select(self, ids):
+        if ids is None:
+            return list(self.torrents.values())
+
+        elif ids == "recently-active":
+            since = time.time() - RECENTLY_ACTIVE_SECONDS
+            return [x for x in self.torrents.values() if x["activityDate"] >= since]
+
+        ids = ids if isinstance(ids, list) else [ids]
+        return [self.torrents[x] for x in ids if x in self.torrents]
+
+    # RPC methods
+    def rpc(self, method, arguments):
+        arguments = arguments or {}
+        with self.lock:
+            if method == "torrent-get":
+                self._tick()
+                fields = arguments.get("fields", [])
+                torrents = self._select(arguments.get("ids"))
+                if "files" in fields or "fileStats" in fields:
+                    torrents = [self._files(x) for x in torrents]
+
+                response = {"torrents": [{k: x[k] for k in fields if k in x} for x in torrents]}
+                if arguments.get("ids") == "recently-active":
+                    since = time.time() - RECENTLY_ACTIVE_SECONDS
+                    response["removed"] = [k for k, v in self.removed.items() if v >= since]
+
+                return "success", response
+
+            elif method == "torrent-add":
+                if "metainfo" in arguments:
+                    name = hashlib.sha1(base64.b64decode(arguments["metainfo"])).hexdigest()[:8]
+
+                elif "filename" in arguments:
+                    name = arguments["filename"].rsplit("/", 1)[-1]
+
+                else:
+                    return "no filename or metainfo specified", {}
+
+                torrent = self._new_torrent(name)
+                return "success", {"torrent-added": {k: torrent[k] for k in ("id", "name", "hashString")}}
+
+            elif method in ("torrent-start", "torrent-stop"):
+                for torrent in self._select(arguments.get("ids")):
+                    torrent["status"] = 0 if method == "torrent-stop" else (4 if torrent["percentDone"] < 1 else 6)
+                    torrent["activityDate"] = int(time.time())
+
+                return "success", {}
+
+            elif method == "torrent-set":
+                for torrent in map(self._files, self._select(arguments.get("ids"))):
+                    for argument, key, value in (("files-wanted", "wanted", True), ("files-unwanted", "wanted", False),
+                                                 ("priority-high", "priority", 1), ("priority-normal", "priority", 0),
+                                                 ("priority-low", "priority", -1)):
+                        for index in arguments.get(argument, []):
+                            torrent["fileStats"][index][key] = value
+
+                return "success", {}
+
+            elif method == "session-get":
+                return "success", dict(self.session)
+
+            elif method == "session-set":
+                self.session.update({k: v for k, v in arguments.items() if k in self.session})
+                return "success", {}
+
+            elif method == "session-stats":
+                downloading = [x for x in self.torrents.values() if x["status"] == 4]
+                return "success", {"activeTorrentCount": len(downloading), "torrentCount": len(self.torrents),
+                                   "downloadSpeed": sum(x["rateDownload"] for x in downloading),
+                                   "uploadSpeed": self.random.randint(0, 10 ** 6)}
+
+            elif method == "torrent-remove":
+                for torrent in self._select(arguments.get("ids")):
+                    self.torrents.pop(torrent["id"])
+                    self.removed[torrent["id"]] = time.time()
+
+                return "success", {}
+
+        return "method name not recognized", {}
+
+
+class _FakeTransmissionHandler(http.server.BaseHTTPRequestHandler):
+    def do_POST(self):
+        fake = self.server.fake
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+        if self.headers.get("X-Transmission-Session-Id") != SESSION_ID:
+            self.send_response(409)
+            self.send_header("X-Transmission-Session-Id", SESSION_ID)
+            self.end_headers()
+            return
+
+        try:
+            request = json.loads(body)
+            result, arguments = fake.rpc(request["method"], request.get("arguments"))
+
+        except (ValueError, KeyError, TypeError):
+            self.send_response(400)
+            self.end_headers()
+            return
+
+        response = json.dumps({"result": result, "arguments": arguments}).encode()
+        fake.requests_count += 1
+        fake.bytes_sent += len(response)
+
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(response)))
+        self.end_headers()
+        self.wfile.write(response)
+
+    def log_message(self, *_):
+        pass
@@ -1,7 +1,12 @@
+import time
+import asyncio
+import humanize
 import telegram.ext
 
 from src import network
 
+PROGRESS_EDIT_INTERVAL = 2  # seconds
+
 
 # Base Module
 class RaspOneBaseModule:
@@ -40,6 +45,47 @@ class RaspOneBaseModule:
     def remove_callback(self, tag):
         self.core.remove_callback(f"{self.NAME.upper()}_{tag}")
 
+    def callback_data(self, tag, payload):
+        """`callback_data` for a button of the `tag` query callback, carrying `payload` as a short token."""
+        return f"{self.NAME.upper()}_{tag}_{self.core.register_callback_token(payload)}"
+
+    def callback_payload(self, token, default=None):
+        """Payload of a button built with `callback_data` (`query.data` is the token), `default` if expired."""
+        return self.core.get_callback_token(token, default)
+
+    # Progress
+    @staticmethod
+    def progress_editor(message: telegram.Message, text: str):
+        """
+        Build a `progress_callback(done, total)` for `Network.download`/`Network.upload` that edits `message`.
+        Must be created inside the event loop, the callback can then be called from a worker thread
+        (_e.g._ `await asyncio.to_thread(self.network.download, url, path, progress_callback=callback)`).
+        `await callback.wait()` before editing `message` again: a late progress edit would overwrite the new text.
+        """
+        loop = asyncio.get_running_loop()
+        last_edit = [0.]
+        pending = []
+
+        def callback(done, total):
+            # Telegram rate-limits edits: at most one every `PROGRESS_EDIT_INTERVAL` seconds, plus the final one
+            if done != total and time.monotonic() - last_edit[0] < PROGRESS_EDIT_INTERVAL:
+                return
+
+            last_edit[0] = time.monotonic()
+            progress = humanize.naturalsize(done)
+            if total:
+                progress += " / %s (%d%%)" % (humanize.naturalsize(total), done * 100 // total)
+
+            pending[:] = [x for x in pending if not x.done()]
+            pending.append(asyncio.run_coroutine_threadsafe(message.edit_text(text + "\n" + progress), loop))
+
+        async def wait():
+            # Errors of the progress edits (_e.g._ message not modified) don't matter
+            await asyncio.gather(*(asyncio.wrap_future(x) for x in pending), return_exceptions=True)
+
+        callback.wait = wait
+        return callback
+
     # Default Handler - Used by core.py
     async def default_handler(self, update: telegram.Update, context: telegram.ext.CallbackContext):
         self.core.remove_callbacks()
@@ -73,6 +119,11 @@ class RaspOneBaseModule:
         await self.command(update, context)
         return
 
+    # Teardown - Used by core.py
+    def kill(self):
+        """Called when the module is unloaded (_e.g._ `/bot restart`): stop its tasks, close its connections."""
+        pass
+
     # Build module utils (scripts, config, ...)
     @staticmethod
     def _build_utils():
@@ -1,10 +1,23 @@
+import os
+import json
+import time
+import asyncio
+import logging
 import humanize
 import telegram
+import ipaddress
+import threading
+import concurrent.futures
 from datetime import datetime
 
+from src import config, DEFAULT_NAME, DATA_PATH
+from src.storage import write_atomic
 from modules import RaspOneBaseModule
 
 
+module_logger = logging.getLogger(DEFAULT_NAME + ".module.ip")
+
+
 class ModuleIp(RaspOneBaseModule):
 
     NAME = "ip"
@@ -12,44 +25,64 @@ class ModuleIp(RaspOneBaseModule):
 
     USAGE = {
         "get": "Get IP address\n"
-               "_More_: `/ip get ipv6`",
+               "_More_: `/ip get ipv6`, `/ip get refresh` (ask the providers again)",
         "list": "Get list of previous logged IP addresses"
     }
 
     def __init__(self, core):
         super().__init__(core)
 
-        self.api_url = "https://api.ipify.org"
-        self.api64_url = "https://api64.ipify.org"
+        ip_config = config["Module - IP"] if config.has_section("Module - IP") else dict()
+
+        # The same query is sent to every provider at once, the first valid answer wins
+        self.providers = [x.strip() for x in ip_config.get("Providers", DEFAULT_PROVIDERS).split(",")]
+        self.providers6 = [x.strip() for x in ip_config.get("Providers6", DEFAULT_PROVIDERS6).split(",")]
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=max(len(self.providers), len(self.providers6)), thread_name_prefix="IP provider")
+
+        # Last IP addresses found (ipv6: bool -> (IP, monotonic time)), served while younger than `cache_ttl`
+        self.cache = dict()
+
+        # History of the IP addresses (IP, first seen), persisted and bounded to `history_size` entries
+        self.history_path = os.path.join(DATA_PATH, "ip_history.json")
+        self.history_size = int(ip_config.get("HistorySize", "100"))
+        self.history = self._load_history()
+        self._history_lock = threading.Lock()
 
-        self.history = []
-        self.last_ip = self.prev_ip = None
+        # Monitor: polls every `poll_min` seconds, the interval doubles while the IP does not change (up to
+        # `poll_max`) and restarts from `poll_min` after a change or an error
+        self.monitor_enabled = ip_config.get("Monitor", "True") != "False"
+        self.poll_min = int(ip_config.get("PollMinutes", "5")) * 60
+        self.poll_max = max(int(ip_config.get("PollMaxMinutes", "60")) * 60, self.poll_min)
+        self.poll_interval = self.poll_min
+        self.cache_ttl = self.poll_max + self.poll_min if self.monitor_enabled else CACHE_TTL
+        self.monitor_job = None
+
+        if self.monitor_enabled:
+            self.monitor_job = self.core.application.job_queue.run_once(self.monitor, when=MONITOR_FIRST_CHECK)
 
     async def command(self, update, context):
         message = ""
         if context.args[0] == "get":
-            ipv6 = False
+            ipv6 = "ipv6" in context.args[1:]
+            refresh = "refresh" in context.args[1:]
 
-            if len(context.args) == 2 and context.args[1] == "ipv6":
-                ipv6 = True
+            ip, err = self.get_cached_ip(ipv6) if not refresh else (None, None)
+            if not ip:
+                ip, err = await asyncio.to_thread(self.get_ip_address, ipv6, True)
 
-            ip, err = self.get_ip_address(ipv6)
             if err:
                 message = "😨 " + err
 
             else:
                 message = "💻 IP: `%s`" % ip
 
-                if not len(self.history):
-                    self.history.append((ip, datetime.now()))
-
-                elif ip != self.history[-1][0]:
-                    self.history.append((ip, datetime.now()))
-
-                    message += "\nPrevious IP was `%s` (%s ago)" % (
-                        self.history[-2][0],
-                        humanize.precisedelta(self.history[-2][1] - self.history[-1][1])
-                    )
+                if not ipv6:
+                    previous = self._record_ip(ip)
+                    if previous:
+                        message += "\nPrevious IP was `%s` (%s ago)" % (
+                            previous[0], humanize.precisedelta(datetime.now() - previous[1], minimum_unit="minutes")
+                        )
 
         elif context.args[0] == "list":
             message = "IP History:\n" + \
@@ -58,10 +91,128 @@ class ModuleIp(RaspOneBaseModule):
 
         await update.effective_message.reply_text(message, parse_mode=telegram.constants.ParseMode.MARKDOWN)
 
-    def get_ip_address(self, ipv6=False):
-        curl_response, request_id = self.network.curl(self.api64_url if ipv6 else self.api_url, parse_json=False)
+    def get_ip_address(self, ipv6=False, refresh=False):
+        """Public IP address, from the cache unless expired (or `refresh`), else asking all the providers at once."""
+        if not refresh:
+            ip, err = self.get_cached_ip(ipv6)
+            if ip:
+                return ip, None
+
+        ip, err = self.race_providers(self.providers6 if ipv6 else self.providers)
+        if ip:
+            self.cache[ipv6] = (ip, time.monotonic())
+
+        return ip, err
+
+    def get_cached_ip(self, ipv6=False):
+        ip, checked = self.cache.get(ipv6, (None, 0))
+        if ip and time.monotonic() - checked < self.cache_ttl:
+            return ip, None
+
+        return None, None
+
+    def race_providers(self, providers):
+        try:
+            futures = [self._executor.submit(self._ask_provider, url) for url in providers]
+
+        except RuntimeError:  # Executor shut down: module unloaded
+            return None, "IP module unloaded"
+
+        err = None
+        try:
+            for future in concurrent.futures.as_completed(futures, timeout=PROVIDER_TIMEOUT + 1):
+                ip, err = future.result()
+                if ip:
+                    return ip, None
+
+        except concurrent.futures.TimeoutError:
+            err = "No IP provider answered in %d seconds" % PROVIDER_TIMEOUT
+
+        finally:
+            for future in futures:
+                future.cancel()  # Requests still running are left to complete in background
+
+        return None, err or "No IP provider available"
+
+    def _ask_provider(self, url):
+        curl_response, request_id = self.network.curl(url, parse_json=False, timeout=PROVIDER_TIMEOUT)
         if not curl_response:
             return None, self.network.get_error(request_id)
 
-        ip_addr = curl_response.text.replace("\n", "")
-        return ip_addr, None
+        answer = curl_response.content[:64].decode("ascii", "replace").strip()
+        try:
+            return str(ipaddress.ip_address(answer)), None
+
+        except ValueError:
+            module_logger.warning("[IP] Invalid answer from %s: %r" % (url, answer))
+            return None, "Invalid answer from %s" % url
+
+    # Monitor
+    async def monitor(self, _):
+        if not self.monitor_enabled:
+            return
+
+        ip, err = await asyncio.to_thread(self.get_ip_address, False, True)
+        if err:
+            module_logger.warning("[IP] Monitor unable to get the IP address: %s" % err)
+            self.poll_interval = self.poll_min
+
+        else:
+            previous = self._record_ip(ip)
+            if previous:
+                self.core.send_message("💻 IP changed: `%s`\nPrevious IP was `%s` (%s ago)" % (
+                    ip, previous[0], humanize.precisedelta(datetime.now() - previous[1], minimum_unit="minutes")))
+                self.poll_interval = self.poll_min
+
+            else:
+                self.poll_interval = min(self.poll_interval * 2, self.poll_max)
+
+        if self.monitor_enabled:
+            self.monitor_job = self.core.application.job_queue.run_once(self.monitor, when=self.poll_interval)
+
+    def kill(self):
+        self.monitor_enabled = False
+        if self.monitor_job:
+            self.monitor_job.schedule_removal()
+
+        # The requests still running are left to complete, their threads then exit
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    # History
+    def _record_ip(self, ip):
+        """Add `ip` to the history if it changed, return the previous `(IP, first seen)` in that case."""
+        with self._history_lock:
+            if len(self.history) and ip == self.history[-1][0]:
+                return None
+
+            self.history.append((ip, datetime.now()))
+            self.history = self.history[-self.history_size:]
+            self._save_history()
+            return self.history[-2] if len(self.history) > 1 else None
+
+    def _load_history(self):
+        try:
+            with open(self.history_path, "r") as history_file:
+                return [(ip, datetime.fromtimestamp(timestamp)) for ip, timestamp in json.load(history_file)]
+
+        except (OSError, ValueError, TypeError):
+            return []
+
+    def _save_history(self):
+        try:
+            write_atomic(self.history_path, json.dumps([(ip, int(seen.timestamp())) for ip, seen in self.history]))
+
+        except OSError:
+            module_logger.error("[IP] Unable to save the IP history", exc_info=True)
+
+
+DEFAULT_PROVIDERS = "https://api.ipify.org, https://checkip.amazonaws.com, https://icanhazip.com, " \
+                    "https://ifconfig.me/ip"
+
+DEFAULT_PROVIDERS6 = "https://api64.ipify.org, https://ipv6.icanhazip.com"
+
+PROVIDER_TIMEOUT = 5  # seconds
+
+CACHE_TTL = 60  # seconds, without the monitor
+
+MONITOR_FIRST_CHECK = 10  # seconds after startup
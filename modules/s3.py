@@ -1,12 +1,23 @@
+import os
+import json
 import uuid
-import boto3
+import asyncio
+import hashlib
 import logging
 import datetime
 import humanize
+import tempfile
 import telegram
+import threading
+import time
+import urllib.parse
+import concurrent.futures
 
-from src import config, DEFAULT_NAME
+from telegram.helpers import escape_markdown
+
+from src import config, DEFAULT_NAME, DATA_PATH
 from src.core import RaspOneException
+from src.storage import write_atomic
 from modules import RaspOneBaseModule
 
 
@@ -35,48 +46,129 @@ class ModuleS3(RaspOneBaseModule):
 
     USAGE = {
         "status": "Check if `s3` command is available",
-        "list": "List objects on S3 bucket",
+        "list": "List objects on S3 bucket\n"
+                "_More_: `/s3 list <prefix> <sort>`, sort by `date`, `name` or `size`",
         "save": "Save object on S3 bucket",
+        "get": "Get object from S3 bucket (as a link if too big for Telegram)",
+        "queue": "Show the upload queue\n"
+                 "_More_: `/s3 queue retry` (retry failed uploads), `/s3 queue clear` (drop failed uploads)",
         "delete": "Delete object from S3 bucket"
     }
 
     def __init__(self, core):
         super().__init__(core)
 
-        self.session = False
+        # boto3 is imported, and its session and client built, only when needed (one client reused by all calls)
+        self.credentials = None
+        self.session = None
+        self.client = None
+        self._client_lock = threading.Lock()
         self.session_error_message = "No AWS Session available. Please see configuration file"
 
         self.rasp_bucket_name = config["Module - AWS"]["BucketName"]
 
+        # Multipart uploads: files bigger than the threshold are uploaded in parts by a thread pool
+        self.multipart_threshold = int(config["Module - AWS"].get("MultipartThreshold", "8")) * 1024 * 1024
+        self.part_size = max(int(config["Module - AWS"].get("PartSize", "8")) * 1024 * 1024, MIN_PART_SIZE)
+        self.upload_threads = int(config["Module - AWS"].get("UploadThreads", "4"))
+
+        # Deduplication: SHA256 of the saved files -> object key (persisted), optionally used as object key
+        self.deduplicate = config["Module - AWS"].get("Deduplicate", "True") != "False"
+        self.content_addressed = config["Module - AWS"].get("ContentAddressed", "False") != "False"
+        self.digests_path = os.path.join(DATA_PATH, "s3_digests.json")
+        self.digests = self._load_digests()
+
+        # Upload queue: files are staged on disk and uploaded in background, the manifest (entry ID -> entry, with
+        # the multipart upload ID and the parts completed) is persisted to resume the uploads after a restart
+        self.queue_path = os.path.join(DATA_PATH, "s3_queue")
+        self.queue_manifest_path = os.path.join(self.queue_path, "manifest.json")
+        self.queue_concurrency = int(config["Module - AWS"].get("QueueConcurrency", "2"))
+        self.queue = dict()
+        self._queue_lock = threading.Lock()
+        self._queue_semaphore = asyncio.Semaphore(self.queue_concurrency)
+        self._queue_tasks = dict()
+        self._queue_progress = dict()
+        self._part_executors = set()
+
+        # Set by `kill`: an unloaded instance must not touch the queue of the instance replacing it
+        self.killed = False
+        self._load_queue()
+
+        # Local index of the bucket (Key -> object), updated on add/delete and refreshed periodically
+        self.objects = dict()
+        self._objects_lock = threading.Lock()  # Uploads index their objects from worker threads
+        self._objects_version = 0
+        self._objects_refreshed = None
+        self._list_view = ["LIST", "", "date", 0]
+        self._list_cache = {"version": None, "views": dict()}
+        self.index_job = None
+        self.resume_job = None
+
         if config["Module - AWS"]["AccessKeyId"] != "None" \
-                and config["Module - AWS"]["SecretAccessKey"] != "None":
-            self.session = boto3.Session(aws_access_key_id=config["Module - AWS"]["AccessKeyId"],
-                                         aws_secret_access_key=config["Module - AWS"]["SecretAccessKey"])
+                and config["Module - AWS"]["SecretAccessKey"] != "None" \
+                and self.rasp_bucket_name != "None":
+            self.credentials = {"aws_access_key_id": config["Module - AWS"]["AccessKeyId"],
+                                "aws_secret_access_key": config["Module - AWS"]["SecretAccessKey"]}
+
+            # The first run, shortly after startup, warms up the client and builds the index in background
+            self.index_job = self.core.application.job_queue.run_repeating(self.index_updater,
+                                                                           interval=INDEX_REFRESH_INTERVAL,
+                                                                           first=WARM_UP_DELAY)
+
+            if self.queue:
+                self.resume_job = self.core.application.job_queue.run_once(self.resume_queue, when=WARM_UP_DELAY)
+
+    def kill(self):
+        # The new instance resumes the queue: the uploads of this one must stop, without saving their state
+        self.killed = True
+        for task in list(self._queue_tasks.values()):
+            task.cancel()
+
+        for job in (self.index_job, self.resume_job):
+            if job:
+                job.schedule_removal()
+
+        for executor in list(self._part_executors):
+            executor.shutdown(wait=False, cancel_futures=True)
 
     async def command(self, update, context):
         markdown = telegram.constants.ParseMode.MARKDOWN
         keyboard = None
 
-        if context.args[0] == "status" or not self.session:
-            message = "`/s3` command is %s" % "available" if self.session \
+        if context.args[0] == "status" or not self.credentials:
+            message = "`/s3` command is %s" % "available" if self.credentials \
                 else "not available. Please see configuration file..."
 
-        elif context.args[0] in ["list", "delete"]:
+        elif context.args[0] in ["list", "get", "delete"]:
             objects, error = self.get_objects()
             if error:
                 message = error
                 markdown = None
 
             else:
-                message = self._list_objects(objects)
+                tag = context.args[0].upper()
+                prefix, sort = "", "date"
+                for arg in context.args[1:]:
+                    if arg.lower() in SORT_KEYS:
+                        sort = arg.lower()
 
-                if context.args[0] == "list" or not len(objects):
-                    message = "🪣 S3 Objects:\n" + message
+                    else:
+                        prefix = arg
 
-                else:
-                    message = "🪣 Which object do you want to *delete*?\n" + message
-                    self.register_query_callback("DELETE", self.query_handler_delete)
-                    keyboard = self._prepare_keyboard("DELETE", objects)
+                self._list_view = [tag, prefix, sort, 0]
+                message, keyboard = self._render_list()
+                self.register_query_callback(tag, {"LIST": self.query_handler_list,
+                                                   "GET": self.query_handler_get,
+                                                   "DELETE": self.query_handler_delete}[tag])
+
+        elif context.args[0] == "queue":
+            if len(context.args) > 1 and context.args[1].lower() == "retry":
+                self.retry_queue()
+
+            elif len(context.args) > 1 and context.args[1].lower() == "clear":
+                await asyncio.to_thread(self.clear_queue)
+
+            message = self._render_queue()
 
         else:
             message = "🪣 Do you want to add an object?\nWaiting a file..."
@@ -84,99 +176,698 @@ class ModuleS3(RaspOneBaseModule):
 
         await update.effective_message.reply_text(message, reply_markup=keyboard, parse_mode=markdown)
 
-    async def query_handler_delete(self, update, _):
+    async def query_handler_list(self, update, _):
+        await self._flip_page(update.callback_query)
+
+    async def query_handler_get(self, update, _):
         query = update.callback_query
-        objects, error = self.get_objects()
-        if error:
-            message = error
+        if query.data.startswith("P_"):
+            await self._flip_page(query)
+            return
+
+        self.remove_callback("GET")
+        obj = self.objects.get(self.callback_payload(query.data), None)
+        if not obj:
+            await query.edit_message_text(text="Object not found")
+            return
+
+        # Objects Telegram cannot receive from a bot are shared with a temporary link
+        if obj["Size"] > telegram.constants.FileSizeLimit.FILESIZE_UPLOAD:
+            object_url, error = await asyncio.to_thread(self.get_presigned_url, obj["Key"])
+            message = str(error) if error else \
+                f"🪣 [{obj['Key']}]({object_url})\n" \
+                f"_Too big to be sent here ({humanize.naturalsize(obj['Size'])}), " \
+                f"the link expires in {humanize.naturaldelta(PRESIGNED_URL_EXPIRATION)}_"
+            await query.edit_message_text(text=message, parse_mode=None if error
+                                          else telegram.constants.ParseMode.MARKDOWN)
+            return
+
+        await query.edit_message_text(text="🪣 Downloading...")
+        file_descriptor, file_path = tempfile.mkstemp()
+        os.close(file_descriptor)
+        editor = self.progress_editor(query.message, "🪣 Downloading...")
+        try:
+            size, error = await asyncio.to_thread(self.download_object, obj["Key"], file_path, editor)
+            await editor.wait()
+            if not error:
+                with open(file_path, "rb") as file:
+                    await query.message.reply_document(document=file, filename=os.path.basename(obj["Key"]))
 
-        else:
-            try:
-                obj = next(filter(lambda o: o["Key"] == query.data, objects))
-                status, error = self.delete_object(obj["Key"])
-                if error:
-                    message = error
+        except (telegram.error.TelegramError, OSError) as send_error:
+            error = send_error
+
+        finally:
+            os.remove(file_path)
 
-                else:
-                    message = "👍"
+        await query.edit_message_text(text=str(error) if error else "👍")
+
+    async def query_handler_delete(self, update, _):
+        query = update.callback_query
+        if query.data.startswith("P_"):
+            await self._flip_page(query)
+            return
 
-            except StopIteration:
-                message = "Object not found (Key %s)" % query.data
+        # Buttons carry a token of the object key
+        obj = self.objects.get(self.callback_payload(query.data), None)
+        if not obj:
+            message = "Object not found"
+
+        else:
+            status, error = self.delete_object(obj["Key"])
+            message = str(error) if error else "👍"
 
         await query.edit_message_text(text=message)
         self.remove_callback("DELETE")
 
+    async def _flip_page(self, query):
+        if not query.data[2:].isdigit():
+            return
+
+        self._list_view[3] = int(query.data[2:])
+        message, keyboard = self._render_list()
+        await query.edit_message_text(text=message, reply_markup=keyboard,
+                                      parse_mode=telegram.constants.ParseMode.MARKDOWN)
+
     async def message_handler_add(self, update, _):
         markdown = None
         message = "Error: expecting a file!"
 
         if update.effective_message.document:
-            file_key = uuid.uuid4().urn[9:] + "/" + update.effective_message.document.file_name
-            file_attached = await update.effective_message.document.get_file()
-            file_bytearray = await file_attached.download_as_bytearray()
-            object_url, error = self.add_object(file_key, file_bytearray, update.effective_message.document.mime_type)
+            document = update.effective_message.document
+            progress_message = await update.effective_message.reply_text("🪣 Uploading...")
+
+            # The file is hashed while written to the queue dir, then uploaded from there in background
+            entry_id = uuid.uuid4().hex
+            file_path = os.path.join(self.queue_path, entry_id)
+            try:
+                file_attached = await document.get_file()
+                with open(file_path, "wb") as file:
+                    writer = HashingWriter(file)
+                    await file_attached.download_to_memory(writer)
+
+                queued, error = await asyncio.to_thread(self.enqueue_file, entry_id, document.file_name,
+                                                        document.mime_type, writer.hexdigest())
+
+            except (telegram.error.TelegramError, OSError) as download_error:
+                queued, error = False, download_error
+
+            if error or queued[2]:
+                if os.path.exists(file_path):
+                    os.remove(file_path)
+
             if error:
                 message = str(error)
 
-            else:
-                message = "Object added 👍\n" \
+            elif queued[2]:
+                file_key, object_url, _ = queued
+                message = "Object already saved, not uploaded again 👍\n" \
                           f"• [{file_key}]({object_url})"
                 markdown = telegram.constants.ParseMode.MARKDOWN
 
+            else:
+                self._start_upload(entry_id, progress_message)
+                self.remove_callback("ADD")
+                return
+
+            await progress_message.edit_text(message, parse_mode=markdown)
+            self.remove_callback("ADD")
+            return
+
         await update.effective_message.reply_text(message, parse_mode=markdown)
         self.remove_callback("ADD")
 
     # API
     def _check_session(self):
-        if not self.session:
+        if not self.credentials:
             raise RaspOneException(self.session_error_message)
 
+    def get_client(self):
+        """The S3 client, built on first use with a connection pool sized for the upload threads."""
+        self._check_session()
+        if self.client is None:
+            with self._client_lock:
+                if self.client is None:
+                    import boto3
+                    import botocore.config
+
+                    self.session = boto3.Session(**self.credentials)
+                    self.client = self.session.client("s3", config=botocore.config.Config(
+                        max_pool_connections=max(10, self.upload_threads * 2),
+                        retries={"max_attempts": 5, "mode": "adaptive"},
+                        connect_timeout=10,
+                        read_timeout=60
+                    ))
+
+        return self.client
+
     def get_objects(self):
+        """Objects of the bucket, served from the local index (built on first use)."""
+        if self._objects_refreshed is None:
+            status, error = self.refresh_index()
+            if error:
+                return None, error
+
+        with self._objects_lock:
+            return list(self.objects.values()), None
+
+    def refresh_index(self):
+        """Rebuild the local index listing the whole bucket (`list_objects_v2` pages of 1000 keys)."""
         try:
-            self._check_session()
-            client = self.session.client("s3")
+            client = self.get_client()
 
-            return client.list_objects(Bucket=self.rasp_bucket_name).get("Contents", []), None
+            objects = dict()
+            for page in client.get_paginator("list_objects_v2").paginate(Bucket=self.rasp_bucket_name):
+                for obj in page.get("Contents", []):
+                    objects[obj["Key"]] = {k: obj[k] for k in ("Key", "LastModified", "Size")}
+
+            with self._objects_lock:
+                self.objects = objects
+                self._objects_version += 1
+
+            self._objects_refreshed = datetime.datetime.now()
+            return True, None
 
         except (RaspOneException, Exception) as error:
-            return None, error
+            return False, error
+
+    async def index_updater(self, _):
+        status, error = await asyncio.to_thread(self.refresh_index)
+        if error:
+            module_logger.warning("[S3] Unable to refresh the objects index: %s" % error)
+
+    def _index_object(self, object_key, object_size):
+        with self._objects_lock:
+            self.objects[object_key] = {"Key": object_key, "Size": object_size,
+                                        "LastModified": datetime.datetime.now(datetime.timezone.utc)}
+            self._objects_version += 1
 
     def delete_object(self, object_key):
         try:
-            self._check_session()
-            client = self.session.client("s3")
+            client = self.get_client()
             response = client.delete_object(Bucket=self.rasp_bucket_name, Key=object_key)
+
+            with self._objects_lock:
+                if self.objects.pop(object_key, None):
+                    self._objects_version += 1
+
+            stale_digests = [digest for digest, key in self.digests.items() if key == object_key]
+            if stale_digests:
+                for digest in stale_digests:
+                    self.digests.pop(digest)
+
+                self._save_digests()
+
             return True, None
 
         except (RaspOneException, Exception) as error:
             return False, error
 
-    def upload_file(self, object_key: str, file_path: str, object_mime=False):
+    def download_object(self, object_key, file_path, progress_callback=None):
+        """
+        Download an object to a local file with ranged reads of `DOWNLOAD_RANGE_SIZE`, each one streamed to disk
+        in `STREAM_CHUNK_SIZE` chunks: memory stays flat whatever the object size. Return the object size.
+        """
         try:
-            self._check_session()
-            client = self.session.client("s3")
+            client = self.get_client()
 
-            with open(file_path, "rb") as file:
-                object_data = file.read()
-                response = client.put_object(Bucket=self.rasp_bucket_name, Key=object_key, Body=object_data,
-                                             **({'ContentType': object_mime} if object_mime else {}))
-                return f"https://{self.rasp_bucket_name}.s3.amazonaws.com/{object_key}", None
+            downloaded, object_size, etag = 0, None, None
+            with open(file_path, "wb") as file:
+                while object_size is None or downloaded < object_size:
+                    # `IfMatch` makes sure all the ranges are read from the same version of the object
+                    try:
+                        response = client.get_object(Bucket=self.rasp_bucket_name, Key=object_key,
+                                                     Range="bytes=%d-%d" % (downloaded,
+                                                                            downloaded + DOWNLOAD_RANGE_SIZE - 1),
+                                                     **({"IfMatch": etag} if etag else {}))
+
+                    except client.exceptions.ClientError as error:
+                        if object_size is None and error.response["Error"]["Code"] == "InvalidRange":
+                            return 0, None  # Empty object, no range can be read
+
+                        raise
+                    etag = response["ETag"]
+                    object_size = int(response["ContentRange"].split("/")[-1]) if "ContentRange" in response \
+                        else response["ContentLength"]
+
+                    for chunk in response["Body"].iter_chunks(STREAM_CHUNK_SIZE):
+                        file.write(chunk)
+                        downloaded += len(chunk)
+
+                    if progress_callback:
+                        progress_callback(downloaded, object_size)
+
+                    if not response["ContentLength"]:
+                        break
+
+            return object_size, None
 
         except Exception as error:
             return False, error
 
-    def add_object(self, object_key: str, object_data: bytearray, object_mime=False):
+    def get_presigned_url(self, object_key):
+        try:
+            client = self.get_client()
+            return client.generate_presigned_url("get_object",
+                                                 Params={"Bucket": self.rasp_bucket_name, "Key": object_key},
+                                                 ExpiresIn=PRESIGNED_URL_EXPIRATION), None
+
+        except Exception as error:
+            return False, error
+
+    def prepare_key(self, file_name, file_path, digest=None):
+        """
+        Key and metadata of a new object for a local file, or the key of the object already saved with the same
+        content. Return `(object_key, metadata, duplicate)`.
+        `digest`: SHA256 of the file if already known (computed while it was written), else the file is read.
+        """
+        if self.deduplicate or self.content_addressed:
+            try:
+                digest = digest or self.file_digest(file_path)
+
+            except OSError as error:
+                return False, error
+
+            _, error = self.get_objects()
+            if error:
+                return False, error
+
+            if self.digests.get(digest, None) in self.objects:
+                return (self.digests[digest], None, True), None
+
+        if self.content_addressed:
+            object_key = digest + os.path.splitext(file_name)[1]
+
+        else:
+            object_key = uuid.uuid4().urn[9:] + "/" + file_name
+
+        metadata = {"filename": urllib.parse.quote(file_name), "sha256": digest} if digest else None
+        return (object_key, metadata, False), None
+
+    def save_file(self, file_name, file_path, object_mime=False, progress_callback=None):
+        """
+        Save a local file on the bucket, unless the same content was already saved.
+        Return `(object_key, object_url, duplicate)`.
+        """
+        prepared, error = self.prepare_key(file_name, file_path)
+        if error:
+            return False, error
+
+        object_key, metadata, duplicate = prepared
+        if duplicate:
+            return (object_key, f"https://{self.rasp_bucket_name}.s3.amazonaws.com/{object_key}", True), None
+
+        object_url, error = self.upload_file(object_key, file_path, object_mime, progress_callback, metadata)
+        if error:
+            return False, error
+
+        self._save_digest(metadata, object_key)
+        return (object_key, object_url, False), None
+
+    def _save_digest(self, metadata, object_key):
+        if metadata and metadata.get("sha256", None):
+            self.digests[metadata["sha256"]] = object_key
+            self._save_digests()
+
+    # Upload queue
+    def enqueue_file(self, entry_id, file_name, object_mime=False, digest=None):
+        """
+        Add the file staged in the queue dir as `entry_id` to the upload queue, unless the same content was
+        already saved. Return `(object_key, object_url, duplicate)`, the URL is known once uploaded.
+        """
+        if self.killed:
+            return False, "S3 module restarted, please send the file again"
+
+        file_path = os.path.join(self.queue_path, entry_id)
+        prepared, error = self.prepare_key(file_name, file_path, digest)
+        if error:
+            return False, error
+
+        object_key, metadata, duplicate = prepared
+        if duplicate:
+            return (object_key, f"https://{self.rasp_bucket_name}.s3.amazonaws.com/{object_key}", True), None
+
+        with self._queue_lock:
+            self.queue[entry_id] = {"name": file_name, "key": object_key, "mime": object_mime or None,
+                                    "metadata": metadata, "size": os.path.getsize(file_path),
+                                    "added": datetime.datetime.now().isoformat(timespec="seconds"),
+                                    "status": "queued", "error": None,
+                                    "upload_id": None, "part_size": None, "parts": dict()}
+
+        self._save_queue()
+        return (object_key, None, False), None
+
+    def _start_upload(self, entry_id, progress_message=None):
+        if entry_id not in self._queue_tasks and not self.killed:
+            self._queue_tasks[entry_id] = self.core.application.create_task(
+                self._run_upload(entry_id, progress_message))
+
+    async def _run_upload(self, entry_id, progress_message=None):
+        try:
+            # At most `queue_concurrency` uploads at a time, each one in parts by `upload_threads` threads
+            async with self._queue_semaphore:
+                entry = self.queue.get(entry_id, None)
+                if not entry:
+                    return
+
+                self._set_entry(entry, status="uploading", error=None)
+                editor = self.progress_editor(progress_message, "🪣 Uploading...") if progress_message else None
+
+                def progress_callback(done, total):
+                    self._queue_progress[entry_id] = done
+                    if editor:
+                        editor(done, total)
+
+                object_url, error = await asyncio.to_thread(
+                    self.upload_file, entry["key"], os.path.join(self.queue_path, entry_id), entry["mime"],
+                    progress_callback, entry["metadata"], entry
+                )
+
+            if error:
+                module_logger.warning("[S3] Queued upload of %s failed: %s" % (entry["name"], error))
+                self._set_entry(entry, status="failed", error=str(error))
+                message = f"🪣 Upload of `{entry['name']}` failed, see `/s3 queue`\n" + escape_markdown(str(error))
+
+            else:
+                self._save_digest(entry["metadata"], entry["key"])
+                self._remove_entry(entry_id)
+                message = "Object added 👍\n" \
+                          f"• [{entry['key']}]({object_url})"
+
+            if progress_message:
+                await editor.wait()
+                await progress_message.edit_text(message, parse_mode=telegram.constants.ParseMode.MARKDOWN)
+
+            else:
+                self.core.send_message(message, markdown=True)
+
+        finally:
+            self._queue_tasks.pop(entry_id, None)
+            self._queue_progress.pop(entry_id, None)
+
+    async def resume_queue(self, _):
+        """Resume the uploads queued before the last shutdown."""
+        module_logger.info("[S3] Resuming %d queued uploads" % len(self.queue))
+        for entry_id in list(self.queue):
+            self._start_upload(entry_id)
+
+    def retry_queue(self):
+        for entry_id, entry in list(self.queue.items()):
+            if entry["status"] == "failed":
+                self._start_upload(entry_id)
+
+    def clear_queue(self):
+        """Drop the failed uploads, aborting their multipart uploads."""
+        for entry_id, entry in list(self.queue.items()):
+            if entry["status"] != "failed" or entry_id in self._queue_tasks:
+                continue
+
+            if entry["upload_id"]:
+                try:
+                    self.get_client().abort_multipart_upload(Bucket=self.rasp_bucket_name, Key=entry["key"],
+                                                             UploadId=entry["upload_id"])
+
+                except Exception as error:
+                    module_logger.warning("[S3] Unable to abort the upload of %s: %s" % (entry["name"], error))
+
+            self._remove_entry(entry_id)
+
+    def _set_entry(self, entry, **values):
+        with self._queue_lock:
+            entry.update(values)
+
+        self._save_queue()
+
+    def _remove_entry(self, entry_id):
+        if self.killed:
+            return
+
+        with self._queue_lock:
+            self.queue.pop(entry_id, None)
+
+        file_path = os.path.join(self.queue_path, entry_id)
+        if os.path.exists(file_path):
+            os.remove(file_path)
+
+        self._save_queue()
+
+    def _load_queue(self):
+        if not os.path.isdir(self.queue_path):
+            os.mkdir(self.queue_path)
+
+        try:
+            with open(self.queue_manifest_path, "r") as manifest_file:
+                queue = json.load(manifest_file)
+
+        except (OSError, ValueError):
+            queue = dict()
+
+        # Entries whose staged file is lost cannot be resumed; staged files without an entry (a download
+        # interrupted before being queued) are removed, unless recent: it may be an add still in progress
+        self.queue = {entry_id: entry for entry_id, entry in queue.items()
+                      if os.path.exists(os.path.join(self.queue_path, entry_id))}
+
+        for file_name in os.listdir(self.queue_path):
+            file_path = os.path.join(self.queue_path, file_name)
+            if file_name not in self.queue and not file_name.startswith("manifest.json"):
+                try:
+                    if time.time() - os.path.getmtime(file_path) > STAGED_FILE_GRACE:
+                        os.remove(file_path)
+
+                except OSError:
+                    pass
+
+    def _save_queue(self):
+        if self.killed:
+            return
+
         try:
-            self._check_session()
-            client = self.session.client("s3")
-            response = client.put_object(Bucket=self.rasp_bucket_name, Key=object_key, Body=object_data,
-                                         **({'ContentType': object_mime} if object_mime else {}))
+            with self._queue_lock:
+                manifest = json.dumps(self.queue)
+
+            write_atomic(self.queue_manifest_path, manifest)
+
+        except OSError:
+            module_logger.error("[S3] Unable to save the upload queue", exc_info=True)
+
+    def upload_file(self, object_key: str, file_path: str, object_mime=False, progress_callback=None, metadata=None,
+                    state=None):
+        """
+        Upload a local file without reading it whole in memory: small files are streamed with `put_object`,
+        files bigger than `multipart_threshold` are uploaded in `part_size` parts by `upload_threads` threads.
+        `progress_callback(uploaded_bytes, total_bytes)` is called as the parts complete.
+        With `state` (a queue entry) the multipart upload ID and the parts completed are kept there, so an
+        interrupted upload is resumed and not aborted.
+        """
+        try:
+            client = self.get_client()
+
+            extra_args = {}
+            if object_mime:
+                extra_args["ContentType"] = object_mime
+
+            if metadata:
+                extra_args["Metadata"] = metadata
+
+            file_size = os.path.getsize(file_path)
+            if file_size >= self.multipart_threshold:
+                self._multipart_upload(client, object_key, file_path, file_size, extra_args, progress_callback, state)
+
+            else:
+                with open(file_path, "rb") as file:
+                    response = client.put_object(Bucket=self.rasp_bucket_name, Key=object_key, Body=file,
+                                                 **extra_args)
+
+                if progress_callback:
+                    progress_callback(file_size, file_size)
+
+            self._index_object(object_key, file_size)
             return f"https://{self.rasp_bucket_name}.s3.amazonaws.com/{object_key}", None
 
         except Exception as error:
             return False, error
 
+    def _multipart_upload(self, client, object_key, file_path, file_size, extra_args=None, progress_callback=None,
+                          state=None):
+        resumable = state is not None
+        state = state if resumable else {"upload_id": None, "part_size": None, "parts": dict()}
+
+        completed = dict()
+        if state["upload_id"]:
+            # Resume: the parts already on S3 are not uploaded again (JSON keys of the manifest are strings)
+            try:
+                for page in client.get_paginator("list_parts").paginate(Bucket=self.rasp_bucket_name,
+                                                                         Key=object_key, UploadId=state["upload_id"]):
+                    for part in page.get("Parts", []):
+                        completed[part["PartNumber"]] = part["ETag"]
+
+            except client.exceptions.NoSuchUpload:
+                module_logger.info("[S3] Multipart upload of %s expired, restarting it" % object_key)
+                state["upload_id"] = None
+
+        if not state["upload_id"]:
+            completed = dict()
+            self._update_state(state, resumable, upload_id=client.create_multipart_upload(
+                Bucket=self.rasp_bucket_name, Key=object_key, **(extra_args or {}))["UploadId"],
+                part_size=self.part_size, parts=dict())
+
+        upload_id, part_size = state["upload_id"], state["part_size"]
+        parts_count = -(-file_size // part_size)
+
+        uploaded = [sum(min(part_size, file_size - (n - 1) * part_size) for n in completed)]
+        uploaded_lock = threading.Lock()
+
+        def upload_part(part_number):
+            if self.killed:
+                raise RaspOneException("S3 module unloaded")
+
+            if part_number in completed:
+                return {"PartNumber": part_number, "ETag": completed[part_number]}
+
+            # Each part is read only when its upload starts: memory is bounded to `upload_threads` parts
+            with open(file_path, "rb") as file:
+                file.seek((part_number - 1) * part_size)
+                part_data = file.read(part_size)
+
+            response = client.upload_part(Bucket=self.rasp_bucket_name, Key=object_key, UploadId=upload_id,
+                                          PartNumber=part_number, Body=part_data)
+
+            with uploaded_lock:
+                uploaded[0] += len(part_data)
+                if progress_callback:
+                    progress_callback(uploaded[0], file_size)
+
+            if resumable:
+                with self._queue_lock:
+                    state["parts"][str(part_number)] = response["ETag"]
+
+                self._save_queue()
+
+            return {"PartNumber": part_number, "ETag": response["ETag"]}
+
+        try:
+            executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.upload_threads)
+            self._part_executors.add(executor)
+            try:
+                parts = list(executor.map(upload_part, range(1, parts_count + 1)))
+
+            finally:
+                executor.shutdown(cancel_futures=True)  # After an error, parts not started are not uploaded
+                self._part_executors.discard(executor)
+
+            client.complete_multipart_upload(Bucket=self.rasp_bucket_name, Key=object_key, UploadId=upload_id,
+                                             MultipartUpload={"Parts": parts})
+
+        except Exception:
+            if resumable:  # Kept to be resumed (or aborted clearing the queue)
+                module_logger.error("[S3] Multipart upload error", exc_info=True)
+                raise
+
+            module_logger.error("[S3] Multipart upload error, aborting", exc_info=True)
+            client.abort_multipart_upload(Bucket=self.rasp_bucket_name, Key=object_key, UploadId=upload_id)
+            raise
+
+    def _update_state(self, state, resumable, **values):
+        if not resumable:
+            state.update(values)
+            return
+
+        with self._queue_lock:
+            state.update(values)
+
+        self._save_queue()
+
     # Utils
+    @staticmethod
+    def file_digest(file_path):
+        hasher = hashlib.sha256()
+        with open(file_path, "rb") as file:
+            for chunk in iter(lambda: file.read(HASH_CHUNK_SIZE), b""):
+                hasher.update(chunk)
+
+        return hasher.hexdigest()
+
+    def _load_digests(self):
+        try:
+            with open(self.digests_path, "r") as digests_file:
+                return json.load(digests_file)
+
+        except (OSError, ValueError):
+            return dict()
+
+    def _save_digests(self):
+        try:
+            write_atomic(self.digests_path, json.dumps(self.digests))
+
+        except OSError:
+            module_logger.error("[S3] Unable to save the digests index", exc_info=True)
+
+    def _render_queue(self):
+        message = "🪣 Upload queue:\n"
+        if not self.queue:
+            return message + "_Empty_"
+
+        for entry_id, entry in self.queue.items():
+            if entry["status"] == "uploading":
+                done = self._queue_progress.get(entry_id, 0)
+                status = "uploading %s / %s" % (humanize.naturalsize(done), humanize.naturalsize(entry["size"]))
+
+            elif entry["status"] == "failed":
+                message += f"• `{entry['name']}` (_failed_): {escape_markdown(entry['error'] or '')}\n"
+                continue
+
+            else:
+                status = "queued, %s" % humanize.naturalsize(entry["size"])
+
+            message += f"• `{entry['name']}` (_{status}_)\n"
+
+        return message
+
+    def _get_view(self):
+        """Keys of the current list view (prefix and sort), cached until the index changes."""
+        _, prefix, sort, _ = self._list_view
+        with self._objects_lock:
+            version = self._objects_version
+            if self._list_cache["version"] != version or (prefix, sort) not in self._list_cache["views"]:
+                matching = [o for k, o in self.objects.items() if k.startswith(prefix)]
+
+            else:
+                matching = None
+
+        if self._list_cache["version"] != version:
+            self._list_cache = {"version": version, "views": dict()}
+
+        if matching is not None:
+            sort_key, reverse = SORT_KEYS[sort]
+            self._list_cache["views"][(prefix, sort)] = [
+                obj["Key"] for obj in sorted(matching, key=sort_key, reverse=reverse)
+            ]
+
+        return self._list_cache["views"][(prefix, sort)]
+
+    def _render_list(self):
+        tag, prefix, sort, page = self._list_view
+        view = self._get_view()
+
+        pages_count = max(1, -(-len(view) // LIST_PAGE_SIZE))
+        page = self._list_view[3] = min(max(page, 0), pages_count - 1)
+        with self._objects_lock:  # Objects deleted since the view was built are skipped
+            page_objects = [self.objects[k] for k in view[page * LIST_PAGE_SIZE:(page + 1) * LIST_PAGE_SIZE]
+                            if k in self.objects]
+
+        message = ("🪣 S3 Objects%s:\n" if tag == "LIST" or not len(view)
+                   else "🪣 Which object%s do you want to *" + tag.lower() + "*?\n") % \
+            (f" (`{prefix}`)" if prefix else "")
+        if pages_count > 1:
+            message += "_Page %d/%d - %d objects_\n" % (page + 1, pages_count, len(view))
+
+        message += self._list_objects(page_objects)
+
+        keyboard = None
+        if tag != "LIST" and len(view) or pages_count > 1:
+            keyboard = self._prepare_keyboard(tag, page_objects, page, pages_count)
+
+        return message, keyboard
+
     def _list_objects(self, objects):
         if not len(objects):
             objects_list_msg = "_Empty_"
@@ -187,17 +878,69 @@ class ModuleS3(RaspOneBaseModule):
                 f"(_Last modified: "
                 f"{humanize.naturaltime(datetime.datetime.now(obj['LastModified'].tzinfo) - obj['LastModified'])}, "
                 f"Size: {humanize.naturalsize(obj['Size'])}_)"
-                for obj in sorted(objects, key=lambda o: o['LastModified'], reverse=True)
+                for obj in objects
             )
 
         return objects_list_msg
 
-    @staticmethod
-    def _prepare_keyboard(tag, objects):
-        objects_list = []
-        for obj in objects:
-            objects_list.append(telegram.InlineKeyboardButton(str(obj["Key"]), callback_data=f"S3_{tag}_{obj['Key']}"))
-
-        return telegram.InlineKeyboardMarkup(
-            [objects_list[i * 2:(i + 1) * 2] for i in range((len(objects_list) + 2 - 1) // 2)]
-        )
+    def _prepare_keyboard(self, tag, objects, page=0, pages_count=1):
+        keyboard = []
+        if tag != "LIST":
+            objects_list = []
+            for obj in objects:
+                objects_list.append(telegram.InlineKeyboardButton(str(obj["Key"]),
+                                                                  callback_data=self.callback_data(tag, obj["Key"])))
+
+            keyboard = [objects_list[i * 2:(i + 1) * 2] for i in range((len(objects_list) + 2 - 1) // 2)]
+
+        if pages_count > 1:
+            navigation = []
+            if page > 0:
+                navigation.append(telegram.InlineKeyboardButton("◀️ Prev", callback_data=f"S3_{tag}_P_{page - 1}"))
+
+            if page < pages_count - 1:
+                navigation.append(telegram.InlineKeyboardButton("Next ▶️", callback_data=f"S3_{tag}_P_{page + 1}"))
+
+            keyboard.append(navigation)
+
+        return telegram.InlineKeyboardMarkup(keyboard)
+
+
+class HashingWriter:
+    """Binary file wrapper computing the SHA256 of what is written, to avoid reading the file again."""
+
+    def __init__(self, file):
+        self.file = file
+        self.hasher = hashlib.sha256()
+
+    def write(self, data):
+        self.hasher.update(data)
+        return self.file.write(data)
+
+    def hexdigest(self):
+        return self.hasher.hexdigest()
+
+
+LIST_PAGE_SIZE = 10
+
+INDEX_REFRESH_INTERVAL = 30 * 60  # seconds
+
+WARM_UP_DELAY = 30  # seconds after startup
+
+STAGED_FILE_GRACE = 60 * 60  # seconds, staged files without a queue entry younger than this are kept
+
+SORT_KEYS = {  # name: (key, reverse)
+    "date": (lambda o: o["LastModified"], True),
+    "name": (lambda o: o["Key"].lower(), False),
+    "size": (lambda o: o["Size"], True)
+}
+
+HASH_CHUNK_SIZE = 1024 * 1024
+
+DOWNLOAD_RANGE_SIZE = 8 * 1024 * 1024  # bytes read by each `get_object`
+
+STREAM_CHUNK_SIZE = 64 * 1024
+
+PRESIGNED_URL_EXPIRATION = 24 * 60 * 60  # seconds
+
+MIN_PART_SIZE = 5 * 1024 * 1024  # S3 minimum size of a part (but the last one)
@@ -1,9 +1,28 @@
 import os
+import re
+import glob
+import time
+import errno
+import base64
+import ctypes
+import socket
+import struct
+import hashlib
+import asyncio
 import logging
+import humanize
 import telegram
+import threading
+import cachetools
+import ctypes.util
+import collections
+from datetime import datetime
+
+from telegram.helpers import escape_markdown
 
 from modules import RaspOneBaseModule
 from src import config, DEFAULT_NAME, UTILS_PATH
+from src.geoip import get_geoip
 
 module_logger = logging.getLogger(DEFAULT_NAME + ".module.ssh")
 
@@ -16,7 +35,9 @@ class ModuleSSH(RaspOneBaseModule):
     USAGE = {
         "status": "Check if `sshd` is running",
         "port": "Show listening port",
-        "fingerprint": "return ECDSA and ED25519 keys fingerprints for verification"
+        "fingerprint": "Return the SHA256 and MD5 fingerprints of the host keys for verification\n"
+                       "_More_: `/ssh fingerprint sshfp` (SSHFP DNS records of the host keys)",
+        "attempts": "Show the failed login attempts (log ingestion)"
     }
 
     def __init__(self, core):
@@ -24,12 +45,109 @@ class ModuleSSH(RaspOneBaseModule):
 
         self.ssh_port = config["Module - SSH"]["SSHPort"]
 
-    def alert(self, message):
+        # Log ingestion: sshd events are read from the auth log (tailed, following the rotations) or from the journal,
+        # failed attempts are aggregated per source IP: a burst is alerted when it starts, the alert is edited when
+        # it ends
+        self.log_source = config["Module - SSH"].get("LogSource", "None")
+        self.bruteforce = BruteForceAggregator(int(config["Module - SSH"].get("BruteForceWindow", "10")) * 60,
+                                               int(config["Module - SSH"].get("BruteForceThreshold", "5")))
+        self.tailer = None
+        self._inotify = None
+        self._inotify_loop = None
+        self._journal_process = None
+        self._ingestion_tasks = set()
+        self._ingestion_jobs = []
+        self._burst_alerts = dict()  # IP -> alert of the ongoing burst {"message_id", "ended"}
+
+        # Open sessions (key -> sessions, oldest first), their alert is edited when they are closed. Keys are
+        # (user, remote host, TTY) for the PAM hook alerts and the sshd PID for the log ingestion
+        self.sessions = cachetools.TTLCache(maxsize=SESSIONS_SIZE, ttl=SESSION_TTL)
+        self._sessions_lock = threading.Lock()
+
+        # Offline location of the remote hosts (see `[GeoIP]`)
+        self.geoip = get_geoip()
+
+        # Host keys (path -> (mtime, key)), parsed again only when the file changes
+        self.host_keys = dict()
+
+        if self.log_source != "None":
+            self.core.application.job_queue.run_once(self.start_ingestion, when=1)
+
+    def alert(self, message, session=None, ip=None):
+        """
+        `session`: key of the session opened by this alert, the alert is edited when `close_session` is called.
+        The `open_session`/`close_session` alerts of the PAM hook are paired by user, remote host and TTY.
+        `ip` (the remote host for the PAM hook alerts) is located: denied locations are highlighted, allowed ones
+        are sent without notification.
+        """
         if not message or not len(message):
             return False
 
         module_logger.info("SSH Alert: %s" % message.encode("unicode_escape").decode("utf-8"))
-        return self.core.send_message("🚨 SSH Alert 🚨:\n%s" % message)
+
+        if session is None:
+            pam_event = parse_pam_alert(message)
+            if pam_event:
+                ip = ip or pam_event["rhost"]
+                key = ("pam", pam_event["user"], pam_event["rhost"], pam_event["tty"])
+                if pam_event["type"] == "close_session" and self.close_session(key):
+                    return True
+
+                elif pam_event["type"] == "open_session":
+                    session = key
+
+        message, severity = self._alert_text(message, ip)
+        if session is None:
+            return self.core.send_message(message, silent=severity == "allow")
+
+        opened = {"text": message, "opened": datetime.now(), "closed": None, "message_id": None}
+        with self._sessions_lock:
+            self.sessions[session] = self.sessions.get(session, []) + [opened]
+
+        return self.core.send_message(message, on_sent=lambda sent: self._session_sent(opened, sent),
+                                      silent=severity == "allow")
+
+    def _alert_text(self, message, ip):
+        location, severity = self.geoip.annotate(ip)
+        message = "🚨 SSH Alert 🚨%s:\n%s" % (" ⛔️ *Denied location*" if severity == "deny" else "", message)
+        if location:
+            message += "\n🌍 " + escape_markdown(location)
+
+        return message, severity
+
+    def close_session(self, key):
+        """Edit the alert of the oldest open session `key` adding its end, False if not found (or expired)."""
+        with self._sessions_lock:
+            sessions = self.sessions.get(key, None)
+            if not sessions:
+                return False
+
+            session = sessions.pop(0)
+            if sessions:
+                self.sessions[key] = sessions
+
+            else:
+                del self.sessions[key]
+
+            session["closed"] = datetime.now()
+            if session["message_id"] is None:
+                return True  # Edited as soon as sent
+
+        self.core.edit_message(session["message_id"], self._closed_text(session))
+        return True
+
+    def _session_sent(self, session, sent_message):
+        with self._sessions_lock:
+            session["message_id"] = sent_message.message_id
+            if session["closed"] is None:
+                return
+
+        self.core.edit_message(session["message_id"], self._closed_text(session))
+
+    @staticmethod
+    def _closed_text(session):
+        return session["text"] + "\n🔚 Closed at %s (duration: %s)" % (
+            session["closed"].strftime("%H:%M:%S"), humanize.precisedelta(session["closed"] - session["opened"]))
 
     async def command(self, update, context):
         message = ""
@@ -59,24 +177,198 @@ class ModuleSSH(RaspOneBaseModule):
                     message = "🚪 " + ssh_port
 
         elif context.args[0] == "fingerprint":
-            ecdsa_fingerprint, error = self.get_ssh_fingerprint()
+            host_keys, error = self.get_host_keys()
             if error:
                 message = error
                 markdown = None
 
+            elif "sshfp" in context.args[1:]:
+                hostname = socket.getfqdn()
+                message = "SSHFP records:\n```\n%s\n```" % "\n".join(
+                    "%s. IN SSHFP %d %d %s" % (hostname, algorithm, fingerprint_type, fingerprint)
+                    for key in host_keys for algorithm, fingerprint_type, fingerprint in key["sshfp"])
+
             else:
-                message = "ECDSA: `%s`" % ecdsa_fingerprint
+                message = "\n".join("🔑 %s (%s bits)\n`%s`\n`%s`" % (key["type"], key["bits"] or "?", key["sha256"],
+                                                                     key["md5"]) for key in host_keys)
 
-            ed25519_fingerprint, error = self.get_ssh_fingerprint(ed25519=True)
-            if error:
-                message += "\n" + error
-                markdown = None
+        elif context.args[0] == "attempts":
+            if self.log_source == "None":
+                message = "log ingestion disabled, see `LogSource` on `rasp_conf.ini`"
 
             else:
-                message += "\nED25519: `%s`" % ed25519_fingerprint
+                message = self._render_attempts()
 
         await update.effective_message.reply_text("SSH:\n" + message, parse_mode=markdown)
 
+    # Log ingestion
+    async def start_ingestion(self, _):
+        if self.log_source == "journal":
+            task = self.core.application.create_task(self._follow_journal())
+            self._ingestion_tasks.add(task)
+
+        else:
+            self.tailer = LogTailer(self.log_source)
+
+            # inotify on the log directory (changes, rotations), else the file is polled
+            try:
+                self._inotify = Inotify()
+                self._inotify.add_watch(os.path.dirname(os.path.abspath(self.log_source)))
+                self._inotify_loop = asyncio.get_running_loop()
+                self._inotify_loop.add_reader(self._inotify.fd, self._on_log_change)
+
+            except OSError as error:
+                module_logger.info("[SSH] inotify not available (%s), polling %s" % (error, self.log_source))
+                if self._inotify:
+                    self._inotify.close()
+
+                self._inotify = None
+                self._ingestion_jobs.append(self.core.application.job_queue.run_repeating(
+                    lambda _: self._read_log(), interval=LOG_POLL_INTERVAL))
+
+            self._read_log()
+
+        self._ingestion_jobs.append(self.core.application.job_queue.run_repeating(self.close_bursts,
+                                                                                  interval=BURST_CHECK_INTERVAL))
+
+    def kill(self):
+        # The reader, the tasks and `journalctl` would outlive the module, alerting every event twice after a restart
+        if self._inotify:
+            self._inotify_loop.remove_reader(self._inotify.fd)
+            self._inotify.close()
+            self._inotify = None
+
+        for task in list(self._ingestion_tasks):
+            task.cancel()
+
+        if self._journal_process and self._journal_process.returncode is None:
+            try:
+                self._journal_process.terminate()
+
+            except ProcessLookupError:
+                pass
+
+        for job in self._ingestion_jobs:
+            job.schedule_removal()
+
+        self._ingestion_jobs = []
+        if self.tailer:
+            self.tailer.close()
+
+    def _on_log_change(self):
+        self._inotify.drain()
+        self._read_log()
+
+    def _read_log(self):
+        for line in self.tailer.read_lines():
+            event = parse_sshd_line(line)
+            if event:
+                self.handle_event(event, time.time())
+
+    async def _follow_journal(self):
+        delay = JOURNAL_RESTART_MIN
+        while True:
+            try:
+                process = await asyncio.create_subprocess_exec(
+                    "journalctl", "--follow", "--lines=0", "--output=export",
+                    "SYSLOG_IDENTIFIER=sshd", "SYSLOG_IDENTIFIER=sshd-session",
+                    stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.DEVNULL)
+                self._journal_process = process
+
+                try:
+                    async for entry in read_journal_export(process.stdout):
+                        delay = JOURNAL_RESTART_MIN
+                        event = parse_sshd_message(entry.get("MESSAGE", ""), entry.get("_PID", None))
+                        if event:
+                            timestamp = int(entry.get("__REALTIME_TIMESTAMP", 0)) / 10 ** 6 or time.time()
+                            self.handle_event(event, timestamp)
+
+                finally:
+                    if process.returncode is None:
+                        process.kill()
+
+                    await process.wait()
+
+                module_logger.warning("[SSH] journalctl exited (%s)" % process.returncode)
+
+            except (OSError, ValueError, asyncio.IncompleteReadError) as error:
+                module_logger.warning("[SSH] Unable to read the journal: %s" % error)
+
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, JOURNAL_RESTART_MAX)
+
+    def handle_event(self, event, timestamp):
+        kind = event["event"]
+        if kind == "failed":
+            # A client offers its keys one by one: a rejected key is not a guess (unlike a password)
+            if event.get("method", None) != "publickey":
+                burst = self.bruteforce.add(event["ip"], event["user"], timestamp)
+                if burst:
+                    self.alert_burst(burst)
+
+        elif kind == "accepted":
+            failed = len(self.bruteforce.attempts.get(event["ip"], ()))
+            self.alert("Login of *%s* from `%s` (%s, port %s)%s" % (
+                escape_markdown(event["user"]), event["ip"], event["method"], event["port"],
+                "\n⚠️ After %d failed attempts from the same IP" % failed if failed else ""),
+                session=("pid", event["pid"]), ip=event["ip"])
+
+        elif kind == "closed":
+            self.close_session(("pid", event["pid"]))
+
+    def alert_burst(self, burst):
+        """Alert a burst as soon as it starts, the alert is edited with its totals by `close_bursts`."""
+        message, severity = self._alert_text(self._burst_text(burst), burst.ip)
+        module_logger.info("SSH Alert: %s" % message.encode("unicode_escape").decode("utf-8"))
+
+        burst_alert = {"message_id": None, "ended": None}
+        self._burst_alerts[burst.ip] = burst_alert
+        self.core.send_message(message, on_sent=lambda sent: self._burst_sent(burst_alert, sent),
+                               silent=severity == "allow")
+
+    def _burst_sent(self, burst_alert, sent_message):
+        burst_alert["message_id"] = sent_message.message_id
+        if burst_alert["ended"] is not None:
+            self.core.edit_message(burst_alert["message_id"], burst_alert["ended"])
+
+    async def close_bursts(self, _):
+        for burst in self.bruteforce.close_bursts(time.time()):
+            burst_alert = self._burst_alerts.pop(burst.ip, None)
+            if burst_alert is None:
+                continue
+
+            burst_alert["ended"], _ = self._alert_text(self._burst_text(burst, ended=True), burst.ip)
+            if burst_alert["message_id"] is not None:  # Else edited as soon as sent
+                self.core.edit_message(burst_alert["message_id"], burst_alert["ended"])
+
+    @staticmethod
+    def _burst_text(burst, ended=False):
+        users = sorted(burst.users)
+        message = "Brute force from `%s`: %d failed attempts in %s%s\nUsers: %s" % (
+            burst.ip, burst.count, humanize.precisedelta(max(burst.last - burst.first, 1)),
+            "" if ended else " (ongoing)",
+            escape_markdown(", ".join(users[:BURST_USERS_SHOWN]) +
+                            (" (+%d)" % (len(users) - BURST_USERS_SHOWN) if len(users) > BURST_USERS_SHOWN else "")))
+        if ended:
+            message += "\n🔚 Ended at %s" % datetime.fromtimestamp(burst.last).strftime("%H:%M:%S")
+
+        return message
+
+    def _render_attempts(self):
+        message = "Failed attempts (last %s):\n" % humanize.precisedelta(self.bruteforce.window)
+        attempts = sorted(((ip, len(x)) for ip, x in self.bruteforce.attempts.items() if len(x)),
+                          key=lambda x: -x[1])
+        if not attempts:
+            return message + "_None_"
+
+        message += "\n".join("• `%s`: %d%s" % (ip, count,
+                                                " (🚨 brute force)" if ip in self.bruteforce.bursts else "")
+                              for ip, count in attempts[:ATTEMPTS_SHOWN])
+        if len(attempts) > ATTEMPTS_SHOWN:
+            message += "\n_...and %d more IPs_" % (len(attempts) - ATTEMPTS_SHOWN)
+
+        return message
+
     def _grep_ssh_port(self):
         proc, stdout, stderr = self.core.server.run(("grep", '"Port "', "/etc/ssh/sshd_config"))
         if not proc:
@@ -100,26 +392,25 @@ class ModuleSSH(RaspOneBaseModule):
         else:
             return False, "Error: `Port` not found in `/etc/ssh/sshd_config`."
 
-    def get_ssh_fingerprint(self, ed25519=False):
-        proc, stdout, stderr = self.core.server.run(("ssh-keygen", "-lf", "/etc/ssh/ssh_host_%s_key.pub" %
-                                                     ("ed25519" if ed25519 else "ecdsa")))
-        if not proc:
-            return False, self.core.server.default_error_message
-
-        elif len(stderr):
-            return False, stderr
-
-        elif len(stdout):
+    def get_host_keys(self):
+        """Fingerprints of every `/etc/ssh/ssh_host_*_key.pub` (see `read_host_key`), cached by file mtime."""
+        host_keys = []
+        for path in sorted(glob.glob(HOST_KEYS_PATTERN)):
             try:
-                fingerprint = stdout.split(" ")[1]
+                mtime = os.stat(path).st_mtime_ns
+                if self.host_keys.get(path, (None, None))[0] != mtime:
+                    self.host_keys[path] = (mtime, read_host_key(path))
 
-            except IndexError:
-                fingerprint = stdout
+            except (OSError, ValueError) as error:
+                module_logger.warning("[SSH] Unable to read host key %s: %s" % (path, error))
+                continue
 
-            return fingerprint, None
+            host_keys.append(self.host_keys[path][1])
 
-        else:
-            return False, self.core.server.default_error_message
+        if not len(host_keys):
+            return False, "Error: no host key found (`%s`)." % HOST_KEYS_PATTERN
+
+        return host_keys, None
 
     @staticmethod
     def _build_utils():
@@ -130,6 +421,340 @@ class ModuleSSH(RaspOneBaseModule):
     module_logger.warning("** THIS MODULE REQUIRE YOUR ATTENTION, SEE LOGS AND utils/ DIRECTORY **")
 
 
+def read_host_key(path):
+    """
+    `{"type", "bits", "comment", "sha256", "md5", "sshfp"}` of an OpenSSH public key file, the fingerprints as printed
+    by `ssh-keygen -l` and `sshfp` as `[(algorithm, fingerprint type, hex fingerprint)]` (RFC 4255, 6594, 7479).
+    Raises ValueError if the file is not a public key.
+    """
+    with open(path, "r") as key_file:
+        fields = key_file.read().split(None, 2)
+
+    if len(fields) < 2:
+        raise ValueError("not an OpenSSH public key")
+
+    try:
+        blob = base64.b64decode(fields[1], validate=True)
+
+    except ValueError:
+        raise ValueError("invalid key encoding")
+
+    values = _ssh_strings(blob)
+    key_type = values[0].decode("ascii", "replace")
+    if key_type != fields[0]:
+        raise ValueError("key type mismatch (%s, %s)" % (fields[0], key_type))
+
+    algorithm = SSHFP_ALGORITHMS.get(key_type, None)
+    return {
+        "type": HOST_KEY_NAMES.get(key_type, key_type),
+        "bits": _key_bits(key_type, values),
+        "comment": fields[2].strip() if len(fields) > 2 else "",
+        "sha256": "SHA256:" + base64.b64encode(hashlib.sha256(blob).digest()).decode().rstrip("="),
+        "md5": "MD5:" + hashlib.md5(blob).digest().hex(":"),
+        "sshfp": [(algorithm, 1, hashlib.sha1(blob).hexdigest()),
+                  (algorithm, 2, hashlib.sha256(blob).hexdigest())] if algorithm else []
+    }
+
+
+def _ssh_strings(blob):
+    """The length-prefixed strings (RFC 4251) of a key blob."""
+    values, offset = [], 0
+    while offset < len(blob):
+        if offset + 4 > len(blob):
+            raise ValueError("truncated key")
+
+        length, = struct.unpack_from(">I", blob, offset)
+        if offset + 4 + length > len(blob):
+            raise ValueError("truncated key")
+
+        values.append(blob[offset + 4:offset + 4 + length])
+        offset += 4 + length
+
+    if not len(values):
+        raise ValueError("empty key")
+
+    return values
+
+
+def _key_bits(key_type, values):
+    if key_type in ("ssh-rsa", "ssh-dss") and len(values) > 2:
+        # RSA: e, n; DSA: p, q, g, y
+        modulus = values[2] if key_type == "ssh-rsa" else values[1]
+        return int.from_bytes(modulus, "big").bit_length()
+
+    return HOST_KEY_BITS.get(key_type, None)
+
+
+# sshd messages, from the auth log (syslog format) or the journal (`MESSAGE` field)
+SYSLOG_LINE = re.compile(r"^\S+(?: +\d+ [\d:]+)? \S+ (?:sshd|sshd-session)\[(?P<pid>\d+)]: (?P<message>.*)$")
+
+SSHD_MESSAGES = [
+    ("accepted", re.compile(r"^Accepted (?P<method>\S+) for (?P<user>\S+) from (?P<ip>\S+) port (?P<port>\d+)")),
+    # Each attempt on an invalid user is logged as "Failed ... for invalid user" (after one "Invalid user", ignored)
+    ("failed", re.compile(r"^Failed (?P<method>\S+) for (?:invalid user )?(?P<user>\S*) from (?P<ip>\S+) "
+                          r"port (?P<port>\d+)")),
+    ("closed", re.compile(r"^pam_unix\(sshd:session\): session closed for user (?P<user>\S+)")),
+    ("closed", re.compile(r"^Disconnected from user (?P<user>\S+) (?P<ip>\S+) port (?P<port>\d+)")),
+]
+
+
+# Alerts of the PAM hook (see `SCRIPT_TEMPLATE`)
+PAM_ALERT = re.compile(r"New event '?`(?P<type>\w+)`'?.*\*From\*: '?`(?P<rhost>[^`]*)`'?.*"
+                       r"User: (?P<user>\S*) \(TTY: (?P<tty>[^)]*)\)", re.DOTALL)
+
+
+def parse_pam_alert(message):
+    match = PAM_ALERT.search(message)
+    return match.groupdict() if match else None
+
+
+def parse_sshd_message(message, pid=None):
+    """Event (`event`, `pid` and the named groups of its pattern) of an sshd message, None if not relevant."""
+    for event, pattern in SSHD_MESSAGES:
+        match = pattern.match(message)
+        if match:
+            return dict(match.groupdict(), event=event, pid=pid)
+
+    return None
+
+
+def parse_sshd_line(line):
+    match = SYSLOG_LINE.match(line)
+    return parse_sshd_message(match.group("message"), match.group("pid")) if match else None
+
+
+async def read_journal_export(stream):
+    """Entries (field -> value) of journald's export format, read from an `asyncio.StreamReader`."""
+    entry = dict()
+    while True:
+        line = await stream.readline()
+        if not line:
+            return
+
+        if line == b"\n":
+            yield entry
+            entry = dict()
+            continue
+
+        field, separator, value = line[:-1].partition(b"=")
+        if not separator:  # Binary field: little-endian 64 bit size, data, new line
+            size = int.from_bytes(await stream.readexactly(8), "little")
+            value = (await stream.readexactly(size + 1))[:-1]
+
+        entry[field.decode(errors="replace")] = value.decode(errors="replace")
+
+
+class LogTailer:
+    """Incremental reader of a log file, following its rotations (new inode) and truncations."""
+
+    def __init__(self, path):
+        self.path = path
+        self.file = None
+        self.inode = None
+        self.partial = b""
+
+        # Start from the end, the events logged before are not reported
+        self._open(from_end=True)
+
+    def _open(self, from_end=False):
+        try:
+            self.file = open(self.path, "rb")
+            self.inode = os.fstat(self.file.fileno()).st_ino
+            if from_end:
+                self.file.seek(0, os.SEEK_END)
+
+        except OSError:
+            self.file = self.inode = None
+
+    def read_lines(self):
+        lines = []
+        try:
+            current_inode = os.stat(self.path).st_ino
+
+        except OSError:
+            current_inode = None
+
+        if self.file and current_inode != self.inode:
+            lines += self._read_available()  # Rotated: the end of the old file, then the new one
+            self.file.close()
+            self.file = None
+            self.partial = b""
+
+        if not self.file:
+            self._open()
+            if not self.file:
+                return lines
+
+        elif os.fstat(self.file.fileno()).st_size < self.file.tell():  # Truncated (copytruncate)
+            self.file.seek(0)
+            self.partial = b""
+
+        return lines + self._read_available()
+
+    def close(self):
+        if self.file:
+            self.file.close()
+            self.file = None
+
+    def _read_available(self):
+        lines = []
+        while True:
+            chunk = self.file.read(LOG_READ_SIZE)
+            if not chunk:
+                return lines
+
+            chunk_lines = (self.partial + chunk).split(b"\n")
+            self.partial = chunk_lines.pop()
+            lines += [line.decode(errors="replace") for line in chunk_lines]
+
+
+class Inotify:
+    """Minimal inotify (Linux) wrapper, through `ctypes`: its `fd` becomes readable when a watched path changes."""
+
+    def __init__(self):
+        libc_name = ctypes.util.find_library("c")
+        if not libc_name:
+            raise OSError(errno.ENOSYS, "libc not found")
+
+        self.libc = ctypes.CDLL(libc_name, use_errno=True)
+        if not hasattr(self.libc, "inotify_init1"):
+            raise OSError(errno.ENOSYS, "inotify not supported")
+
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()))
+
+    def add_watch(self, path, mask=None):
+        mask = mask or INOTIFY_MASK
+        if self.libc.inotify_add_watch(self.fd, os.fsencode(path), ctypes.c_uint32(mask)) < 0:
+            raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()), path)
+
+    def close(self):
+        os.close(self.fd)
+
+    def drain(self):
+        # The events are not parsed: any change triggers a read of the log (cheap when nothing is new)
+        try:
+            while os.read(self.fd, 4096):
+                pass
+
+        except BlockingIOError:
+            pass
+
+
+class BruteForceAggregator:
+    """
+    Failed attempts per source IP, in a sliding window of `window` seconds: at `threshold` attempts a burst starts,
+    it is closed after `window` seconds without attempts.
+    """
+
+    Burst = collections.namedtuple("Burst", ("ip", "first", "last", "count", "users"))
+
+    def __init__(self, window, threshold):
+        self.window = window
+        self.threshold = threshold
+        self.attempts = collections.OrderedDict()  # IP -> deque of (timestamp, user), least recently seen first
+        self.bursts = dict()  # IP -> [first, last, count, users]
+
+    def add(self, ip, user, timestamp):
+        """Count a failed attempt, return the burst it starts (None if no burst starts)."""
+        started = None
+        attempts = self.attempts.pop(ip, None) or collections.deque()
+        self.attempts[ip] = attempts
+        attempts.append((timestamp, user))
+        while attempts and attempts[0][0] < timestamp - self.window:
+            attempts.popleft()
+
+        if ip in self.bursts:
+            burst = self.bursts[ip]
+            burst[1], burst[2] = timestamp, burst[2] + 1
+            if len(burst[3]) < BURST_USERS_KEPT:
+                burst[3].add(user)
+
+        elif len(attempts) >= self.threshold:
+            self.bursts[ip] = [attempts[0][0], timestamp, len(attempts), {x[1] for x in attempts}]
+            started = self.Burst(ip, *self.bursts[ip])
+
+        # Bounded memory: the IPs seen least recently are forgotten first
+        while len(self.attempts) > MAX_TRACKED_IPS:
+            self.attempts.popitem(last=False)
+
+        return started
+
+    def close_bursts(self, now):
+        """Bursts without attempts in the last `window` seconds, removed. Expired attempts are dropped too."""
+        closed = []
+        for ip, (first, last, count, users) in list(self.bursts.items()):
+            if last < now - self.window:
+                closed.append(self.Burst(ip, first, last, count, users))
+                del self.bursts[ip]
+
+        for ip, attempts in list(self.attempts.items()):
+            if not attempts or attempts[-1][0] < now - self.window:
+                del self.attempts[ip]
+
+        return closed
+
+
+LOG_POLL_INTERVAL = 5  # seconds, without inotify
+
+LOG_READ_SIZE = 64 * 1024
+
+INOTIFY_MASK = 0x2 | 0x40 | 0x80 | 0x100 | 0x200  # IN_MODIFY, IN_MOVED_FROM, IN_MOVED_TO, IN_CREATE, IN_DELETE
+
+JOURNAL_RESTART_MIN = 5  # seconds, doubled after each failure
+
+JOURNAL_RESTART_MAX = 300  # seconds
+
+BURST_CHECK_INTERVAL = 60  # seconds
+
+BURST_USERS_KEPT = 50
+
+BURST_USERS_SHOWN = 10
+
+ATTEMPTS_SHOWN = 20
+
+MAX_TRACKED_IPS = 10000
+
+SESSIONS_SIZE = 1024
+
+SESSION_TTL = 24 * 60 * 60  # seconds, sessions not closed after a day are forgotten
+
+HOST_KEYS_PATTERN = "/etc/ssh/ssh_host_*_key.pub"
+
+HOST_KEY_NAMES = {
+    "ssh-rsa": "RSA",
+    "ssh-dss": "DSA",
+    "ecdsa-sha2-nistp256": "ECDSA",
+    "ecdsa-sha2-nistp384": "ECDSA",
+    "ecdsa-sha2-nistp521": "ECDSA",
+    "ssh-ed25519": "ED25519",
+    "ssh-ed448": "ED448",
+    "sk-ecdsa-sha2-nistp256@openssh.com": "ECDSA-SK",
+    "sk-ssh-ed25519@openssh.com": "ED25519-SK"
+}
+
+HOST_KEY_BITS = {
+    "ecdsa-sha2-nistp256": 256,
+    "ecdsa-sha2-nistp384": 384,
+    "ecdsa-sha2-nistp521": 521,
+    "ssh-ed25519": 256,
+    "ssh-ed448": 456,
+    "sk-ecdsa-sha2-nistp256@openssh.com": 256,
+    "sk-ssh-ed25519@openssh.com": 256
+}
+
+# https://www.iana.org/assignments/dns-sshfp-rr-parameters/dns-sshfp-rr-parameters.xhtml
+SSHFP_ALGORITHMS = {
+    "ssh-rsa": 1,
+    "ssh-dss": 2,
+    "ecdsa-sha2-nistp256": 3,
+    "ecdsa-sha2-nistp384": 3,
+    "ecdsa-sha2-nistp521": 3,
+    "ssh-ed25519": 4,
+    "ssh-ed448": 6
+}
+
 SCRIPT_TEMPLATE = """#!/bin/bash
 
 # SSH Alert module
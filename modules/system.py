@@ -1,8 +1,14 @@
 import os
-import telegram
+import glob
+import math
+import time
 import logging
+import humanize
+import telegram
+from datetime import datetime
 
-from src import DEFAULT_NAME, UTILS_PATH
+from src import config, DEFAULT_NAME, UTILS_PATH
+from src.ring import SampleRing
 from modules import RaspOneBaseModule
 
 module_logger = logging.getLogger(DEFAULT_NAME + ".module.system")
@@ -14,7 +20,8 @@ class ModuleSystem(RaspOneBaseModule):
     DESCRIPTION = "Manage the system"
 
     USAGE = {
-        "reboot": "Reboot the system"
+        "reboot": "Reboot the system",
+        "stats": "Show CPU, memory, load, disk, network and temperature, with their averages and trends"
     }
 
     def __init__(self, core):
@@ -23,6 +30,16 @@ class ModuleSystem(RaspOneBaseModule):
         self.reboot_keyboard = [[telegram.InlineKeyboardButton("Yes!", callback_data="SYSTEM_REBOOT_True"),
                                  telegram.InlineKeyboardButton("No...", callback_data="SYSTEM_REBOOT_False")]]
 
+        system_config = config["Module - System"] if config.has_section("Module - System") else dict()
+
+        # Metrics sampled every `SampleSeconds` from `/proc` and `/sys`, kept in ring buffers at several resolutions
+        self.sampler = None
+        if system_config.get("Sampler", "True") != "False":
+            self.sampler = SystemSampler(int(system_config.get("SampleSeconds", "10")))
+            self.sampler_job = self.core.application.job_queue.run_repeating(self.sample,
+                                                                             interval=self.sampler.interval,
+                                                                             first=self.sampler.interval)
+
     async def command(self, update, context):
         if context.args[0] == "reboot":
             await update.effective_message.reply_text("Are you sure? 😨😨",
@@ -30,6 +47,25 @@ class ModuleSystem(RaspOneBaseModule):
 
             self.register_query_callback("REBOOT", self.query_handler_reboot)
 
+        elif context.args[0] == "stats":
+            if not self.sampler:
+                message = "sampler disabled, see `Sampler` on `rasp_conf.ini`"
+
+            else:
+                message = self._render_stats()
+
+            await update.effective_message.reply_text("System:\n" + message,
+                                                      parse_mode=telegram.constants.ParseMode.MARKDOWN)
+
+    async def sample(self, _):
+        # A sample costs well under a millisecond: read in the event loop, without a thread
+        self.sampler.sample()
+
+    def kill(self):
+        if self.sampler:
+            self.sampler_job.schedule_removal()
+            self.sampler.close()
+
     async def query_handler_reboot(self, update, _):
         query = update.callback_query
         if query.data == "True":
@@ -62,6 +98,28 @@ class ModuleSystem(RaspOneBaseModule):
         else:
             return True, None
 
+    def _render_stats(self):
+        levels = self.sampler.levels
+        if not levels[0].count:
+            return "no sample yet, retry in %d seconds" % (self.sampler.interval * 2)
+
+        # Current values, then the average over the span of each resolution
+        columns = [levels[0].last()] + [level.mean(level.span) for level in levels]
+        header = ["now"] + [_span_label(level.span) for level in levels]
+        rows = ["%-7s" % "" + "".join("%7s" % x for x in header)]
+        for i, (_, label, formatter) in enumerate(METRICS):
+            rows.append("%-7s" % label + "".join("%7s" % (formatter(column[i]) if not math.isnan(column[i]) else "-")
+                                                 for column in columns))
+
+        # Trend of the last hour (or of the span of the finest resolution)
+        span = min(TREND_SPAN, levels[0].span)
+        series = levels[0].series(span, TREND_POINTS)
+        rows += ["", "Last %s:" % _span_label(span)] + ["%-7s" % label + _sparkline([x[i] for x in series])
+                                                         for i, (_, label, _) in enumerate(METRICS)]
+
+        return "📊 Sampled every %d seconds since %s\n```\n%s\n```" % (
+            self.sampler.interval, humanize.naturaltime(datetime.now() - self.sampler.started), "\n".join(rows))
+
     @staticmethod
     def _build_utils():
         with open(os.path.join(UTILS_PATH, "rasp_one_system.conf"), "w") as script:
@@ -70,6 +128,212 @@ class ModuleSystem(RaspOneBaseModule):
     module_logger.warning("** THIS MODULE REQUIRE YOUR ATTENTION, SEE LOGS AND utils/ DIRECTORY **")
 
 
+class SystemSampler:
+    """
+    Samples the `METRICS` reading `/proc` and `/sys` only (no subprocess, the files are kept open and read again from
+    the start). Each resolution of `RESOLUTIONS` is a `SampleRing`, fed with the means of `factor` samples of the
+    previous one.
+    """
+
+    def __init__(self, interval=10):
+        self.interval = interval
+        self.started = datetime.now()
+
+        self.levels = []
+        step = interval
+        for factor, size in RESOLUTIONS:
+            step *= factor
+            self.levels.append(SampleRing(size, len(METRICS), step))
+
+        # Downsampling accumulators of the coarser levels: per metric sums and counts (NaN skipped), samples merged
+        self._sums = [[0.0] * len(METRICS) for _ in self.levels]
+        self._counts = [[0] * len(METRICS) for _ in self.levels]
+        self._merged = [0] * len(self.levels)
+
+        self._files = dict()
+        self._previous = None  # (monotonic time, counters)
+
+        # Physical disks only: partitions, loop, RAM and device-mapper devices would count the same I/O twice
+        try:
+            self.disks = {x for x in os.listdir(SYS_BLOCK) if os.path.exists(os.path.join(SYS_BLOCK, x, "device"))}
+
+        except OSError:
+            self.disks = set()
+
+        self.thermal_zones = sorted(glob.glob(THERMAL_ZONES))
+
+    def sample(self):
+        now, timestamp = time.monotonic(), time.time()
+        counters = self._read_counters()
+        if self._previous:
+            elapsed = now - self._previous[0]
+            previous = self._previous[1]
+
+            # CPU busy share of the jiffies elapsed, then the rates of the cumulative counters
+            cpu = (counters[0] - previous[0]) / (counters[1] - previous[1]) * 100 \
+                if counters[1] > previous[1] else math.nan
+            rates = [max(x - y, 0) / elapsed if elapsed > 0 else math.nan
+                     for x, y in zip(counters[2:], previous[2:])]
+
+            self._append((cpu, *self._read_memory_load(), *rates, self._read_temperature()), timestamp)
+
+        self._previous = (now, counters)
+
+    def _append(self, values, timestamp):
+        self.levels[0].append(timestamp, values)
+        for i in range(1, len(self.levels)):
+            sums, counts = self._sums[i], self._counts[i]
+            for j, value in enumerate(values):
+                if not math.isnan(value):
+                    sums[j] += value
+                    counts[j] += 1
+
+            self._merged[i] += 1
+            if self._merged[i] < RESOLUTIONS[i][0]:
+                return
+
+            values = [x / c if c else math.nan for x, c in zip(sums, counts)]
+            self.levels[i].append(timestamp, values)
+            self._sums[i], self._counts[i], self._merged[i] = [0.0] * len(METRICS), [0] * len(METRICS), 0
+
+    def close(self):
+        for proc_file in self._files.values():
+            proc_file.close()
+
+        self._files = dict()
+
+    # Sources
+    def _read(self, path):
+        proc_file = self._files.get(path, None)
+        try:
+            if proc_file is None:
+                proc_file = self._files[path] = open(path, "rb", buffering=0)
+
+            proc_file.seek(0)
+            return proc_file.read().decode("ascii", "replace")
+
+        except OSError:
+            if self._files.pop(path, None):
+                proc_file.close()
+
+            return None
+
+    def _read_counters(self):
+        """`(CPU busy, CPU total, disk read, disk written, network received, network sent)`, cumulative."""
+        counters = [math.nan] * 6
+
+        stat = self._read("/proc/stat")
+        if stat:
+            jiffies = [int(x) for x in stat.split("\n", 1)[0].split()[1:9]]
+            counters[0] = sum(jiffies) - jiffies[3] - jiffies[4]  # Not idle nor waiting I/O
+            counters[1] = sum(jiffies)
+
+        diskstats = self._read("/proc/diskstats")
+        if diskstats:
+            counters[2] = counters[3] = 0
+            for fields in (x.split() for x in diskstats.splitlines()):
+                if len(fields) > 9 and fields[2] in self.disks:
+                    counters[2] += int(fields[5]) * SECTOR_SIZE
+                    counters[3] += int(fields[9]) * SECTOR_SIZE
+
+        net_dev = self._read("/proc/net/dev")
+        if net_dev:
+            counters[4] = counters[5] = 0
+            for line in net_dev.splitlines()[2:]:
+                interface, _, fields = line.partition(":")
+                fields = fields.split()
+                if interface.strip() != "lo" and len(fields) > 8:
+                    counters[4] += int(fields[0])
+                    counters[5] += int(fields[8])
+
+        return counters
+
+    def _read_memory_load(self):
+        """`(memory used %, 1 minute load average)`"""
+        memory = load = math.nan
+
+        meminfo = self._read("/proc/meminfo")
+        if meminfo:
+            values = dict()
+            for line in meminfo.splitlines():
+                key, _, value = line.partition(":")
+                if key in ("MemTotal", "MemAvailable"):
+                    values[key] = int(value.split()[0])
+
+            if values.get("MemTotal", 0) and "MemAvailable" in values:
+                memory = (values["MemTotal"] - values["MemAvailable"]) / values["MemTotal"] * 100
+
+        loadavg = self._read("/proc/loadavg")
+        if loadavg:
+            load = float(loadavg.split()[0])
+
+        return memory, load
+
+    def _read_temperature(self):
+        """Hottest thermal zone, Celsius degrees."""
+        temperatures = [int(x) / 1000 for x in (self._read(path) for path in self.thermal_zones)
+                        if x and x.strip().lstrip("-").isdigit()]
+        return max(temperatures) if temperatures else math.nan
+
+
+def _span_label(seconds):
+    for unit, label in ((86400, "d"), (3600, "h"), (60, "m")):
+        if seconds >= unit:
+            return "%d%s" % (seconds // unit, label)
+
+    return "%ds" % seconds
+
+
+def _sparkline(values):
+    known = [x for x in values if not math.isnan(x)]
+    if not known:
+        return ""
+
+    low, high = min(known), max(known)
+    return "".join(" " if math.isnan(x) else
+                   SPARKLINE[int((x - low) / (high - low) * (len(SPARKLINE) - 1)) if high > low else 0]
+                   for x in values)
+
+
+def _format_rate(value):
+    # At most 6 characters (_e.g._ `9.5K/s`, `120K/s`), to fit the table columns
+    for unit in "BKMG":
+        if value < 999.5 or unit == "G":
+            break
+
+        value /= 1024
+
+    return ("%.1f" if value < 9.95 and unit != "B" else "%.0f") % value + unit + "/s"
+
+
+# (key, label, formatter): order of the values in the samples
+METRICS = [
+    ("cpu", "CPU", lambda x: "%.0f%%" % x),
+    ("memory", "Memory", lambda x: "%.0f%%" % x),
+    ("load", "Load", lambda x: "%.2f" % x),
+    ("disk_read", "Disk R", _format_rate),
+    ("disk_write", "Disk W", _format_rate),
+    ("net_rx", "Net RX", _format_rate),
+    ("net_tx", "Net TX", _format_rate),
+    ("temperature", "Temp", lambda x: "%.0f°" % x)
+]
+
+# (samples of the previous level merged, samples kept): 10 s for 1 hour, 1 minute for 1 day, 10 minutes for 1 week
+# at the default interval, about 200 kB in total
+RESOLUTIONS = [(1, 360), (6, 1440), (10, 1008)]
+
+TREND_SPAN = 60 * 60  # seconds
+
+TREND_POINTS = 12
+
+SPARKLINE = "▁▂▃▄▅▆▇█"
+
+SECTOR_SIZE = 512  # bytes, `/proc/diskstats` unit whatever the device
+
+SYS_BLOCK = "/sys/block"
+
+THERMAL_ZONES = "/sys/class/thermal/thermal_zone*/temp"
+
 SCRIPT_TEMPLATE = """# System module
 # sudo copy this file into `/etc/sudoers.d/`
 
@@ -1,5 +1,10 @@
+import os
 import json
+import time
+import math
 import base64
+import tempfile
+import urllib.parse
 import logging
 import datetime
 import telegram
@@ -8,6 +13,7 @@ import humanize
 from typing import Union
 
 from src import config, DEFAULT_NAME
+from src.ring import SampleRing
 from modules import RaspOneBaseModule
 
 module_logger = logging.getLogger(DEFAULT_NAME + ".module.torrent")
@@ -20,10 +26,15 @@ class ModuleTorrent(RaspOneBaseModule):
 
     USAGE = {
         "status": "Check if `transmission` is running",
-        "list": "List torrents",
-        "add": "Add a torrent from a file or a magnet link",
-        "remove": "Remove a torrent (keeping local data if completed)",
-        "pause": "Pause or resume a torrent"
+        "list": "List torrents\n"
+                "_More_: `/torrent list <sort> <filter>`, sort by `name`, `size`, `progress` or `ratio`, "
+                "filter by `downloading`, `seeding`, `stopped` or `errors`",
+        "add": "Add torrents from files or magnet links",
+        "remove": "Remove torrents (keeping local data if completed)",
+        "pause": "Pause or resume torrents",
+        "files": "Show and select the files of a torrent\n"
+                 "_More_: `/torrent files <id>`",
+        "speed": "Show current speed rates and bandwidth policy"
     }
 
     def __init__(self, core):
@@ -35,13 +46,78 @@ class ModuleTorrent(RaspOneBaseModule):
 
         self.download_dir = config["Module - Torrent"]["DownloadDir"]
 
+        # `.torrent` ingestion: Transmission's watch directory, or local path if the daemon shares the filesystem
+        self.watch_dir = config["Module - Torrent"].get("WatchDir", "None")
+        self.watch_dir = None if self.watch_dir == "None" else self.watch_dir
+
+        self.shared_filesystem = config["Module - Torrent"].get("SharedFilesystem", "Auto")
+        if self.shared_filesystem == "Auto":
+            self.shared_filesystem = urllib.parse.urlparse(self.rpc_url).hostname in ("127.0.0.1", "localhost", "::1")
+
+        else:
+            self.shared_filesystem = self.shared_filesystem != "False"
+
+        self.ingest_dir = config["Module - Torrent"].get("IngestDir", "None")
+        self.ingest_dir = tempfile.gettempdir() if self.ingest_dir == "None" else self.ingest_dir
+
+        self._add_batch = []
+        self._add_batch_job = None
+
+        # Files of the torrent shown by `/torrent files`, with the pending changes (index -> (wanted, priority))
+        self._files_view = None
+
         self.transmission_service_name = "transmission"
 
+        # Local torrent table (ID -> torrent), kept updated with `recently-active` deltas
+        self.torrents = dict()
+        self._torrents_synced = None
+        self._torrents_dirty = set()
+
+        # Torrent IDs selected on the current multi-select keyboard
+        self._selected_torrents = set()
+
+        # Current list view (tag, sort, filter, page) and its rendering cache, valid until the table changes
+        self._torrents_version = 0
+        self._list_view = ["LIST", "id", "all", 0]
+        self._list_cache = {"version": None, "views": dict(), "pages": dict()}
+        self._rendered_torrents = dict()
+
+        # Progress tracking: rate history, milestones and stalls of the downloading torrents
+        self.milestones = sorted(int(x) for x in
+                                 config["Module - Torrent"].get("Milestones", "25,50,75").split(",") if x.strip())
+        self.stall_timeout = int(config["Module - Torrent"].get("StallMinutes", "10")) * 60
+        self._torrents_updated = set()
+        self._rate_history = dict()
+        self._milestones_reached = dict()
+        self._stalled_torrents = set()
+
+        # Status message, pinned and edited in place while there are downloading torrents
+        self.status_message_enabled = config["Module - Torrent"].get("StatusMessage", "True") != "False"
+        self._status_message = None
+        self._status_text = None
+        self._status_edited = 0.
+
         self.watcher = None
         self.watcher_timer = datetime.timedelta(seconds=15)
-        self._watcher_set = set()
         self.start_watcher()
 
+        # Bandwidth scheduler: limited speed during busy hours, high system load or VPN sessions
+        self.scheduler_enabled = config["Module - Torrent"].get("SpeedScheduler", "False") != "False"
+        self.busy_hours = self._parse_hours(config["Module - Torrent"].get("BusyHours", "None"))
+        self.load_high = float(config["Module - Torrent"].get("LoadHigh", "0.8"))
+        self.load_low = float(config["Module - Torrent"].get("LoadLow", "0.5"))
+        self.limit_down = config["Module - Torrent"].get("LimitDown", "None")
+        self.limit_down = None if self.limit_down == "None" else int(self.limit_down)
+        self.limit_up = config["Module - Torrent"].get("LimitUp", "None")
+        self.limit_up = None if self.limit_up == "None" else int(self.limit_up)
+
+        self.scheduler = None
+        self._limited = None
+        self._limited_reasons = []
+        self._limited_changed = 0.
+        self._high_load = False
+        self.start_scheduler()
+
     async def command(self, update, context):
         self.start_watcher()
 
@@ -59,27 +135,55 @@ class ModuleTorrent(RaspOneBaseModule):
                           ("" if status else "**not** ", "👍" if status else "👎")
 
         elif context.args[0] in ["list", "pause", "remove"]:
-            torrents, error = self.get_torrent_list()
+            error = self.sync_torrents()
             if error:
                 message = error
                 markdown = None
 
             else:
-                message = self._list_torrents(torrents)
+                tag = context.args[0].upper()
+                sort, torrent_filter = "id", "all"
+                for arg in map(str.lower, context.args[1:]):
+                    if arg in SORT_KEYS:
+                        sort = arg
+
+                    elif arg in FILTERS:
+                        torrent_filter = arg
+
+                self._list_view = [tag, sort, torrent_filter, 0]
+                self._selected_torrents.clear()
+                message, keyboard = self._render_list()
+
+                if tag == "LIST":
+                    self.register_query_callback("LIST", self.query_handler_list)
 
-                if context.args[0] == "list" or not len(torrents):
-                    message = "📥 Torrents:\n" + message
+                elif tag == "PAUSE":
+                    self.register_query_callback("PAUSE", self.query_handler_pause)
 
                 else:
-                    if context.args[0] == "pause":
-                        message = "📥 Which torrent do you want to pause/resume?\n" + message
-                        self.register_query_callback("PAUSE", self.query_handler_pause)
+                    self.register_query_callback("REMOVE", self.query_handler_remove)
 
-                    else:
-                        message = "📥 Which torrent do you want to *remove*?\n" + message
-                        self.register_query_callback("REMOVE", self.query_handler_remove)
+        elif context.args[0] == "speed":
+            message, error = self._render_speed()
+            if error:
+                message = error
+                markdown = None
 
-                    keyboard = self._prepare_keyboard(context.args[0].upper(), torrents)
+        elif context.args[0] == "files":
+            torrent_id = context.args[1].lstrip("#") if len(context.args) > 1 else ""
+            if not torrent_id.isdigit():
+                message = "Error: expecting a torrent ID!"
+                markdown = None
+
+            else:
+                error = self.load_files_view(int(torrent_id))
+                if error:
+                    message = error
+                    markdown = None
+
+                else:
+                    message, keyboard = self._render_files()
+                    self.register_query_callback("FILES", self.query_handler_files)
 
         else:
             message = "📥 Do you want to add a torrent?\n" \
@@ -89,67 +193,213 @@ class ModuleTorrent(RaspOneBaseModule):
 
         await update.effective_message.reply_text(message, reply_markup=keyboard, parse_mode=markdown)
 
+    async def query_handler_list(self, update, _):
+        await self._flip_page(update.callback_query)
+
     async def query_handler_pause(self, update, _):
         query = update.callback_query
-        torrents, error = self.get_torrent(query.data)
-        if error:
-            message = error
+        if query.data.startswith("T_"):
+            await self._toggle_selection(query)
+            return
+
+        elif query.data.startswith("P_"):
+            await self._flip_page(query)
+            return
+
+        if query.data == "ALL_STOP":
+            status, error = self.pause_torrents()
+
+        elif query.data == "ALL_START":
+            status, error = self.start_torrents()
 
         else:
-            torrent = torrents.pop(0)
-            status, error = self.start_torrent(torrent) if not torrent["status"] else self.pause_torrent(torrent)
-            if error:
-                message = error
+            selected = [self.torrents[x] for x in self._selected_torrents if x in self.torrents]
+            stopped_ids = [x["id"] for x in selected if not x["status"]]
+            running_ids = [x["id"] for x in selected if x["status"]]
 
-            else:
-                message = "👍"
+            status, error = (self.start_torrents(stopped_ids) if len(stopped_ids) else (bool(selected), None))
+            if not error and len(running_ids):
+                status, error = self.pause_torrents(running_ids)
 
-        await query.edit_message_text(text=message)
+        await query.edit_message_text(text=error if error else ("👍" if status else "No torrent selected 🤷"))
+        self._selected_torrents.clear()
         self.remove_callback("PAUSE")
 
     async def query_handler_remove(self, update, _):
         query = update.callback_query
-        torrents, error = self.get_torrent(query.data)
-        if error:
-            message = error
+        if query.data.startswith("T_"):
+            await self._toggle_selection(query)
+            return
+
+        elif query.data.startswith("P_"):
+            await self._flip_page(query)
+            return
+
+        if query.data == "COMPLETED":
+            selected = [x for x in self.torrents.values() if x["percentDone"] == 1]
 
         else:
-            torrent = torrents.pop(0)
-            status, error = self.remove_torrent(torrent)
-            if error:
-                message = error
+            selected = [self.torrents[x] for x in self._selected_torrents if x in self.torrents]
 
-            else:
-                message = "👍"
+        completed_ids = [x["id"] for x in selected if x["percentDone"] == 1]
+        incomplete_ids = [x["id"] for x in selected if x["percentDone"] < 1]
 
-        await query.edit_message_text(text=message)
+        # Local data is kept only for completed torrents, one RPC for each group
+        status, error = (self.remove_torrents(completed_ids, delete_local_data=False) if len(completed_ids)
+                         else (bool(selected), None))
+        if not error and len(incomplete_ids):
+            status, error = self.remove_torrents(incomplete_ids, delete_local_data=True)
+
+        await query.edit_message_text(text=error if error else ("👍" if status else "No torrent selected 🤷"))
+        self._selected_torrents.clear()
         self.remove_callback("REMOVE")
 
-    async def message_handler_add(self, update, _):
-        torrent = None
-        markdown = None
-        message = "Error: invalid torrent file/URL!"
-        if update.effective_message.text:
-            if update.effective_message.text.startswith("magnet:"):
-                torrent = update.effective_message.text
-
-        elif update.effective_message.document:
-            if "torrent" in update.effective_message.document.mime_type:
-                torrent = await (await update.effective_message.document.get_file()).download_as_bytearray()
-
-        if torrent:
-            status, error = self.add_torrent(torrent)
-            if error:
-                message = error
+    async def query_handler_files(self, update, _):
+        query = update.callback_query
+        if not self._files_view:
+            return
+
+        action, _, index = query.data.partition("_")
+        if action == "OK":
+            status, error = self.set_files(self._files_view["id"], self._files_view["changes"])
+            await query.edit_message_text(text=error if error else "👍")
+            self._files_view = None
+            self.remove_callback("FILES")
+            return
+
+        elif not index.isdigit():
+            return
+
+        index = int(index)
+        if action == "P":
+            self._files_view["page"] = index
+
+        elif action in ("W", "R") and index < len(self._files_view["files"]):
+            wanted, priority = self._file_state(index)
+            if action == "W":
+                wanted = not wanted
 
             else:
-                message = "Torrent {state} 👍\n" \
-                          "#*{id}* - `{name}`".format_map(status)
-                markdown = telegram.constants.ParseMode.MARKDOWN
+                priority = (priority + 2) % 3 - 1  # Normal -> High -> Low -> Normal
+
+            stats = self._files_view["stats"][index]
+            if (wanted, priority) == (stats["wanted"], stats["priority"]):
+                self._files_view["changes"].pop(index, None)
+
+            else:
+                self._files_view["changes"][index] = (wanted, priority)
+
+        message, keyboard = self._render_files()
+        await query.edit_message_text(text=message, reply_markup=keyboard,
+                                      parse_mode=telegram.constants.ParseMode.MARKDOWN)
+
+    async def _toggle_selection(self, query):
+        try:
+            torrent_id = int(query.data[2:])
+
+        except ValueError:
+            return
 
-        await update.effective_message.reply_text(message, parse_mode=markdown)
+        if torrent_id in self._selected_torrents:
+            self._selected_torrents.remove(torrent_id)
+
+        elif torrent_id in self.torrents:
+            self._selected_torrents.add(torrent_id)
+
+        _, keyboard = self._render_list()
+        await query.edit_message_reply_markup(reply_markup=keyboard)
+
+    async def _flip_page(self, query):
+        # Pages are rendered from the local torrent table: no RPC here
+        try:
+            self._list_view[3] = int(query.data[2:])
+
+        except ValueError:
+            return
+
+        message, keyboard = self._render_list()
+        await query.edit_message_text(text=message, reply_markup=keyboard,
+                                      parse_mode=telegram.constants.ParseMode.MARKDOWN)
+
+    async def message_handler_add(self, update, _):
+        results = []
+        effective_message = update.effective_message
+        if effective_message.text:
+            results.extend(self.add_torrents(x for x in effective_message.text.split() if x.startswith("magnet:")))
+
+        elif effective_message.document:
+            if "torrent" in (effective_message.document.mime_type or "") \
+                    or (effective_message.document.file_name or "").endswith(".torrent"):
+                results.append(await self.ingest_torrent_file(effective_message.document))
+
+        if effective_message.media_group_id:
+            # Documents sent together arrive as separate messages: wait for the whole group before replying
+            self._add_batch.extend(results)
+            if self._add_batch_job:
+                self._add_batch_job.schedule_removal()
+
+            self._add_batch_job = self.core.application.job_queue.run_once(self._finish_add_batch,
+                                                                           when=ADD_BATCH_TIMEOUT)
+            return
+
+        message, markdown = self._format_added(results)
+        await effective_message.reply_text(message, parse_mode=markdown)
         self.remove_callback("ADD")
 
+    async def _finish_add_batch(self, _):
+        message, markdown = self._format_added(self._add_batch)
+        self.core.send_message(message, markdown=markdown is not None)
+
+        self._add_batch = []
+        self._add_batch_job = None
+        self.remove_callback("ADD")
+
+    async def ingest_torrent_file(self, document):
+        """
+        Add a `.torrent` file sent on Telegram, streaming it to disk instead of keeping it (and its base64 copy)
+        in memory:
+        - with `WatchDir` it's written into Transmission's watch directory (picked up by the daemon);
+        - if the daemon shares the filesystem, its local path is sent to Transmission (`filename`);
+        - otherwise it's downloaded in memory and sent as `metainfo`.
+        """
+        try:
+            telegram_file = await document.get_file()
+            file_name = os.path.basename(document.file_name or "") or telegram_file.file_unique_id + ".torrent"
+            if not file_name.endswith(".torrent"):
+                file_name += ".torrent"
+
+            if self.watch_dir:
+                # `.part` files are ignored by the watch directory until renamed
+                file_path = os.path.join(self.watch_dir, file_name)
+                await telegram_file.download_to_drive(file_path + ".part")
+                os.replace(file_path + ".part", file_path)
+                return {"name": file_name, "state": "watched"}, None
+
+            elif self.shared_filesystem:
+                file_descriptor, file_path = tempfile.mkstemp(suffix=".torrent", dir=self.ingest_dir)
+                os.close(file_descriptor)
+                try:
+                    await telegram_file.download_to_drive(file_path)
+                    os.chmod(file_path, 0o644)  # Readable by the daemon user
+
+                    torrent_info, error = self.add_torrent(file_path)
+                    if error:
+                        # The daemon may not see our filesystem after all (e.g. containers)
+                        module_logger.warning("[Torrent] Unable to add by local path, sending metainfo: %s" % error)
+                        with open(file_path, "rb") as torrent_file:
+                            torrent_info, error = self.add_torrent(torrent_file.read())
+
+                    return torrent_info, error
+
+                finally:
+                    os.remove(file_path)
+
+            return self.add_torrent(await telegram_file.download_as_bytearray())
+
+        except (telegram.error.TelegramError, OSError) as ingest_error:
+            module_logger.error("[Torrent] Ingestion error", exc_info=True)
+            return False, "Error: unable to get the torrent file (%s)" % ingest_error
+
     # Watcher/Updater
     def start_watcher(self):
         self.stop_watcher()
@@ -166,56 +416,241 @@ class ModuleTorrent(RaspOneBaseModule):
             self.stop_watcher()
             return
 
-        torrents, error = self.get_torrent_list()
-        if not error and len(torrents):
-            if len(self._watcher_set):
-                completed = {x["id"] for x in torrents if x["percentDone"] == 1}
-                for completed_id in self._watcher_set.intersection(completed):
-                    completed_torrent = next(x for x in torrents if x["id"] == completed_id)
-                    self.core.send_message("📥 Torrent Completed 🎉\n"
-                                           "#*{id}* - `{name}`".format_map(completed_torrent),
-                                           markdown=True)
-
-                self._watcher_set.clear()
-
-            self._watcher_set.update(x["id"] for x in torrents if x["percentDone"] < 1)
-            if len(self._watcher_set):
-                self.watcher.job.trigger.interval = self.watcher_timer
-                return
+        error = self.sync_torrents()
+        if not error:
+            await self.watch_progress()
+
+        if not error and any(x["percentDone"] < 1 for x in self.torrents.values()):
+            self.watcher.job.trigger.interval = self.watcher_timer
+            return
 
         self.watcher.job.trigger.interval = min(self.watcher.job.trigger.interval + datetime.timedelta(seconds=30),
                                                 datetime.timedelta(minutes=5))
 
-    # RPC API
-    def get_torrent_list(self):
-        rpc_response, err = self.rpc("torrent-get", {"fields": ["id", "name", "totalSize", "error",
-                                                                "errorString", "eta", "percentDone",
-                                                                "status", "totalSize"]})
+    # Torrent table
+    def sync_torrents(self):
+        """
+        Update the local torrent table and notify completed torrents.
+        The table is fully loaded only the first time (or if the last sync is older than the `recently-active`
+        window of Transmission), then only torrents active in the last minute and the removed IDs are requested.
+        """
+        full_sync = self._torrents_synced is None \
+            or time.monotonic() - self._torrents_synced > RECENTLY_ACTIVE_WINDOW
+
+        sync_time = time.monotonic()
+        rpc_response, err = self.rpc("torrent-get", {"fields": TORRENT_FIELDS} if full_sync else
+                                     {"fields": TORRENT_FIELDS, "ids": "recently-active"})
         if err:
-            return False, err
+            return err
 
         elif rpc_response["result"] != "success":
-            return False, "Error: %s result:\n%s" % (rpc_response["result"], json.dumps(rpc_response))
+            return "Error: %s result:\n%s" % (rpc_response["result"], json.dumps(rpc_response))
 
-        return rpc_response["arguments"]["torrents"], None
+        torrents = rpc_response["arguments"]["torrents"]
+        if self._torrents_dirty and not full_sync:
+            # Torrents changed by a command, not necessarily reported as `recently-active`
+            dirty_torrents, err = self.get_torrent(list(self._torrents_dirty))
+            if err:
+                return err
 
-    def get_torrent(self, torrent_id):
-        rpc_response, err = self.rpc("torrent-get", {
-            "fields": ["id", "name", "totalSize", "error",
-                       "errorString", "eta", "percentDone",
-                       "status", "totalSize"],
-            "ids": [int(torrent_id)]
-        })
-        if err:
-            return False, err
+            torrents.extend(dirty_torrents)
 
-        elif rpc_response["result"] != "success":
-            return False, "Error: %s result:\n%s" % (rpc_response["result"], json.dumps(rpc_response))
+        first_sync = self._torrents_synced is None
+        changed = False
+        if full_sync:
+            previous_torrents, self.torrents = self.torrents, dict()
+            changed = len(previous_torrents) != len(torrents)
 
-        return rpc_response["arguments"]["torrents"], None
+        else:
+            previous_torrents = self.torrents
+            for removed_id in rpc_response["arguments"].get("removed", []):
+                changed |= self.torrents.pop(removed_id, None) is not None
+
+        for torrent in torrents:
+            previous_torrent = previous_torrents.get(torrent["id"], None)
+            if not first_sync and torrent["percentDone"] == 1 \
+                    and (previous_torrent is None or previous_torrent["percentDone"] < 1):
+                self._notify_completed(torrent)
+
+            changed |= previous_torrent != torrent
+            self.torrents[torrent["id"]] = torrent
+
+        if changed:
+            self._torrents_version += 1
+
+        self._torrents_dirty.clear()
+        self._torrents_updated = {x["id"] for x in torrents}
+        self._torrents_synced = sync_time
+        return None
+
+    def _notify_completed(self, torrent):
+        self.core.send_message("📥 Torrent Completed 🎉\n"
+                               "#*{id}* - `{name}`".format_map(torrent),
+                               markdown=True)
+
+    # Progress tracking
+    async def watch_progress(self):
+        """
+        Sample the download rate of the downloading torrents, notify milestones and stalls, update the status message.
+        Torrents missing from the last `recently-active` delta had no activity: their rate is sampled as zero.
+        """
+        now = time.monotonic()
+        downloading = [x for x in self.torrents.values() if x["status"] == 4 and x["percentDone"] < 1]
+        downloading_ids = {x["id"] for x in downloading}
+
+        for torrent_id in set(self._rate_history) - downloading_ids:
+            self._rate_history.pop(torrent_id)
+            self._stalled_torrents.discard(torrent_id)
+
+        for torrent_id in set(self._milestones_reached) - set(self.torrents):
+            self._milestones_reached.pop(torrent_id)
+
+        for torrent in downloading:
+            rate = torrent["rateDownload"] if torrent["id"] in self._torrents_updated else 0
+            history = self._rate_history.setdefault(torrent["id"], RateHistory())
+            history.append(now, rate)
+
+            percent = torrent["percentDone"] * 100
+            reached = max((x for x in self.milestones if x <= percent), default=0)
+            if torrent["id"] not in self._milestones_reached:
+                self._milestones_reached[torrent["id"]] = reached  # Milestones already passed are not notified
+
+            elif reached > self._milestones_reached[torrent["id"]]:
+                self._milestones_reached[torrent["id"]] = reached
+                self.core.send_message("📥 Torrent at %d%% 🏁\n" % reached +
+                                       "#*{id}* - `{name}`".format_map(torrent),
+                                       markdown=True)
+
+            if rate:
+                self._stalled_torrents.discard(torrent["id"])
+
+            elif torrent["id"] not in self._stalled_torrents and now - history.last_active >= self.stall_timeout:
+                self._stalled_torrents.add(torrent["id"])
+                self.core.send_message("📥 Torrent Stalled 🐌\n"
+                                       "#*{id}* - `{name}`\n".format_map(torrent) +
+                                       "No download activity for %s" % humanize.naturaldelta(now - history.last_active),
+                                       markdown=True)
+
+        if self.status_message_enabled:
+            await self._update_status_message(downloading, now)
+
+    def estimate_eta(self, torrent):
+        """ETA in seconds based on the local rate history (instead of Transmission's `eta`), None if unknown."""
+        history = self._rate_history.get(torrent["id"], None)
+        mean_rate = history.mean_rate() if history else 0
+        if not mean_rate:
+            return None
+
+        return torrent["leftUntilDone"] / mean_rate
+
+    async def _update_status_message(self, downloading, now):
+        bot = self.core.application.bot
+        markdown = telegram.constants.ParseMode.MARKDOWN
+
+        try:
+            if not len(downloading):
+                if self._status_message:
+                    await self._status_message.edit_text("📥 No active downloads 😴")
+                    await self._status_message.unpin()
+                    self._status_message = self._status_text = None
+
+                return
+
+            status_text = self._render_status(downloading)
+            if not self._status_message:
+                self._status_message = await bot.send_message(self.core.chat_id, status_text, parse_mode=markdown)
+                self._status_text, self._status_edited = status_text, now
+                await self._status_message.pin(disable_notification=True)
+
+            elif status_text != self._status_text and now - self._status_edited >= STATUS_EDIT_INTERVAL:
+                await self._status_message.edit_text(status_text, parse_mode=markdown)
+                self._status_text, self._status_edited = status_text, now
+
+        except telegram.error.TelegramError:
+            module_logger.warning("[Torrent] Unable to update the status message", exc_info=True)
+
+    def _render_status(self, downloading):
+        rows = []
+        for torrent in sorted(downloading, key=lambda x: x["id"]):
+            eta = self.estimate_eta(torrent)
+            rows.append("\n#*{id}* - `{name}`\n".format_map(torrent) +
+                        "%s%% - %s/s - ETA: %s%s\n" % (round(torrent["percentDone"] * 100, 1),
+                                                        humanize.naturalsize(torrent["rateDownload"]
+                                                                             if torrent["id"] in
+                                                                             self._torrents_updated else 0),
+                                                        humanize.naturaldelta(eta) if eta is not None else "N/A",
+                                                        " 🐌" if torrent["id"] in self._stalled_torrents else ""))
+
+        return _fit_rows("📥 Downloads (_updated %s_):\n" % datetime.datetime.now().strftime("%H:%M"), rows)
+
+    # Bandwidth scheduler
+    def start_scheduler(self):
+        self.stop_scheduler()
+        if self.scheduler_enabled:
+            self.scheduler = self.core.application.job_queue.run_repeating(self.schedule_bandwidth,
+                                                                           interval=SCHEDULER_INTERVAL, first=1)
+
+    def stop_scheduler(self):
+        if self.scheduler:
+            self.scheduler.schedule_removal()
+
+        self.scheduler = None
+
+    async def schedule_bandwidth(self, _):
+        limited, self._limited_reasons = self.evaluate_policy()
+
+        # Hysteresis: after a switch, the mode is kept for at least `SCHEDULER_MIN_DWELL` seconds
+        if limited == self._limited or \
+                (self._limited is not None and time.monotonic() - self._limited_changed < SCHEDULER_MIN_DWELL):
+            return
+
+        status, error = self.set_limited(limited)
+        if error:
+            module_logger.warning("[Torrent] Unable to change speed mode: %s" % error)
+            return
+
+        module_logger.info("[Torrent] Speed mode: %s (%s)" % ("limited" if limited else "full",
+                                                             ", ".join(self._limited_reasons) or "no reason"))
+        self._limited = limited
+        self._limited_changed = time.monotonic()
+
+    def evaluate_policy(self):
+        """Return whether the speed should be limited, and the reasons."""
+        reasons = []
 
-    def start_torrent(self, torrent):
-        rpc_response, err = self.rpc("torrent-start", {"ids": [torrent["id"]]})
+        load = os.getloadavg()[0] / (os.cpu_count() or 1)
+        if self._high_load and load <= self.load_low or not self._high_load and load >= self.load_high:
+            self._high_load = not self._high_load
+
+        if self._high_load:
+            reasons.append("system load %.2f" % load)
+
+        vpn_module = self.core.modules["instances"].get("vpn", None)
+        vpn_sessions = vpn_module.count_sessions() if vpn_module else None
+        if vpn_sessions:
+            reasons.append("%d VPN sessions" % vpn_sessions)
+
+        if self.busy_hours:
+            start, end = self.busy_hours
+            now = datetime.datetime.now().time()
+            if (start <= now < end) if start <= end else (now >= start or now < end):
+                reasons.append("busy hours")
+
+        return bool(reasons), reasons
+
+    def set_limited(self, limited):
+        if self.limit_down is None and self.limit_up is None:
+            arguments = {"alt-speed-enabled": limited}
+
+        else:
+            arguments = dict()
+            if self.limit_down is not None:
+                arguments.update({"speed-limit-down-enabled": limited, "speed-limit-down": self.limit_down})
+
+            if self.limit_up is not None:
+                arguments.update({"speed-limit-up-enabled": limited, "speed-limit-up": self.limit_up})
+
+        rpc_response, err = self.rpc("session-set", arguments)
         if err:
             return False, err
 
@@ -224,26 +659,67 @@ class ModuleTorrent(RaspOneBaseModule):
 
         return True, None
 
-    def pause_torrent(self, torrent):
-        rpc_response, err = self.rpc("torrent-stop", {"ids": [torrent["id"]]})
+    @staticmethod
+    def _parse_hours(hours):
+        if hours == "None":
+            return None
+
+        start, end = hours.split("-")
+        return (datetime.datetime.strptime(start.strip(), "%H:%M").time(),
+                datetime.datetime.strptime(end.strip(), "%H:%M").time())
+
+    # RPC API
+    def get_torrent_list(self):
+        error = self.sync_torrents()
+        if error:
+            return False, error
+
+        return sorted(self.torrents.values(), key=lambda x: x["id"]), None
+
+    def get_torrent(self, torrent_ids):
+        rpc_response, err = self.rpc("torrent-get", {
+            "fields": TORRENT_FIELDS,
+            "ids": [int(x) for x in torrent_ids] if isinstance(torrent_ids, (list, set, tuple)) else [int(torrent_ids)]
+        })
         if err:
             return False, err
 
         elif rpc_response["result"] != "success":
             return False, "Error: %s result:\n%s" % (rpc_response["result"], json.dumps(rpc_response))
 
-        return True, None
+        return rpc_response["arguments"]["torrents"], None
+
+    def start_torrents(self, torrent_ids=None):
+        """Start the given torrents, or all the torrents if `torrent_ids` is None (one RPC)."""
+        return self._torrent_action("torrent-start", torrent_ids)
 
-    def remove_torrent(self, torrent):
-        rpc_response, err = self.rpc("torrent-remove", {"ids": [torrent["id"]],
-                                                        "delete-local-data": False
-                                                        if torrent["percentDone"] == 1 else True})
+    def pause_torrents(self, torrent_ids=None):
+        """Stop the given torrents, or all the torrents if `torrent_ids` is None (one RPC)."""
+        return self._torrent_action("torrent-stop", torrent_ids)
+
+    def remove_torrents(self, torrent_ids, delete_local_data=False):
+        status, error = self._torrent_action("torrent-remove", torrent_ids, {"delete-local-data": delete_local_data})
+        if not error:
+            for torrent_id in torrent_ids:
+                self.torrents.pop(torrent_id, None)
+
+            self._torrents_version += 1
+
+        return status, error
+
+    def _torrent_action(self, method, torrent_ids=None, arguments=None):
+        arguments = dict(arguments or {})
+        if torrent_ids is not None:
+            arguments["ids"] = list(torrent_ids)
+
+        rpc_response, err = self.rpc(method, arguments)
         if err:
             return False, err
 
         elif rpc_response["result"] != "success":
             return False, "Error: %s result:\n%s" % (rpc_response["result"], json.dumps(rpc_response))
 
+        self._torrents_dirty.update(self.torrents.keys() if torrent_ids is None else torrent_ids)
         return True, None
 
     def add_torrent(self, torrent_source: Union[str, bytearray]):
@@ -271,6 +747,59 @@ class ModuleTorrent(RaspOneBaseModule):
 
         return torrent_info, None
 
+    def get_torrent_files(self, torrent_id):
+        """Per-file fields are heavy: they are requested only here, for a single torrent, never by the polling."""
+        rpc_response, err = self.rpc("torrent-get", {"fields": ["id", "name", "files", "fileStats"],
+                                                     "ids": [int(torrent_id)]})
+        if err:
+            return False, err
+
+        elif rpc_response["result"] != "success":
+            return False, "Error: %s result:\n%s" % (rpc_response["result"], json.dumps(rpc_response))
+
+        elif not len(rpc_response["arguments"]["torrents"]):
+            return False, "Error: torrent #%s not found!" % torrent_id
+
+        return rpc_response["arguments"]["torrents"][0], None
+
+    def set_files(self, torrent_id, changes):
+        """Apply several file changes (index -> (wanted, priority)) with a single `torrent-set`."""
+        if not len(changes):
+            return True, None
+
+        arguments = {"ids": [torrent_id], "files-wanted": [], "files-unwanted": [],
+                     "priority-high": [], "priority-normal": [], "priority-low": []}
+        for index, (wanted, priority) in sorted(changes.items()):
+            arguments["files-wanted" if wanted else "files-unwanted"].append(index)
+            arguments[FILE_PRIORITY_ARGUMENTS[priority]].append(index)
+
+        return self._torrent_action("torrent-set", [torrent_id],
+                                    {k: v for k, v in arguments.items() if k != "ids" and len(v)})
+
+    def get_session_speed(self):
+        rpc_response, err = self.rpc("session-stats")
+        if err:
+            return False, err
+
+        elif rpc_response["result"] != "success":
+            return False, "Error: %s result:\n%s" % (rpc_response["result"], json.dumps(rpc_response))
+
+        session_stats = rpc_response["arguments"]
+
+        rpc_response, err = self.rpc("session-get", {"fields": SESSION_SPEED_FIELDS})
+        if err:
+            return False, err
+
+        elif rpc_response["result"] != "success":
+            return False, "Error: %s result:\n%s" % (rpc_response["result"], json.dumps(rpc_response))
+
+        session_stats.update(rpc_response["arguments"])
+        return session_stats, None
+
+    def add_torrents(self, torrent_sources):
+        """Add several torrents (one `torrent-add` each, Transmission has no batch add), returning their results."""
+        return [self.add_torrent(torrent_source) for torrent_source in torrent_sources]
+
     def rpc(self, method, arguments=None):
         rpc_req_response, request_id = self.network.curl(self.rpc_url,
                                                          method="post",
@@ -297,38 +826,311 @@ class ModuleTorrent(RaspOneBaseModule):
         return rpc_response, None
 
     # Utils
+    def _render_speed(self):
+        session, error = self.get_session_speed()
+        if error:
+            return False, error
+
+        message = "🚦 Speed:\n" \
+                  "⬇️ %s/s - ⬆️ %s/s (%d active torrents)\n" % (humanize.naturalsize(session["downloadSpeed"]),
+                                                             humanize.naturalsize(session["uploadSpeed"]),
+                                                             session["activeTorrentCount"])
+
+        limits = []
+        if session["alt-speed-enabled"]:
+            limits.append("alt-speed ⬇️ %d kB/s ⬆️ %d kB/s" % (session["alt-speed-down"], session["alt-speed-up"]))
+
+        if session["speed-limit-down-enabled"]:
+            limits.append("⬇️ %d kB/s" % session["speed-limit-down"])
+
+        if session["speed-limit-up-enabled"]:
+            limits.append("⬆️ %d kB/s" % session["speed-limit-up"])
+
+        message += "Limits: %s\n" % (", ".join(limits) if len(limits) else "_none_")
+
+        if not self.scheduler_enabled:
+            message += "Scheduler: _off_"
+
+        else:
+            policy = ["system load over %s (back under %s)" % (self.load_high, self.load_low), "VPN sessions"]
+            if self.busy_hours:
+                policy.append("busy hours %s-%s" % tuple(x.strftime("%H:%M") for x in self.busy_hours))
+
+            message += "Scheduler: *%s*%s\nPolicy: limited on %s" % (
+                "limited" if self._limited else "full speed",
+                " (%s)" % ", ".join(self._limited_reasons) if self._limited_reasons else "",
+                ", ".join(policy)
+            )
+
+        return message, None
+
+    def load_files_view(self, torrent_id):
+        torrent, error = self.get_torrent_files(torrent_id)
+        if error:
+            return error
+
+        self._files_view = {"id": torrent["id"], "name": torrent["name"], "files": torrent["files"],
+                            "stats": torrent["fileStats"], "page": 0, "changes": dict()}
+        return None
+
+    def _file_state(self, index):
+        if index in self._files_view["changes"]:
+            return self._files_view["changes"][index]
+
+        stats = self._files_view["stats"][index]
+        return stats["wanted"], stats["priority"]
+
+    def _render_files(self):
+        view = self._files_view
+        pages_count = max(1, -(-len(view["files"]) // FILES_PAGE_SIZE))
+        page = view["page"] = min(max(view["page"], 0), pages_count - 1)
+        indexes = range(page * FILES_PAGE_SIZE, min((page + 1) * FILES_PAGE_SIZE, len(view["files"])))
+
+        message = "📥 Files of #*{id}* - `{name}`\n".format_map(view)
+        if pages_count > 1:
+            message += "_Page %d/%d - %d files_\n" % (page + 1, pages_count, len(view["files"]))
+
+        rows, keyboard = [], []
+        for index in indexes:
+            file = view["files"][index]
+            wanted, priority = self._file_state(index)
+            name = file["name"] if len(file["name"]) <= 64 else "..." + file["name"][-61:]
+            rows.append("\n%s *%d*. `%s`\n%s - %s%% - Priority: %s\n" % (
+                "✅" if wanted else "⬜", index, name, humanize.naturalsize(file["length"]),
+                round(file["bytesCompleted"] * 100 / file["length"], 1) if file["length"] else 100,
+                FILE_PRIORITY_MAP[priority]
+            ))
+            keyboard.append([telegram.InlineKeyboardButton(("✅ " if wanted else "⬜ ") + str(index),
+                                                           callback_data=f"TORRENT_FILES_W_{index}"),
+                             telegram.InlineKeyboardButton("%s %d" % (FILE_PRIORITY_MAP[priority], index),
+                                                           callback_data=f"TORRENT_FILES_R_{index}")])
+
+        if pages_count > 1:
+            navigation = []
+            if page > 0:
+                navigation.append(telegram.InlineKeyboardButton("◀️ Prev", callback_data=f"TORRENT_FILES_P_{page - 1}"))
+
+            if page < pages_count - 1:
+                navigation.append(telegram.InlineKeyboardButton("Next ▶️", callback_data=f"TORRENT_FILES_P_{page + 1}"))
+
+            keyboard.append(navigation)
+
+        keyboard.append([telegram.InlineKeyboardButton("💾 Apply %d changes" % len(view["changes"]),
+                                                       callback_data="TORRENT_FILES_OK")])
+
+        return _fit_rows(message, rows), telegram.InlineKeyboardMarkup(keyboard)
+
     @staticmethod
-    def _list_torrents(torrents):
-        torrent_list_msg = ""
+    def _format_added(results):
+        if not len(results):
+            return "Error: invalid torrent file/URL!", None
+
+        messages = []
+        for torrent_info, error in results:
+            if error:
+                messages.append(error)
+
+            elif torrent_info["state"] == "watched":
+                messages.append("Torrent queued on the watch directory 👍\n`{name}`".format_map(torrent_info))
+
+            else:
+                messages.append("Torrent {state} 👍\n#*{id}* - `{name}`".format_map(torrent_info))
+
+        # Error messages are not markdown-safe
+        markdown = None if any(error for _, error in results) else telegram.constants.ParseMode.MARKDOWN
+        return "\n\n".join(messages), markdown
+
+    def _render_list(self):
+        """Render the current list view (message and keyboard), only the requested page is rendered."""
+        tag, sort, torrent_filter, page = self._list_view
+        if self._list_cache["version"] != self._torrents_version:
+            self._list_cache = {"version": self._torrents_version, "views": dict(), "pages": dict()}
+            self._rendered_torrents = {k: v for k, v in self._rendered_torrents.items() if k in self.torrents}
+
+        view_key = (sort, torrent_filter)
+        if view_key not in self._list_cache["views"]:
+            sort_key, reverse = SORT_KEYS[sort]
+            self._list_cache["views"][view_key] = [
+                x["id"] for x in sorted(filter(FILTERS[torrent_filter], self.torrents.values()),
+                                        key=sort_key, reverse=reverse)
+            ]
+
+        torrent_ids = self._list_cache["views"][view_key]
+        pages_count = max(1, -(-len(torrent_ids) // LIST_PAGE_SIZE))
+        page = self._list_view[3] = min(max(page, 0), pages_count - 1)
+        page_ids = torrent_ids[page * LIST_PAGE_SIZE:(page + 1) * LIST_PAGE_SIZE]
+
+        if (view_key, page) not in self._list_cache["pages"]:
+            self._list_cache["pages"][(view_key, page)] = self._list_torrents([self.torrents[x] for x in page_ids])
+
+        message = LIST_HEADERS[tag] + "\n"
+        if pages_count > 1:
+            message += "_Page %d/%d - %d torrents_\n" % (page + 1, pages_count, len(torrent_ids))
+
+        message = _fit_rows(message, self._list_cache["pages"][(view_key, page)])
+
+        keyboard = None
+        if tag != "LIST" and len(self.torrents) or pages_count > 1:
+            keyboard = self._prepare_keyboard(tag, [self.torrents[x] for x in page_ids], self._selected_torrents,
+                                              page, pages_count)
+
+        return message, keyboard
+
+    def _list_torrents(self, torrents):
         if not len(torrents):
-            torrent_list_msg = "_Empty_"
+            return ["_Empty_"]
 
-        for torrent in torrents:
-            torrent_list_msg += "\n"
-            torrent_list_msg += "#*{id}* - `{name}`\n".format_map(torrent)
-            torrent_list_msg += "Status: %s\n" % STATUS_MAP[torrent["status"]]
-            torrent_list_msg += "ETA: %s - " % \
-                                (humanize.naturaltime(torrent['eta'], future=True)
-                                 if torrent['eta'] > 0 else torrent['eta'])
-            torrent_list_msg += "Percent: %s%%\n" % round(torrent["percentDone"] * 100, 2)
-            torrent_list_msg += "Size: %s\n" % humanize.naturalsize(torrent["totalSize"])
+        return [self._render_torrent(torrent) for torrent in torrents]
+
+    def _render_torrent(self, torrent):
+        # Rendered entries are reused while the torrent is unchanged
+        cached = self._rendered_torrents.get(torrent["id"], None)
+        if cached and cached[0] == torrent:
+            return cached[1]
 
-            if torrent["error"]:
-                torrent_list_msg += "**ERROR**: _{errorString}_\n".format_map(torrent)
+        torrent_msg = "\n" + \
+                      "#*{id}* - `{name}`\n".format_map(torrent) + \
+                      "Status: %s\n" % STATUS_MAP[torrent["status"]] + \
+                      "ETA: %s - " % (humanize.naturaltime(torrent['eta'], future=True)
+                                      if torrent['eta'] > 0 else torrent['eta']) + \
+                      "Percent: %s%%\n" % round(torrent["percentDone"] * 100, 2) + \
+                      "Size: %s - Ratio: %s\n" % (humanize.naturalsize(torrent["totalSize"]),
+                                                  RATIO_SENTINELS.get(torrent["uploadRatio"],
+                                                                      round(torrent["uploadRatio"], 2)))
 
-        return torrent_list_msg
+        if torrent["error"]:
+            torrent_msg += "**ERROR**: _{errorString}_\n".format_map(torrent)
+
+        self._rendered_torrents[torrent["id"]] = (torrent, torrent_msg)
+        return torrent_msg
 
     @staticmethod
-    def _prepare_keyboard(tag, torrents):
-        torrent_list = []
-        for torrent in torrents:
-            torrent_list.append(telegram.InlineKeyboardButton(str(torrent["id"]),
-                                                              callback_data=f"TORRENT_{tag}_{torrent['id']}"))
+    def _prepare_keyboard(tag, torrents, selected=frozenset(), page=0, pages_count=1):
+        keyboard = []
+        if tag != "LIST":
+            torrent_list = []
+            for torrent in torrents:
+                torrent_list.append(telegram.InlineKeyboardButton(("✅ " if torrent["id"] in selected else "") +
+                                                                  str(torrent["id"]),
+                                                                  callback_data=f"TORRENT_{tag}_T_{torrent['id']}"))
+
+            keyboard = [torrent_list[i * 2:(i + 1) * 2] for i in range((len(torrent_list) + 2 - 1) // 2)]
+
+        if pages_count > 1:
+            navigation = []
+            if page > 0:
+                navigation.append(telegram.InlineKeyboardButton("◀️ Prev", callback_data=f"TORRENT_{tag}_P_{page - 1}"))
+
+            if page < pages_count - 1:
+                navigation.append(telegram.InlineKeyboardButton("Next ▶️", callback_data=f"TORRENT_{tag}_P_{page + 1}"))
+
+            keyboard.append(navigation)
+
+        if tag == "LIST":
+            return telegram.InlineKeyboardMarkup(keyboard)
+
+        elif tag == "PAUSE":
+            keyboard.append([telegram.InlineKeyboardButton("⏸ Pause all", callback_data=f"TORRENT_{tag}_ALL_STOP"),
+                             telegram.InlineKeyboardButton("▶️ Resume all", callback_data=f"TORRENT_{tag}_ALL_START")])
+
+        else:
+            keyboard.append([telegram.InlineKeyboardButton("🧹 Remove completed",
+                                                           callback_data=f"TORRENT_{tag}_COMPLETED")])
+
+        keyboard.append([telegram.InlineKeyboardButton("👍 Confirm selected", callback_data=f"TORRENT_{tag}_OK")])
+        return telegram.InlineKeyboardMarkup(keyboard)
+
+
+class RateHistory(SampleRing):
+    """The last `size` (timestamp, download rate) samples of a torrent, and the time of its last activity."""
+
+    __slots__ = ("last_active",)
 
-        return telegram.InlineKeyboardMarkup(
-            [torrent_list[i * 2:(i + 1) * 2] for i in range((len(torrent_list) + 2 - 1) // 2)]
-        )
+    def __init__(self, size=None):
+        super().__init__(size or RATE_HISTORY_SIZE, 1)
+        self.last_active = None
 
+    def append(self, timestamp, rate):
+        super().append(timestamp, (rate,))
+        if rate or self.last_active is None:
+            self.last_active = timestamp
+
+    def mean_rate(self):
+        return self.mean()[0] if self.count else 0
+
+
+def _fit_rows(header, rows):
+    """`header` and the `rows` fitting in a message: rows are dropped whole, a cut row could break its Markdown."""
+    limit = telegram.constants.MessageLimit.MAX_TEXT_LENGTH - TRIMMED_ROWS_RESERVE
+    message = header
+    for shown, row in enumerate(rows):
+        if len(message) + len(row) > limit:
+            return message + "\n_...and %d more_" % (len(rows) - shown)
+
+        message += row
+
+    return message
+
+
+TORRENT_FIELDS = ["id", "name", "totalSize", "error", "errorString", "eta", "percentDone", "status", "uploadRatio",
+                  "rateDownload", "leftUntilDone"]
+
+RECENTLY_ACTIVE_WINDOW = 55  # seconds, Transmission considers `recently-active` the last 60 seconds
+
+LIST_PAGE_SIZE = 10
+
+RATE_HISTORY_SIZE = 40  # samples, 10 minutes at the watcher interval
+
+STATUS_EDIT_INTERVAL = 60  # seconds between two edits of the status message
+
+ADD_BATCH_TIMEOUT = 3  # seconds to wait for the other files of a group
+
+FILES_PAGE_SIZE = 8
+
+SCHEDULER_INTERVAL = 60  # seconds
+
+SCHEDULER_MIN_DWELL = 300  # seconds, minimum time between two speed mode switches
+
+SESSION_SPEED_FIELDS = ["alt-speed-enabled", "alt-speed-down", "alt-speed-up", "speed-limit-down-enabled",
+                        "speed-limit-down", "speed-limit-up-enabled", "speed-limit-up"]
+
+FILE_PRIORITY_MAP = {
+    -1: "⬇️ Low",
+    0: "➖ Normal",
+    1: "⬆️ High"
+}
+
+FILE_PRIORITY_ARGUMENTS = {
+    -1: "priority-low",
+    0: "priority-normal",
+    1: "priority-high"
+}
+
+LIST_HEADERS = {
+    "LIST": "📥 Torrents:",
+    "PAUSE": "📥 Which torrent do you want to pause/resume?",
+    "REMOVE": "📥 Which torrent do you want to *remove*?"
+}
+
+SORT_KEYS = {  # name: (key, reverse)
+    "id": (lambda x: x["id"], False),
+    "name": (lambda x: x["name"].lower(), False),
+    "size": (lambda x: x["totalSize"], True),
+    "progress": (lambda x: x["percentDone"], True),
+    "ratio": (lambda x: x["uploadRatio"] if x["uploadRatio"] != -2 else math.inf, True)
+}
+
+RATIO_SENTINELS = {-1: "-", -2: "∞"}  # Transmission's `TR_RATIO_NA` and `TR_RATIO_INF`
+
+TRIMMED_ROWS_RESERVE = 32  # characters kept for the "...and N more" line
+
+FILTERS = {
+    "all": lambda x: True,
+    "downloading": lambda x: x["status"] in (3, 4),
+    "seeding": lambda x: x["status"] in (5, 6),
+    "stopped": lambda x: x["status"] == 0,
+    "errors": lambda x: x["error"] != 0
+}
 
 STATUS_MAP = {
     0: "Stopped",
@@ -1,10 +1,20 @@
 import re
 import os
+import io
+import time
+import asyncio
 import logging
+import zipfile
+import humanize
 import telegram
+from datetime import datetime
+
+from telegram.helpers import escape_markdown
 
 from modules import RaspOneBaseModule
 from src import config, UTILS_PATH, DEFAULT_NAME
+from src.geoip import get_geoip
+from src.ring import SampleRing
 
 module_logger = logging.getLogger(DEFAULT_NAME + ".module.vpn")
 
@@ -17,7 +27,10 @@ class ModuleVPN(RaspOneBaseModule):
     USAGE = {
         "status": "Check if `openvpn` is running",
         "client": "Return the `.ovpn` profile file\n"
-                  "_More_: `/vpn client <profile>`"
+                  "_More_: `/vpn client <profile>`",
+        "export": "Return all the `.ovpn` profiles in a zip file",
+        "clients": "List the connected clients (management interface)",
+        "traffic": "Show the traffic of the clients (management interface)"
     }
 
     def __init__(self, core):
@@ -26,12 +39,56 @@ class ModuleVPN(RaspOneBaseModule):
         self.profiles_path = config["Module - VPN"]["VPNProfilesPath"]
         self.regex_remote_host = re.compile(r"(?<=remote )[\w.]+")
 
-    def alert(self, message):
+        # Rendered profiles (path -> (mtime, IP, profile)) and zip of all of them, rendered again only when the
+        # file or the public IP change
+        self.profiles = dict()
+        self._export = (None, None)
+
+        self.status_file = config["Module - VPN"].get("StatusFile", "/var/log/openvpn-status.log")
+
+        # Management interface: one persistent connection receiving the `>CLIENT:` notifications, `status` is polled
+        # every `traffic_interval` seconds to keep the clients list and their traffic history
+        self.management = None
+        self.management_client_auth = config["Module - VPN"].get("ManagementClientAuth", "False") != "False"
+        self.traffic_interval = int(config["Module - VPN"].get("TrafficInterval", "30"))
+        self.clients = dict()  # client ID -> client (last `status`)
+        self.clients_refreshed = None
+        self.traffic = dict()  # client ID -> TrafficHistory
+        self.traffic_totals = dict()  # common name -> [received, sent] of the sessions ended
+        self.traffic_since = datetime.now()
+        self._management_tasks = set()
+        self._status_job = None
+
+        # Offline location of the clients real IP (see `[GeoIP]`)
+        self.geoip = get_geoip()
+
+        if config["Module - VPN"].get("Management", "None") != "None":
+            password = config["Module - VPN"].get("ManagementPassword", "None")
+            self.management = ManagementClient(config["Module - VPN"]["Management"],
+                                               password if password != "None" else None,
+                                               self._management_notification)
+            self.core.application.job_queue.run_once(self.start_management, when=1)
+
+    def alert(self, message, ip=None):
+        """
+        `ip`: real IP of the client (else found in the hook message), located: denied locations are highlighted,
+        allowed ones are sent without notification.
+        """
         if not message or not len(message):
             return False
 
         module_logger.info("VPN Alert: %s" % message.encode("unicode_escape").decode("utf-8"))
-        return self.core.send_message("🚨 VPN Alert 🚨:\n%s" % message)
+
+        if ip is None:
+            match = HOOK_IP.search(message)
+            ip = match.group(1) if match else None
+
+        location, severity = self.geoip.annotate(ip)
+        message = "🚨 VPN Alert 🚨%s:\n%s" % (" ⛔️ *Denied location*" if severity == "deny" else "", message)
+        if location:
+            message += "\n🌍 " + escape_markdown(location)
+
+        return self.core.send_message(message, silent=severity == "allow")
 
     async def command(self, update, context):
         message = ""
@@ -58,22 +115,231 @@ class ModuleVPN(RaspOneBaseModule):
                     if os.path.commonpath((self.profiles_path, profile_path)) != os.path.dirname(self.profiles_path):
                         raise OSError("invalid path: " + profile_path)
 
-                with open(profile_path, "r") as profile_file:
-                    profile_file_str = profile_file.read()
-                    ip, err = self.core.modules["instances"]["ip"].get_ip_address()
-                    if not err:
-                        profile_file_str = self.regex_remote_host.sub(ip, profile_file_str)
+                await self._warm_up_ip()
+                await update.effective_message.reply_document(document=self.get_profile(profile_path),
+                                                              filename=os.path.basename(profile_path))
+                return
+
+            except OSError as os_error:
+                message = "Error opening the client file: %s" % os_error
+                markdown = None
+
+        elif context.args[0] in ["clients", "traffic"]:
+            if not self.management:
+                message = "management interface not configured, see `Management` on `rasp_conf.ini`"
 
-                    await update.effective_message.reply_document(document=profile_file_str.encode(),
-                                                                  filename=os.path.basename(profile_path))
+            elif self.clients_refreshed is None:
+                message = "management interface not connected (yet)"
+
+            else:
+                message = self._render_clients() if context.args[0] == "clients" else self._render_traffic()
+
+        elif context.args[0] == "export":
+            try:
+                await self._warm_up_ip()
+                profiles_zip, profiles_count = await asyncio.to_thread(self.export_profiles)
+                if profiles_count:
+                    await update.effective_message.reply_document(document=profiles_zip, filename="vpn_profiles.zip")
                     return
 
+                message = "No `.ovpn` profile found"
+
             except OSError as os_error:
-                message = "Error opening the client file: %s" % os_error
+                message = "Error exporting the client files: %s" % os_error
                 markdown = None
 
         await update.effective_message.reply_text("VPN: " + message, parse_mode=markdown)
 
+    def get_profile(self, profile_path):
+        """Profile with the `remote` host set to the public IP, read again only if the file or the IP changed."""
+        mtime = os.stat(profile_path).st_mtime_ns
+        ip, _ = self.core.modules["instances"]["ip"].get_cached_ip()
+
+        cached = self.profiles.get(profile_path, None)
+        if cached and cached[:2] == (mtime, ip):
+            return cached[2]
+
+        with open(profile_path, "r") as profile_file:
+            profile_file_str = profile_file.read()
+
+        if ip:
+            profile_file_str = self.regex_remote_host.sub(ip, profile_file_str)
+
+        self.profiles[profile_path] = (mtime, ip, profile_file_str.encode())
+        return self.profiles[profile_path][2]
+
+    def export_profiles(self):
+        """Zip of all the profiles (and their count), built again only if a profile was added, removed or rendered."""
+        profiles = [(file_name, self.get_profile(os.path.join(self.profiles_path, file_name)))
+                    for file_name in sorted(os.listdir(self.profiles_path)) if file_name.endswith(".ovpn")]
+
+        export_key = tuple((file_name, self.profiles[os.path.join(self.profiles_path, file_name)][:2])
+                           for file_name, _ in profiles)
+        if self._export[0] != export_key:
+            zip_buffer = io.BytesIO()
+            with zipfile.ZipFile(zip_buffer, "w", compression=zipfile.ZIP_DEFLATED) as profiles_zip:
+                for file_name, profile in profiles:
+                    profiles_zip.writestr(file_name, profile)
+
+            self._export = (export_key, zip_buffer.getvalue())
+
+        return self._export[1], len(profiles)
+
+    async def _warm_up_ip(self):
+        # The public IP is usually cached by the IP module monitor, else it is looked up once here
+        ip_module = self.core.modules["instances"]["ip"]
+        ip, _ = ip_module.get_cached_ip()
+        if not ip:
+            await asyncio.to_thread(ip_module.get_ip_address)
+
+    def count_sessions(self):
+        """
+        Number of connected clients, from the management interface if connected, else read from OpenVPN's `status`
+        file (any version), None if not available.
+        """
+        if self.management and self.management.connected and self.clients_refreshed is not None \
+                and time.monotonic() - self.clients_refreshed < 2 * self.traffic_interval:
+            return len(self.clients)
+
+        try:
+            with open(self.status_file, "r") as status_file:
+                sessions = 0
+                client_list = False
+                for line in status_file:
+                    if line.startswith("CLIENT_LIST"):  # status-version 2 and 3
+                        sessions += 1
+
+                    elif line.startswith("Common Name,"):  # status-version 1
+                        client_list = True
+
+                    elif line.startswith("ROUTING TABLE"):
+                        client_list = False
+
+                    elif client_list and len(line.strip()):
+                        sessions += 1
+
+                return sessions
+
+        except OSError:
+            return None
+
+    # Management interface
+    async def start_management(self, _):
+        self._management_tasks.add(self.core.application.create_task(self.management.run()))
+        self._status_job = self.core.application.job_queue.run_repeating(self.poll_status,
+                                                                         interval=self.traffic_interval, first=1)
+
+    def kill(self):
+        # OpenVPN serves one management client at a time: a reloaded module must release the connection
+        for task in list(self._management_tasks):
+            task.cancel()
+
+        if self.management:
+            self.management.close()
+
+        if self._status_job:
+            self._status_job.schedule_removal()
+            self._status_job = None
+
+    async def poll_status(self, _):
+        if not self.management.connected:
+            return
+
+        clients, error = await self.management.status()
+        if error:
+            module_logger.warning("[VPN] Management `status` error: %s" % error)
+            return
+
+        now = time.time()
+        clients = {client["id"]: client for client in clients}
+        for client_id, client in clients.items():
+            if client_id not in self.traffic:
+                self.traffic[client_id] = TrafficHistory()
+
+            self.traffic[client_id].append(now, client["received"], client["sent"])
+
+        # Sessions ended: their traffic is added to the totals of the common name
+        for client_id in set(self.traffic) - set(clients):
+            history = self.traffic.pop(client_id)
+            name = self.clients[client_id]["name"] if client_id in self.clients else client_id
+            totals = self.traffic_totals.setdefault(name, [0, 0])
+            totals[0] += history.last()[0]
+            totals[1] += history.last()[1]
+
+        self.clients = clients
+        self.clients_refreshed = time.monotonic()
+
+    def _management_notification(self, kind, args, env):
+        if kind != "CLIENT":
+            return
+
+        event = args[0]
+        if event in ("CONNECT", "REAUTH") and self.management_client_auth and len(args) > 2:
+            # `management-client-auth`: the clients, already authenticated by OpenVPN, must be approved here
+            task = asyncio.get_running_loop().create_task(
+                self.management.command("client-auth-nt %s %s" % (args[1], args[2])))
+            self._management_tasks.add(task)
+            task.add_done_callback(self._management_tasks.discard)
+
+        elif event == "ESTABLISHED":
+            real_ip = env.get("trusted_ip", env.get("untrusted_ip", None))
+            self.alert("Client connected: *%s*\nReal IP: `%s`\nVirtual IP: `%s`" % (
+                escape_markdown(env.get("common_name", "?")), real_ip or "?",
+                env.get("ifconfig_pool_remote_ip", "?")), ip=real_ip)
+
+        elif event == "DISCONNECT":
+            self.alert("Client disconnected: *%s*\nSession duration: %s\nTraffic: %s received, %s sent" % (
+                escape_markdown(env.get("common_name", "?")),
+                humanize.precisedelta(int(env.get("time_duration", 0) or 0)),
+                humanize.naturalsize(int(env.get("bytes_received", 0) or 0)),
+                humanize.naturalsize(int(env.get("bytes_sent", 0) or 0))))
+
+    def _render_clients(self):
+        if not self.clients:
+            return "no client connected"
+
+        message = "%d client%s connected\n" % (len(self.clients), "s" if len(self.clients) > 1 else "")
+        for client_id, client in sorted(self.clients.items(), key=lambda x: x[1]["name"]):
+            received_rate, sent_rate = self.traffic[client_id].rates() if client_id in self.traffic else (0, 0)
+            message += "• *%s* from `%s` (`%s`), connected %s\n" \
+                       "  %s received (%s/s), %s sent (%s/s)\n" % (
+                           escape_markdown(client["name"]), client["real"], client["virtual"],
+                           humanize.naturaltime(datetime.now() - datetime.fromtimestamp(client["since"]))
+                           if client["since"] else "?",
+                           humanize.naturalsize(client["received"]), humanize.naturalsize(received_rate),
+                           humanize.naturalsize(client["sent"]), humanize.naturalsize(sent_rate))
+
+        return message
+
+    def _render_traffic(self):
+        # Per common name: sessions ended since startup plus the ones in progress
+        traffic = {name: list(totals) + [0, 0] for name, totals in self.traffic_totals.items()}
+        for client_id, client in self.clients.items():
+            received_rate, sent_rate = self.traffic[client_id].rates() if client_id in self.traffic else (0, 0)
+            name_traffic = traffic.setdefault(client["name"], [0, 0, 0, 0])
+            name_traffic[0] += client["received"]
+            name_traffic[1] += client["sent"]
+            name_traffic[2] += received_rate
+            name_traffic[3] += sent_rate
+
+        message = "traffic since %s\n" % humanize.naturaltime(datetime.now() - self.traffic_since)
+        if not traffic:
+            return message + "_Empty_"
+
+        for name, (received, sent, received_rate, sent_rate) in sorted(traffic.items(),
+                                                                        key=lambda x: -(x[1][0] + x[1][1])):
+            message += "• *%s*: %s received, %s sent" % (escape_markdown(name), humanize.naturalsize(received),
+                                                         humanize.naturalsize(sent))
+            if received_rate or sent_rate:
+                message += " (recently %s/s in, %s/s out)" % (humanize.naturalsize(received_rate),
+                                                        humanize.naturalsize(sent_rate))
+
+            message += "\n"
+
+        message += "Total: %s received, %s sent" % (humanize.naturalsize(sum(x[0] for x in traffic.values())),
+                                                    humanize.naturalsize(sum(x[1] for x in traffic.values())))
+        return message
+
     @staticmethod
     def _build_utils():
         with open(os.path.join(UTILS_PATH, "rasp_vpn_alert.sh"), "w") as script:
@@ -83,6 +349,215 @@ class ModuleVPN(RaspOneBaseModule):
         module_logger.warning("** THIS MODULE REQUIRE YOUR ATTENTION, SEE LOGS AND utils/ DIRECTORY **")
 
 
+class ManagementClient:
+    """
+    Async client of the OpenVPN management interface, over TCP (`host:port`) or a Unix socket (path).
+    It reconnects by itself; real-time notifications (`>CLIENT:`, `>INFO:`, ...) are passed to
+    `on_notification(kind, args, env)`, with `env` the `>CLIENT:ENV` block (if any).
+    """
+
+    def __init__(self, address, password=None, on_notification=None):
+        self.address = address
+        self.password = password
+        self.on_notification = on_notification
+
+        self.reader = self.writer = None
+        self.connected = False
+        self.closed = False
+        self._command_lock = asyncio.Lock()
+        self._response = None  # (future, multi-line, lines) of the command waiting its response
+        self._client_event = None  # (args, env) of the `>CLIENT:` notification waiting its `ENV` block
+
+    async def run(self):
+        delay = MANAGEMENT_RECONNECT_MIN
+        while not self.closed:
+            try:
+                if self.address.startswith("/"):
+                    self.reader, self.writer = await asyncio.open_unix_connection(self.address)
+
+                else:
+                    host, port = self.address.rsplit(":", 1)
+                    self.reader, self.writer = await asyncio.open_connection(host, int(port))
+
+                if self.password:
+                    self.writer.write(self.password.encode() + b"\n")
+
+                self.connected = True
+                delay = MANAGEMENT_RECONNECT_MIN
+                module_logger.info("[VPN] Connected to the management interface %s" % self.address)
+                await self._read_loop()
+
+            except (OSError, ValueError, EOFError) as error:
+                module_logger.warning("[VPN] Management interface %s: %s" % (self.address, error))
+
+            finally:
+                self._disconnect()
+
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, MANAGEMENT_RECONNECT_MAX)
+
+    def close(self):
+        """Disconnect, without reconnecting."""
+        self.closed = True
+        self._disconnect()
+
+    def _disconnect(self):
+        self.connected = False
+        if self.writer:
+            self.writer.close()
+
+        self.reader = self.writer = None
+        self._client_event = None
+        if self._response and not self._response[0].done():
+            self._response[0].set_exception(ConnectionResetError("management interface disconnected"))
+
+    async def _read_loop(self):
+        while True:
+            line = await self.reader.readline()
+            if not line:
+                raise EOFError("connection closed")
+
+            line = line.decode(errors="replace").rstrip("\r\n")
+            if line.startswith("ENTER PASSWORD:"):  # The prompt has no line ending
+                line = line[len("ENTER PASSWORD:"):]
+
+            if line.startswith(">"):
+                self._notification(line[1:])
+
+            elif self._response:
+                future, multiline, lines = self._response
+                if future.done():
+                    continue
+
+                if line.startswith("ERROR:") or not multiline:
+                    future.set_result([line])
+
+                elif line == "END":
+                    future.set_result(lines)
+
+                else:
+                    lines.append(line)
+
+    def _notification(self, notification):
+        kind, _, args = notification.partition(":")
+        args = args.split(",")
+
+        if kind == "CLIENT" and args[0] == "ENV":
+            if not self._client_event:
+                return
+
+            if args[1] == "END":
+                (event_args, env), self._client_event = self._client_event, None
+                self._dispatch(kind, event_args, env)
+
+            else:
+                name, _, value = ",".join(args[1:]).partition("=")
+                self._client_event[1][name] = value
+
+        elif kind == "CLIENT" and args[0] != "ADDRESS":  # Followed by its `ENV` block
+            self._client_event = (args, dict())
+
+        else:
+            self._dispatch(kind, args, None)
+
+    def _dispatch(self, kind, args, env):
+        if self.on_notification:
+            try:
+                self.on_notification(kind, args, env)
+
+            except Exception:
+                module_logger.error("[VPN] Error handling the notification %s %s" % (kind, args), exc_info=True)
+
+    async def command(self, command, multiline=False):
+        """Send `command`, return its response lines (`multiline`: until `END`)."""
+        async with self._command_lock:
+            if not self.connected:
+                return None, "management interface not connected"
+
+            future = asyncio.get_running_loop().create_future()
+            self._response = (future, multiline, [])
+            try:
+                self.writer.write(command.encode() + b"\n")
+                await self.writer.drain()
+                lines = await asyncio.wait_for(future, MANAGEMENT_COMMAND_TIMEOUT)
+
+            except (OSError, asyncio.TimeoutError) as error:
+                return None, str(error) or "no response to `%s`" % command
+
+            finally:
+                self._response = None
+
+            if lines and lines[0].startswith("ERROR:"):
+                return None, lines[0]
+
+            return lines, None
+
+    async def status(self):
+        """Connected clients, parsed from `status 3` (tab separated, columns named by its `HEADER` line)."""
+        lines, error = await self.command("status 3", multiline=True)
+        if error:
+            return None, error
+
+        columns, clients = None, []
+        for line in lines:
+            fields = line.split("\t")
+            if fields[:2] == ["HEADER", "CLIENT_LIST"]:
+                columns = fields[2:]
+
+            elif fields[0] == "CLIENT_LIST" and columns:
+                client = dict(zip(columns, fields[1:]))
+                clients.append({
+                    "id": client.get("Client ID", None) or "%s@%s" % (client.get("Common Name", ""),
+                                                                     client.get("Real Address", "")),
+                    "name": client.get("Common Name", "?"),
+                    "real": client.get("Real Address", "?"),
+                    "virtual": client.get("Virtual Address", "") or client.get("Virtual IPv6 Address", "?"),
+                    "received": int(client.get("Bytes Received", 0) or 0),
+                    "sent": int(client.get("Bytes Sent", 0) or 0),
+                    "since": int(client.get("Connected Since (time_t)", 0) or 0)
+                })
+
+        return clients, None
+
+
+class TrafficHistory(SampleRing):
+    """The last `size` (timestamp, bytes received, bytes sent) samples of a client."""
+
+    __slots__ = ()
+
+    def __init__(self, size=None):
+        super().__init__(size or TRAFFIC_HISTORY_SIZE, 2)
+
+    def append(self, timestamp, received, sent):
+        super().append(timestamp, (received, sent))
+
+    def last(self):
+        return tuple(int(x) for x in super().last()) if self.count else (0, 0)
+
+    def rates(self):
+        """Mean (received, sent) bytes per second over the samples kept."""
+        if self.count < 2:
+            return 0, 0
+
+        (first_time, first), (last_time, last) = self.sample(self.count - 1), self.sample(0)
+        elapsed = last_time - first_time
+        if elapsed <= 0:
+            return 0, 0
+
+        return tuple(max(x - y, 0) / elapsed for x, y in zip(last, first))
+
+
+TRAFFIC_HISTORY_SIZE = 20  # samples, 10 minutes at the default interval
+
+MANAGEMENT_COMMAND_TIMEOUT = 10  # seconds
+
+MANAGEMENT_RECONNECT_MIN = 5  # seconds, doubled after each failure
+
+MANAGEMENT_RECONNECT_MAX = 300  # seconds
+
+# Real IP of the client in the messages of `SCRIPT_TEMPLATE`
+HOOK_IP = re.compile(r"(?:Trusted IP|\*Untrusted IP\*): '`([^`]+)`'")
+
 SCRIPT_TEMPLATE = """#!/bin/bash
 
 # OpenVPN Alert module
@@ -6,16 +6,20 @@ DEFAULT_NAME = "raspOne"
 BASE_PATH = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))  # '/src/../'
 LOGS_PATH = os.path.join(BASE_PATH, "logs/")
 UTILS_PATH = os.path.join(BASE_PATH, "utils/")
+DATA_PATH = os.path.join(BASE_PATH, "data/")
 MODULES_PATH = os.path.join(BASE_PATH, "modules")
 PERSONAL_MODULES_PATH = os.path.join(BASE_PATH, "personal_modules")
 
-# Create logs/ and utils/ dirs
+# Create logs/, utils/ and data/ (modules state) dirs
 if not os.path.isdir(LOGS_PATH):
     os.mkdir(LOGS_PATH)
 
 if not os.path.isdir(UTILS_PATH):
     os.mkdir(UTILS_PATH)
 
+if not os.path.isdir(DATA_PATH):
+    os.mkdir(DATA_PATH)
+
 # Parse config
 config = configparser.ConfigParser()
 
@@ -1,9 +1,11 @@
 import sys
 import asyncio
 import pkgutil
+import secrets
 import logging
 import importlib
 import traceback
+import cachetools
 
 import telegram
 import telegram.ext
@@ -45,6 +47,9 @@ class RaspOne:
             "callbacks": dict()
         }
 
+        # Short opaque tokens -> payloads, for `callback_data` (limited to 64 bytes by Telegram)
+        self.callback_tokens = cachetools.TTLCache(maxsize=CALLBACK_TOKENS_SIZE, ttl=CALLBACK_TOKENS_TTL)
+
     def start(self, restart=False):
         if restart:
             self.log(logging.WARNING, "Restarting...")
@@ -169,6 +174,22 @@ class RaspOne:
         for callback_name in list(self.modules["callbacks"].keys()):
             self.remove_callback(callback_name)
 
+    # Callback Tokens
+    def register_callback_token(self, payload):
+        """
+        Store `payload` (any object) and return a short token (8 hex chars) to be used in a button `callback_data`.
+        Tokens expire after `CALLBACK_TOKENS_TTL` seconds, the oldest ones are dropped past `CALLBACK_TOKENS_SIZE`.
+        """
+        token = secrets.token_hex(4)
+        while token in self.callback_tokens:
+            token = secrets.token_hex(4)
+
+        self.callback_tokens[token] = payload
+        return token
+
+    def get_callback_token(self, token, default=None):
+        return self.callback_tokens.get(token, default)
+
     # Handler Wrapper and Decorator
     @staticmethod
     def wrap_handler(callback_tag, func):
@@ -222,7 +243,11 @@ class RaspOne:
 
         module_logger.log(lvl, "[R1] " + msg, *args, **kwargs)
 
-    def send_message(self, message: str, log=True, markdown=True):
+    def send_message(self, message: str, log=True, markdown=True, on_sent=None, silent=False):
+        """
+        `on_sent(telegram.Message)`, if given, is called once the message is sent (_e.g._ to edit it later).
+        `silent` messages are delivered without notification.
+        """
         try:
             if log:
                 self.log(logging.INFO, "Sending message: %s" % message)
@@ -231,19 +256,85 @@ class RaspOne:
                 self.chat_id,
                 message,
                 parse_mode=telegram.constants.ParseMode.MARKDOWN if markdown else None,
-                reply_markup=telegram.ReplyKeyboardRemove()
+                reply_markup=telegram.ReplyKeyboardRemove(),
+                disable_notification=silent
             )
 
-            if not self._event_loop:
-                self._event_loop = asyncio.get_event_loop()
-
-            self._event_loop.create_task(send_message_coroutine)
+            self._schedule(self._send_message(send_message_coroutine, on_sent))
             return True
 
         except telegram.error.TelegramError as send_error:
             self.log(logging.ERROR, "Send message error! Reason: %s" % send_error, exc_info=True, stack_info=True)
             return False
 
+    async def _send_message(self, send_message_coroutine, on_sent=None):
+        # Scheduled: the errors are raised here, not in `send_message`
+        try:
+            sent_message = await send_message_coroutine
+
+        except telegram.error.TelegramError as send_error:
+            # Not sent on the chat: it would fail the same way
+            self.log(logging.ERROR, "Send message error! Reason: %s" % send_error, network_error=True, exc_info=True)
+            return
+
+        if on_sent:
+            try:
+                on_sent(sent_message)
+
+            except Exception as callback_error:
+                self.log(logging.ERROR, "Sent message callback error! Reason: %s" % callback_error, exc_info=True)
+
+    def edit_message(self, message_id: int, message: str, log=True, markdown=True):
+        if log:
+            self.log(logging.INFO, "Editing message %s: %s" % (message_id, message))
+
+        self._schedule(self._edit_message(message_id, message, markdown))
+        return True
+
+    async def _edit_message(self, message_id, message, markdown):
+        try:
+            await self.application.bot.edit_message_text(
+                message,
+                chat_id=self.chat_id,
+                message_id=message_id,
+                parse_mode=telegram.constants.ParseMode.MARKDOWN if markdown else None
+            )
+
+        except telegram.error.BadRequest as edit_error:  # Before `NetworkError`, its base class
+            if "not modified" in str(edit_error).lower():
+                # Same text as the message (_e.g._ progress unchanged since the last edit)
+                self.log(logging.DEBUG, "Edit message skipped, not modified: %s" % message_id)
+                return
+
+            self.log(logging.ERROR, "Edit message error! Reason: %s" % edit_error, exc_info=True)
+
+        except telegram.error.RetryAfter as edit_error:
+            # Flood control: an error message on the chat would be limited too
+            self.log(logging.WARNING, "Edit message error! Reason: %s" % edit_error, network_error=True)
+
+        except telegram.error.NetworkError as edit_error:
+            self.log(logging.ERROR, "Edit message error! Reason: %s" % edit_error, network_error=True, exc_info=True)
+
+        except telegram.error.TelegramError as edit_error:
+            self.log(logging.ERROR, "Edit message error! Reason: %s" % edit_error, exc_info=True)
+
+    def _schedule(self, coroutine):
+        if not self._event_loop:
+            self._event_loop = asyncio.get_event_loop()
+
+        # Alerts are sent from the IPC threads too
+        try:
+            in_loop = asyncio.get_running_loop() is self._event_loop
+
+        except RuntimeError:
+            in_loop = False
+
+        if in_loop:
+            self._event_loop.create_task(coroutine)
+
+        else:
+            asyncio.run_coroutine_threadsafe(coroutine, self._event_loop)
+
     # Errors
     def _register_error(self):
         self.application.add_error_handler(self._error_handler)
@@ -283,6 +374,12 @@ class RaspOne:
         module_instance = self.modules["instances"].pop(module_name)
         self.application.remove_handler(self.modules["handlers"].pop(module_name))
 
+        try:
+            module_instance.kill()
+
+        except Exception as kill_error:
+            self.log(logging.ERROR, "Error killing module %s: %s" % (module_name, kill_error), exc_info=True)
+
         if module_name in self.ipc.services:
             self.ipc.remove_service(module_name)
 
@@ -304,6 +401,11 @@ class RaspOne:
         self.log(logging.WARNING, "Terminated...")
 
 
+CALLBACK_TOKENS_SIZE = 4096
+
+CALLBACK_TOKENS_TTL = 60 * 60  # seconds
+
+
 # Exception
 class RaspOneException(Exception):
     """Custom exception to catch in the main thread, raised by the code for a specific reason.
@@ -0,0 +1,227 @@
+import os
+import time
+import logging
+import ipaddress
+import threading
+import cachetools
+
+from src import config, DEFAULT_NAME
+
+module_logger = logging.getLogger(DEFAULT_NAME + ".geoip")
+
+_geoip = None
+_geoip_lock = threading.Lock()
+
+
+def get_geoip():
+    """The `GeoIP` instance shared by the modules, configured by the `[GeoIP]` section."""
+    global _geoip
+    if _geoip is None:
+        with _geoip_lock:
+            if _geoip is None:
+                geoip_config = config["GeoIP"] if config.has_section("GeoIP") else dict()
+                _geoip = GeoIP(
+                    *(geoip_config.get(x, "None") for x in ("CityDatabase", "ASNDatabase")),
+                    **{x.lower(): _parse_list(geoip_config.get(x, "None"))
+                       for x in ("AllowCountries", "DenyCountries", "AllowASN", "DenyASN")}
+                )
+
+    return _geoip
+
+
+def _parse_list(value):
+    return {x.strip().upper() for x in value.split(",") if x.strip()} if value != "None" else set()
+
+
+class GeoIP:
+    """
+    Offline country, city and ASN of IP addresses, from local MaxMind-format (`.mmdb`) databases (_e.g._ GeoLite2
+    City and ASN) read memory-mapped. Lookups are LRU cached; a database file replaced on disk is reopened.
+    The allow/deny lists (country ISO codes, AS numbers) decide the severity of the alerts.
+    """
+
+    def __init__(self, city_path="None", asn_path="None", allowcountries=None, denycountries=None, allowasn=None,
+                 denyasn=None):
+        self.databases = {name: _Database(path) for name, path in (("city", city_path), ("asn", asn_path))
+                          if path != "None"}
+
+        self.allow_countries = allowcountries or set()
+        self.deny_countries = denycountries or set()
+        self.allow_asn = allowasn or set()
+        self.deny_asn = denyasn or set()
+
+        self.cache = cachetools.LRUCache(maxsize=LOOKUP_CACHE_SIZE)
+        self._cache_lock = threading.Lock()
+
+    @property
+    def available(self):
+        return bool(self.databases)
+
+    def lookup(self, ip):
+        """
+        `{"country", "country_name", "city", "asn", "org"}` of `ip` (the keys found), `{"private": True}` for
+        private addresses, None if not an IP address or not found.
+        """
+        try:
+            ip = ipaddress.ip_address(ip.strip("[]"))
+
+        except (ValueError, AttributeError):
+            return None
+
+        if not ip.is_global:
+            return {"private": True}
+
+        # A reloaded database invalidates the cache
+        if any([database.check_reload() for database in self.databases.values()]):
+            with self._cache_lock:
+                self.cache.clear()
+
+        with self._cache_lock:
+            info = self.cache.get(ip, False)
+
+        if info is False:
+            info = self._lookup(str(ip))
+            with self._cache_lock:
+                self.cache[ip] = info
+
+        return info
+
+    def _lookup(self, ip):
+        info = dict()
+        city = self.databases["city"].get(ip) if "city" in self.databases else None
+        if city:
+            country = city.get("country", None) or city.get("registered_country", None) or dict()
+            info.update({
+                "country": country.get("iso_code", None),
+                "country_name": country.get("names", dict()).get("en", None),
+                "city": city.get("city", dict()).get("names", dict()).get("en", None)
+            })
+
+        asn = self.databases["asn"].get(ip) if "asn" in self.databases else None
+        if asn:
+            info.update({"asn": asn.get("autonomous_system_number", None),
+                         "org": asn.get("autonomous_system_organization", None)})
+
+        info = {k: v for k, v in info.items() if v}
+        return info or None
+
+    def annotate(self, ip):
+        """`(description, severity)` of `ip` for an alert, `(None, None)` without databases or address."""
+        if not self.available or not ip:
+            return None, None
+
+        info = self.lookup(ip)
+        if info is None:
+            return None, None
+
+        return self.describe(info), self.severity(info)
+
+    def describe(self, info):
+        """_e.g._ `Rome, Italy (IT) - AS3269 Telecom Italia`"""
+        if not info:
+            return "Unknown location"
+
+        elif info.get("private", False):
+            return "Private network"
+
+        location = ", ".join(x for x in (info.get("city", None), info.get("country_name", None)) if x)
+        if info.get("country", None):
+            location += " (%s)" % info["country"] if location else info["country"]
+
+        if info.get("asn", None):
+            location += (" - " if location else "") + "AS%d" % info["asn"] + \
+                        (" %s" % info["org"] if info.get("org", None) else "")
+
+        return location or "Unknown location"
+
+    def severity(self, info):
+        """
+        `deny` (denied country/ASN, or not in the allowed countries when set), `allow` (allowed country/ASN, or private
+        address when a list is set) or None (no policy).
+        """
+        if not info:
+            return None
+
+        elif info.get("private", False):
+            return "allow" if self.allow_countries or self.deny_countries or self.allow_asn or self.deny_asn else None
+
+        country, asn = info.get("country", None), str(info.get("asn", ""))
+        if country in self.deny_countries or asn in self.deny_asn:
+            return "deny"
+
+        elif country in self.allow_countries or asn in self.allow_asn:
+            return "allow"
+
+        elif self.allow_countries and country:
+            return "deny"
+
+        return None
+
+
+class _Database:
+    """A `.mmdb` file, memory-mapped, reopened when replaced (checked at most every `RELOAD_CHECK_INTERVAL`)."""
+
+    def __init__(self, path):
+        self.path = path
+        self.reader = None
+        self.file_id = None
+        self.checked = 0
+        self.lock = threading.Lock()
+
+        self.check_reload(force=True)
+
+    def check_reload(self, force=False):
+        """Reopen the file if replaced, return True if reopened."""
+        now = time.monotonic()
+        if not force and now - self.checked < RELOAD_CHECK_INTERVAL:
+            return False
+
+        self.checked = now
+        try:
+            stat = os.stat(self.path)
+
+        except OSError:
+            return False
+
+        if (stat.st_ino, stat.st_mtime_ns, stat.st_size) == self.file_id:
+            return False
+
+        with self.lock:
+            try:
+                import maxminddb
+
+                reader = maxminddb.open_database(self.path, mode=maxminddb.MODE_MMAP)
+
+            except ImportError:
+                module_logger.error("[GeoIP] `maxminddb` not installed: pip install maxminddb")
+                self.file_id = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+                return False
+
+            except (OSError, ValueError) as error:
+                module_logger.error("[GeoIP] Unable to open %s: %s" % (self.path, error))
+                return False
+
+            old_reader, self.reader = self.reader, reader
+            self.file_id = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+        if old_reader:
+            old_reader.close()
+
+        module_logger.info("[GeoIP] Loaded %s" % self.path)
+        return True
+
+    def get(self, ip):
+        with self.lock:
+            if not self.reader:
+                return None
+
+            try:
+                return self.reader.get(ip)
+
+            except ValueError:
+                return None
+
+
+LOOKUP_CACHE_SIZE = 4096
+
+RELOAD_CHECK_INTERVAL = 60  # seconds
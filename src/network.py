@@ -1,10 +1,13 @@
+import os
 import json
+import time
 import random
+import hashlib
 import logging
 import requests
 import threading
 import cachetools
-from typing import Tuple, Union
+from typing import Callable, Iterator, Optional, Tuple, Union
 
 from src import config, DEFAULT_NAME
 
@@ -26,6 +29,8 @@ class Network:
     REQUEST_SENDING_ERROR = 2
     UNEXPECTED_RESPONSE_CODE = 3
     JSON_DECODE_ERROR = 4
+    CHECKSUM_MISMATCH = 5
+    FILE_ERROR = 6
 
     ERROR_DETAIL = "See internal log for further details (ID: %d)."
 
@@ -34,8 +39,13 @@ class Network:
         REQUEST_SENDING_ERROR: "Error during request sending. " + ERROR_DETAIL,
         UNEXPECTED_RESPONSE_CODE: "Response code differs from 200 OK. " + ERROR_DETAIL,
         JSON_DECODE_ERROR: "Response body is not a valid JSON. " + ERROR_DETAIL,
+        CHECKSUM_MISMATCH: "Checksum of the downloaded data does not match. " + ERROR_DETAIL,
+        FILE_ERROR: "Error reading/writing the local file. " + ERROR_DETAIL,
     }
 
+    STREAM_CHUNK_SIZE = 64 * 1024
+    PROGRESS_INTERVAL = 2  # seconds between two calls of a progress callback
+
     def __init__(self, module_name):
         self.module_name = module_name
         self.module_logger = logging.getLogger(DEFAULT_NAME + ".network:" + module_name)
@@ -103,7 +113,8 @@ class Network:
                        if req_obj["res"].headers else "") + "\n" + \
                       ('\n'.join('{}: {}'.format(k, v) for k, v in req_obj["res"].cookies.items())
                        if req_obj["res"].cookies else "") + "\n" + \
-                      (req_obj["res"].text if hasattr(req_obj["res"], "text") and req_obj["res"].text else "")
+                      ("<streamed body>" if req_obj.get("stream", False) else
+                       (req_obj["res"].text if hasattr(req_obj["res"], "text") and req_obj["res"].text else ""))
 
         return output
 
@@ -124,13 +135,18 @@ class Network:
         return self.ERRORS[err_str] % request_id
 
     # Network
-    def curl(self, url, method="get", check_200=True, parse_json=True, **kwargs) \
+    def curl(self, url, method="get", check_200=True, parse_json=True, stream=False, timeout=None, **kwargs) \
             -> Tuple[Union[requests.Response, bool], int]:
+        """
+        With `stream=True` the response body is not read (nor parsed as JSON): the caller is in charge of consuming
+        it with `response.iter_content()` and closing the response.
+        `timeout` (seconds, or a `(connect, read)` tuple) is passed to `requests`, no timeout by default.
+        """
         request_id = random.randint(11111111, 99999999)
 
         self.module_logger.debug(
-            "[cURL] Building new request for: %s (method: %s, 200: %s, JSON: %s, kwargs: %s) [ID: %s]" %
-            (url, method.upper(), check_200, parse_json, kwargs, request_id))
+            "[cURL] Building new request for: %s (method: %s, 200: %s, JSON: %s, stream: %s, kwargs: %s) [ID: %s]" %
+            (url, method.upper(), check_200, parse_json, stream, kwargs, request_id))
 
         try:
             request = self.session.prepare_request(requests.Request(method, url, **kwargs))
@@ -141,10 +157,10 @@ class Network:
             self._save_request_stack(request_id, err=self.REQUEST_NOT_BUILT)
             return False, request_id
 
-        self._save_request_stack(request_id, req=request)
+        self._save_request_stack(request_id, req=request, stream=stream)
 
         try:
-            response = self.session.send(request)
+            response = self.session.send(request, stream=stream, timeout=timeout)
 
         except (requests.RequestException, requests.ConnectionError, requests.HTTPError,
                 ConnectionError, ValueError, Exception):
@@ -157,12 +173,15 @@ class Network:
 
         if check_200 and response.status_code != 200:
             self.module_logger.warning("[cURL] Response code != 200. [ID %s]" % request_id)
+            if stream:
+                response.close()
+
             self._save_request_stack(request_id, err=self.UNEXPECTED_RESPONSE_CODE)
             return False, request_id
 
         elif "Content-Type" in response.headers \
                 and "application/json" in response.headers["Content-Type"] \
-                and parse_json:
+                and parse_json and not stream:
             decoded_json = self.safe_json(response)
             if not decoded_json:
                 self.module_logger.warning("[cURL] Response not a JSON. [ID %s]" % request_id)
@@ -182,3 +201,210 @@ class Network:
         except (ValueError, TypeError, json.JSONDecodeError):
             module_global_logger.warning("[SafeJson] unable to decode JSON response.", exc_info=True, stack_info=True)
             return False
+
+    # Streaming
+    def iter_content(self, url, method="get", chunk_size=None, **kwargs) \
+            -> Tuple[Union[Iterator[bytes], bool], int]:
+        """
+        Return a generator of body chunks (at most `chunk_size` bytes each), never holding the whole body in memory.
+        The underlying response is closed when the generator is exhausted or garbage collected.
+        """
+        response, request_id = self.curl(url, method=method, stream=True, **kwargs)
+        if response is False:
+            return False, request_id
+
+        def chunks():
+            with response:
+                yield from response.iter_content(chunk_size=chunk_size or self.STREAM_CHUNK_SIZE)
+
+        return chunks(), request_id
+
+    def download(self, url, file_path, checksum: Optional[Tuple[str, str]] = None, resume=True,
+                 progress_callback: Optional[Callable[[int, Optional[int]], None]] = None,
+                 chunk_size=None, **kwargs) -> Tuple[Union[str, bool], int]:
+        """
+        Download `url` into `file_path` with bounded memory (one chunk at a time).
+
+        - The data is written in `<file_path>.part`, renamed to `file_path` only once completed and verified.
+        - With `resume=True` an existing `.part` file is continued with a `Range` request (if the server answers
+          with `206 Partial Content`, otherwise the download starts from scratch).
+        - `checksum` is a tuple `(algorithm, hexdigest)`, e.g. `("sha256", "ab12...")`, computed while streaming.
+        - `progress_callback(downloaded_bytes, total_bytes_or_None)` is called at most every `PROGRESS_INTERVAL`
+          seconds, and once at the end.
+        """
+        part_path = file_path + ".part"
+        hasher = hashlib.new(checksum[0]) if checksum else None
+
+        offset = 0
+        if resume and os.path.isfile(part_path):
+            offset = os.path.getsize(part_path)
+
+        request_headers = kwargs.pop("headers", None)
+        headers = dict(request_headers or {})
+        if offset:
+            headers["Range"] = "bytes=%d-" % offset
+
+        response, request_id = self.curl(url, check_200=False, stream=True, headers=headers, **kwargs)
+        if response is False:
+            return False, request_id
+
+        restart = False
+        with response:
+            if response.status_code == 416 and offset:
+                # Range not satisfiable: the `.part` file is complete if the remote size (`Content-Range: */N`) is
+                # its size or if the checksum verifies it, otherwise it's not a prefix of this file
+                content_range = response.headers.get("Content-Range", "")
+                restart = not hasher and content_range != "bytes */%d" % offset
+                total_size = offset
+                write_mode = None
+
+            elif response.status_code == 206 and offset:
+                total_size = self._get_total_size(response, offset)
+                write_mode = "ab"
+
+            elif response.status_code == 200:
+                total_size = self._get_total_size(response, 0)
+                offset = 0
+                write_mode = "wb"
+
+            else:
+                self.module_logger.warning("[cURL] Unexpected response code for download. [ID %s]" % request_id)
+                self._save_request_stack(request_id, err=self.UNEXPECTED_RESPONSE_CODE)
+                return False, request_id
+
+            try:
+                if hasher and offset:
+                    # Resumed download: the checksum must cover the data already on disk
+                    with open(part_path, "rb") as part_file:
+                        for chunk in iter(lambda: part_file.read(chunk_size or self.STREAM_CHUNK_SIZE), b""):
+                            hasher.update(chunk)
+
+                downloaded = offset
+                if write_mode:
+                    progress = self._throttled_progress(progress_callback)
+                    with open(part_path, write_mode) as part_file:
+                        for chunk in response.iter_content(chunk_size=chunk_size or self.STREAM_CHUNK_SIZE):
+                            part_file.write(chunk)
+                            if hasher:
+                                hasher.update(chunk)
+
+                            downloaded += len(chunk)
+                            progress(downloaded, total_size)
+
+            except (requests.RequestException, ConnectionError):
+                # The `.part` file is kept, the next call will resume it
+                self.module_logger.error("[cURL] Download interrupted. [ID %s]" % request_id,
+                                         exc_info=True, stack_info=True)
+                self._save_request_stack(request_id, err=self.REQUEST_SENDING_ERROR)
+                return False, request_id
+
+            except OSError:
+                self.module_logger.error("[cURL] Unable to write the downloaded file. [ID %s]" % request_id,
+                                         exc_info=True, stack_info=True)
+                self._save_request_stack(request_id, err=self.FILE_ERROR)
+                return False, request_id
+
+        if restart:
+            self.module_logger.warning("[cURL] Partial file not matching the remote size, restarting the download. "
+                                       "[ID %s]" % request_id)
+            return self.download(url, file_path, checksum, False, progress_callback, chunk_size,
+                                 headers=request_headers, **kwargs)
+
+        if hasher and hasher.hexdigest().lower() != checksum[1].lower():
+            self.module_logger.warning("[cURL] Checksum mismatch (%s != %s). [ID %s]" %
+                                       (hasher.hexdigest(), checksum[1], request_id))
+            os.remove(part_path)
+            self._save_request_stack(request_id, err=self.CHECKSUM_MISMATCH)
+            return False, request_id
+
+        try:
+            os.replace(part_path, file_path)
+
+        except OSError:
+            self.module_logger.error("[cURL] Unable to move the downloaded file. [ID %s]" % request_id,
+                                     exc_info=True, stack_info=True)
+            self._save_request_stack(request_id, err=self.FILE_ERROR)
+            return False, request_id
+
+        self._call_progress(progress_callback, downloaded, total_size)
+        return file_path, request_id
+
+    def upload(self, url, file_path, method="put",
+               progress_callback: Optional[Callable[[int, Optional[int]], None]] = None, **kwargs) \
+            -> Tuple[Union[requests.Response, bool], int]:
+        """
+        Upload `file_path` as the request body, streaming it from disk (sent with a `Content-Length` header).
+        `progress_callback(uploaded_bytes, total_bytes)` behaves like in `download`.
+        """
+        try:
+            with open(file_path, "rb") as upload_file:
+                body = _ProgressReader(upload_file, self._throttled_progress(progress_callback))
+                response, request_id = self.curl(url, method=method, data=body, **kwargs)
+
+        except OSError:
+            request_id = random.randint(11111111, 99999999)
+            self.module_logger.error("[cURL] Unable to read the file to upload. [ID %s]" % request_id,
+                                     exc_info=True, stack_info=True)
+            self._save_request_stack(request_id, err=self.FILE_ERROR)
+            return False, request_id
+
+        if response is not False:
+            self._call_progress(progress_callback, len(body), len(body))
+
+        return response, request_id
+
+    def _throttled_progress(self, progress_callback):
+        if not progress_callback:
+            return lambda *_: None
+
+        last_call = [0.]
+
+        def progress(done, total):
+            now = time.monotonic()
+            if now - last_call[0] >= self.PROGRESS_INTERVAL:
+                last_call[0] = now
+                self._call_progress(progress_callback, done, total)
+
+        return progress
+
+    def _call_progress(self, progress_callback, done, total):
+        # A failing callback (_e.g._ a message edit) must not fail the transfer
+        if not progress_callback:
+            return
+
+        try:
+            progress_callback(done, total)
+
+        except Exception:
+            self.module_logger.warning("[cURL] Progress callback error.", exc_info=True)
+
+    @staticmethod
+    def _get_total_size(response, offset):
+        if "Content-Range" in response.headers:
+            total_size = response.headers["Content-Range"].rpartition("/")[2]
+            return int(total_size) if total_size.isdigit() else None
+
+        elif "Content-Length" in response.headers and response.headers["Content-Length"].isdigit():
+            return offset + int(response.headers["Content-Length"])
+
+        return None
+
+
+class _ProgressReader:
+    """File wrapper used as request body: `requests` streams it with `read()` and takes its size from `len()`."""
+
+    def __init__(self, file, progress):
+        self.file = file
+        self.progress = progress
+
+        self.size = os.fstat(file.fileno()).st_size
+        self.read_bytes = 0
+
+    def __len__(self):
+        return self.size
+
+    def read(self, size=-1):
+        chunk = self.file.read(size)
+        self.read_bytes += len(chunk)
+        self.progress(self.read_bytes, self.size)
+        return chunk
@@ -0,0 +1,78 @@
+import math
+import array
+
+
+class SampleRing:
+    """
+    Fixed-size ring buffer of the last `size` samples (timestamp, one value per column), stored in `array`s of doubles:
+    a few bytes per sample, allocated once. `step` is the expected interval between two samples, if regular.
+    """
+
+    __slots__ = ("step", "times", "values", "index", "count")
+
+    def __init__(self, size, columns, step=None):
+        self.step = step
+        self.times = array.array("d", bytes(8 * size))
+        self.values = [array.array("d", bytes(8 * size)) for _ in range(columns)]
+        self.index = self.count = 0
+
+    @property
+    def span(self):
+        return self.step * len(self.times)
+
+    def append(self, timestamp, values):
+        self.times[self.index] = timestamp
+        for column, value in zip(self.values, values):
+            column[self.index] = value
+
+        self.index = (self.index + 1) % len(self.times)
+        self.count = min(self.count + 1, len(self.times))
+
+    def last(self):
+        return self.sample(0)[1] if self.count else [math.nan] * len(self.values)
+
+    def sample(self, age):
+        """`(timestamp, values)` of the sample appended `age` samples before the last one, None if not kept."""
+        if not 0 <= age < self.count:
+            return None
+
+        index = (self.index - 1 - age) % len(self.times)
+        return self.times[index], [column[index] for column in self.values]
+
+    def indexes(self, seconds=None):
+        """Indexes of the samples of the last `seconds` (all the samples kept if None), newest first."""
+        size = len(self.times)
+        cutoff = self.times[(self.index - 1) % size] - seconds if seconds is not None else -math.inf
+        for i in range(1, self.count + 1):
+            index = (self.index - i) % size
+            if self.times[index] <= cutoff:
+                return
+
+            yield index
+
+    def mean(self, seconds=None):
+        """Mean of each column over the last `seconds` (all the samples kept if None), NaN skipped."""
+        sums, counts = [0.0] * len(self.values), [0] * len(self.values)
+        for index in self.indexes(seconds):
+            for j, column in enumerate(self.values):
+                if not math.isnan(column[index]):
+                    sums[j] += column[index]
+                    counts[j] += 1
+
+        return [x / c if c else math.nan for x, c in zip(sums, counts)]
+
+    def series(self, seconds, points):
+        """Last `seconds` split in `points` intervals, oldest first: the mean of each column in each interval."""
+        sums = [[0.0] * len(self.values) for _ in range(points)]
+        counts = [[0] * len(self.values) for _ in range(points)]
+        if self.count:
+            end = self.times[(self.index - 1) % len(self.times)]
+            for index in self.indexes(seconds):
+                point = min(int((seconds - (end - self.times[index])) / seconds * points), points - 1)
+                for j, column in enumerate(self.values):
+                    if not math.isnan(column[index]):
+                        sums[point][j] += column[index]
+                        counts[point][j] += 1
+
+        return [[x / c if c else math.nan for x, c in zip(point_sums, point_counts)]
+                for point_sums, point_counts in zip(sums, counts)]
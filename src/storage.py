@@ -0,0 +1,22 @@
+import os
+import tempfile
+
+
+def write_atomic(path, text):
+    """
+    Write `text` to `path` through a temporary file replacing it: a crash while writing never leaves a truncated
+    file, and concurrent writers never mix their data (each one has its own temporary file). Raise `OSError`.
+    """
+    file_descriptor, tmp_path = tempfile.mkstemp(prefix=os.path.basename(path) + ".", suffix=".tmp",
+                                                 dir=os.path.dirname(path) or ".")
+    try:
+        with os.fdopen(file_descriptor, "w") as tmp_file:
+            tmp_file.write(text)
+
+        os.replace(tmp_path, path)
+
+    except OSError:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+        raise